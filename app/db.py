@@ -3,21 +3,35 @@
 """
 from __future__ import annotations
 
-from collections.abc import AsyncGenerator
-from typing import Annotated
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from typing import Annotated, TypeVar
 
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
+T = TypeVar("T")
+
 
 def get_engine(database_url: str):
-    """Создаёт async engine для PostgreSQL."""
+    """Создаёт async engine для PostgreSQL; размеры пула и таймауты — из настроек (DB_*)."""
+    from config import get_settings
+
+    settings = get_settings()
+    connect_args = {}
+    if database_url.startswith("postgresql+asyncpg"):
+        connect_args = {
+            "command_timeout": settings.DB_COMMAND_TIMEOUT,
+            # Короткие OLTP-запросы бота: JIT Postgres только добавляет задержку на планирование
+            "server_settings": {"jit": "off", "application_name": "scantext-bot"},
+        }
     return create_async_engine(
         database_url,
         echo=False,
         pool_pre_ping=True,
-        pool_size=20,
-        max_overflow=40,
-        pool_recycle=3600,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        connect_args=connect_args,
     )
 
 
@@ -44,6 +58,15 @@ def init_db(database_url: str) -> None:
     async_session_factory = get_session_factory(engine)
 
 
+async def run_in_own_session(fn: Callable[[AsyncSession], Awaitable[T]]) -> T:
+    """Выполняет fn(session) в отдельной короткой сессии — для параллельных read-only запросов
+    (одна AsyncSession не допускает параллельных запросов, asyncio.gather по разным сессиям — да)."""
+    if async_session_factory is None:
+        raise RuntimeError("DB not initialized. Call init_db() first.")
+    async with async_session_factory() as s:
+        return await fn(s)
+
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     """Yield async session для dependency injection в хэндлерах."""
     if async_session_factory is None:
@@ -20,9 +20,11 @@ SYSTEM_PROMPT = """Ты — высокоточный OCR-инструмент. 
 - Языки: русский и английский. Не переводи текст, выводи в оригинале."""
 
 
-def prepare_image_for_llm(image_bytes: bytes, max_side: int = 2048, jpeg_quality: int = 88) -> bytes:
+def prepare_image_for_llm(image_bytes: bytes, max_side: int = 2048, jpeg_quality: int = 85) -> bytes:
     """
     Уменьшает изображение до max_side по большей стороне и конвертирует в JPEG.
+    Готовый JPEG, уже укладывающийся в max_side (страницы PDF рендерятся сразу в JPEG),
+    возвращается как есть — без повторного декодирования и сжатия.
     Возвращает байты JPEG для последующего base64.
     """
     from PIL import Image
@@ -30,22 +32,19 @@ def prepare_image_for_llm(image_bytes: bytes, max_side: int = 2048, jpeg_quality
     if not image_bytes or len(image_bytes) < 100:
         raise ValueError("Изображение пустое или слишком маленькое")
     try:
-        img = Image.open(BytesIO(image_bytes)).convert("RGB")
+        img = Image.open(BytesIO(image_bytes))
+        if img.format == "JPEG" and img.mode in ("RGB", "L") and max(img.size) <= max_side:
+            return image_bytes
+        img = img.convert("RGB")
     except Exception as e:
         logger.warning("Не удалось открыть изображение: %s", e)
         raise ValueError(f"Не удалось прочитать изображение: {e!s}") from e
     w, h = img.size
-    if max(w, h) <= max_side:
-        out = BytesIO()
-        img.save(out, format="JPEG", quality=jpeg_quality, optimize=True)
-        return out.getvalue()
-    scale = max_side / max(w, h)
-    new_w = max(1, int(w * scale))
-    new_h = max(1, int(h * scale))
-    resampling = getattr(Image, "Resampling", Image).LANCZOS
-    img = img.resize((new_w, new_h), resampling)
+    if max(w, h) > max_side:
+        resampling = getattr(Image, "Resampling", Image).LANCZOS
+        img.thumbnail((max_side, max_side), resampling)
     out = BytesIO()
-    img.save(out, format="JPEG", quality=jpeg_quality, optimize=True)
+    img.save(out, format="JPEG", quality=jpeg_quality, optimize=True, progressive=True)
     return out.getvalue()
 
 
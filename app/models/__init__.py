@@ -4,6 +4,7 @@ from app.models.document import Document
 from app.models.payment_package import PaymentPackage
 from app.models.refund import RefundProcessed
 from app.models.settings import BotSettings
+from app.models.stats import StatsCounter
 from app.models.transaction import Transaction
 from app.models.user import User, UserBalance, UserUTM
 
@@ -13,6 +14,7 @@ __all__ = [
     "Document",
     "PaymentPackage",
     "RefundProcessed",
+    "StatsCounter",
     "Transaction",
     "User",
     "UserBalance",
@@ -6,7 +6,7 @@ from __future__ import annotations
 from datetime import datetime
 from typing import TYPE_CHECKING
 
-from sqlalchemy import DateTime, ForeignKey, Integer, String, Text, func
+from sqlalchemy import BigInteger, DateTime, Enum, ForeignKey, Identity, Index, Integer, String, Text, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.models.base import Base
@@ -14,21 +14,33 @@ from app.models.base import Base
 if TYPE_CHECKING:
     from app.models.user import User
 
+DOCUMENT_STATUSES = ("pending", "processing", "done", "error")
+
 
 class Document(Base):
     """Документ: загруженный файл, статус обработки. Результат отправляется в чат (текст или файл)."""
 
     __tablename__ = "documents"
-
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    __table_args__ = (
+        # Очистка зависших: pending/processing старше N минут (миграция 013); завершённые в индекс не попадают
+        Index(
+            "ix_documents_active_created",
+            "created_at",
+            postgresql_where=text("status IN ('pending', 'processing')"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)  # bigint identity (миграция 016)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     telegram_file_id: Mapped[str] = mapped_column(String(512), nullable=False)  # file_id из Telegram
     telegram_file_unique_id: Mapped[str | None] = mapped_column(String(255), nullable=True)
     file_name: Mapped[str | None] = mapped_column(String(512), nullable=True)
     mime_type: Mapped[str | None] = mapped_column(String(128), nullable=True)
 
-    # Статус: pending, processing, done, error
-    status: Mapped[str] = mapped_column(String(50), default="pending", nullable=False, index=True)
+    # Статус: pending, processing, done, error (enum document_status, миграция 015)
+    status: Mapped[str] = mapped_column(
+        Enum(*DOCUMENT_STATUSES, name="document_status"), default="pending", nullable=False, index=True
+    )
     error_message: Mapped[str | None] = mapped_column(Text, nullable=True)
     
     deducted_free: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
@@ -0,0 +1,38 @@
+"""
+Счётчики для сводки админки (поддерживаются триггерами БД, см. миграции 010 и 017).
+"""
+from __future__ import annotations
+
+from decimal import Decimal
+
+from sqlalchemy import Numeric, SmallInteger, String, func, select
+from sqlalchemy.orm import Mapped, mapped_column
+
+from app.models.base import Base
+
+# Ключи stats_counters
+STATS_USERS = "users"
+STATS_DOCS = "docs"
+STATS_PAID = "paid"
+# Строк (шардов) на ключ: триггер пишет дельту в шард pg_backend_pid() % STATS_SHARDS (миграция 017),
+# параллельные транзакции не ждут друг друга на одной строке; значение счётчика — сумма шардов
+STATS_SHARDS = 16
+
+
+class StatsCounter(Base):
+    """Шард счётчика: число пользователей, документов и сумма успешных оплат — sum(value) по key."""
+
+    __tablename__ = "stats_counters"
+
+    key: Mapped[str] = mapped_column(String(32), primary_key=True, nullable=False)
+    shard: Mapped[int] = mapped_column(SmallInteger, primary_key=True, default=0, server_default="0")
+    value: Mapped[Decimal] = mapped_column(Numeric(20, 2), nullable=False, default=0, server_default="0")
+
+
+def stats_totals_stmt(keys):
+    """SELECT key, sum(value) по шардам для заданных ключей."""
+    return (
+        select(StatsCounter.key, func.sum(StatsCounter.value))
+        .where(StatsCounter.key.in_(keys))
+        .group_by(StatsCounter.key)
+    )
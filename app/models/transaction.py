@@ -7,7 +7,7 @@ from datetime import datetime
 from decimal import Decimal
 from typing import TYPE_CHECKING
 
-from sqlalchemy import DateTime, ForeignKey, Integer, Numeric, String, func
+from sqlalchemy import BigInteger, DateTime, ForeignKey, Identity, Index, Integer, Numeric, String, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.models.base import Base
@@ -20,8 +20,19 @@ class Transaction(Base):
     """Платёж ЮKassa."""
 
     __tablename__ = "transactions"
-
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    __table_args__ = (
+        # Лимит активных оплат при /buy: число pending пользователя за последние N минут (миграция 012).
+        # Единственный запрос по (user_id, status, created_at); полный индекс по всем статусам не заводится —
+        # истории платежей пользователя нет, а на каждую запись он стоил бы лишней вставки в индекс
+        Index(
+            "ix_transactions_user_pending_created",
+            "user_id",
+            "created_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)  # bigint identity (миграция 016)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     idempotency_key: Mapped[str | None] = mapped_column(String(255), unique=True, nullable=True, index=True)
     yookassa_payment_id: Mapped[str | None] = mapped_column(String(255), unique=True, nullable=True, index=True)
@@ -6,7 +6,7 @@ from __future__ import annotations
 from datetime import datetime
 from typing import TYPE_CHECKING
 
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String, Text, func
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, Text, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.models.base import Base
@@ -23,7 +23,7 @@ class User(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     tg_id: Mapped[int] = mapped_column(BigInteger, unique=True, nullable=False, index=True)
-    username: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    username: Mapped[str | None] = mapped_column(String(255), nullable=True, index=True)
     first_name: Mapped[str | None] = mapped_column(String(255), nullable=True)
     last_name: Mapped[str | None] = mapped_column(String(255), nullable=True)
 
@@ -41,6 +41,9 @@ class User(Base):
     free_limits_remaining: Mapped[int] = mapped_column(Integer, default=5, nullable=False)
     free_limits_reset_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
 
+    # Число документов пользователя; ведётся триггером на documents (миграция 010)
+    documents_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -67,6 +70,17 @@ class UserUTM(Base):
     """UTM-метки (deep link при /start)."""
 
     __tablename__ = "user_utm"
+    __table_args__ = (
+        # First-touch аналитика: строки в порядке окна (user_id, created_at, id) с метками прямо из индекса
+        # (index-only scan без сортировки таблицы, миграция 014)
+        Index(
+            "ix_user_utm_first_touch",
+            "user_id",
+            "created_at",
+            "id",
+            postgresql_include=["utm_source", "utm_medium", "utm_campaign"],
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
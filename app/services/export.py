@@ -1,113 +1,140 @@
 """
 Формирование выгрузок в Excel для админки.
+Строятся в Celery-воркере (sync-сессия): openpyxl в режиме write_only, строки из БД читаются
+порциями (yield_per) и сразу пишутся в лист — память не растёт вместе с таблицами.
 """
 from __future__ import annotations
 
+from collections.abc import Callable
+from datetime import datetime
 from io import BytesIO
+
 from openpyxl import Workbook
 from sqlalchemy import func, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.models import Transaction, User, UserBalance, UserUTM
+from app.models.stats import STATS_DOCS, STATS_PAID, STATS_USERS, stats_totals_stmt
+
+# Размер порции при потоковом чтении строк из БД
+_YIELD_PER = 1000
+
+
+def _fmt_dt(d: datetime | None) -> str:
+    """ГГГГ-ММ-ДД ЧЧ:ММ; вызывается на каждую строку выгрузки, поэтому без strftime."""
+    if d is None:
+        return ""
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d} {d.hour:02d}:{d.minute:02d}"
 
-from app.models import Document, Transaction, User, UserUTM
+
+def _save(wb: Workbook) -> bytes:
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
 
 
-async def build_users_xlsx(session: AsyncSession) -> bytes:
+def _stream(session: Session, stmt):
+    return session.execute(stmt.execution_options(yield_per=_YIELD_PER))
+
+
+def build_users_xlsx(session: Session) -> bytes:
     """Выгрузка пользователей: tg_id, username, имя, дата регистрации, беспл./платн. лимиты, кол-во документов."""
-    from sqlalchemy.orm import selectinload
-    result = await session.execute(select(User).options(selectinload(User.balance)))
-    users = result.scalars().all()
-    docs_count_q = select(Document.user_id, func.count(Document.id).label("cnt")).group_by(Document.user_id)
-    docs_result = await session.execute(docs_count_q)
-    docs_map = {row[0]: row[1] for row in docs_result.fetchall()}
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Пользователи"
+    # Пользователь + купленные лимиты одним запросом; число документов — счётчик users.documents_count
+    stmt = (
+        select(
+            User.tg_id,
+            User.username,
+            User.first_name,
+            User.last_name,
+            User.created_at,
+            User.free_limits_remaining,
+            func.coalesce(UserBalance.purchased_credits, 0),
+            User.documents_count,
+            User.is_banned,
+        )
+        .outerjoin(UserBalance, UserBalance.user_id == User.id)
+    )
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Пользователи")
     headers = ["tg_id", "username", "first_name", "last_name", "created_at", "free_remaining", "purchased", "documents_count", "is_banned"]
     ws.append(headers)
-    for u in users:
+    for tg_id, username, first_name, last_name, created_at, free_left, purchased, docs_count, is_banned in _stream(session, stmt):
         ws.append([
-            u.tg_id,
-            u.username or "",
-            u.first_name or "",
-            u.last_name or "",
-            u.created_at.strftime("%Y-%m-%d %H:%M") if u.created_at else "",
-            u.free_limits_remaining,
-            u.balance.purchased_credits if u.balance else 0,
-            docs_map.get(u.id, 0),
-            "да" if getattr(u, "is_banned", False) else "нет",
+            tg_id,
+            username or "",
+            first_name or "",
+            last_name or "",
+            _fmt_dt(created_at),
+            free_left,
+            purchased,
+            docs_count,
+            "да" if is_banned else "нет",
         ])
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
+    return _save(wb)
 
 
-async def build_transactions_xlsx(session: AsyncSession) -> bytes:
+def build_transactions_xlsx(session: Session) -> bytes:
     """Выгрузка транзакций: дата, user_id, tg_id, сумма, валюта, статус, описание."""
-    result = await session.execute(
-        select(Transaction, User.tg_id)
+    stmt = (
+        select(
+            Transaction.id,
+            Transaction.created_at,
+            Transaction.user_id,
+            User.tg_id,
+            Transaction.amount,
+            Transaction.currency,
+            Transaction.status,
+            Transaction.yookassa_payment_id,
+            Transaction.description,
+        )
         .join(User, Transaction.user_id == User.id)
         .order_by(Transaction.created_at.desc())
     )
-    rows = result.all()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Транзакции"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Транзакции")
     ws.append(["id", "created_at", "user_id", "tg_id", "amount", "currency", "status", "yookassa_payment_id", "description"])
-    for txn, tg_id in rows:
+    for txn_id, created_at, user_id, tg_id, amount, currency, status, payment_id, description in _stream(session, stmt):
         ws.append([
-            txn.id,
-            txn.created_at.strftime("%Y-%m-%d %H:%M") if txn.created_at else "",
-            txn.user_id,
+            txn_id,
+            _fmt_dt(created_at),
+            user_id,
             tg_id,
-            float(txn.amount),
-            txn.currency,
-            txn.status,
-            txn.yookassa_payment_id or "",
-            txn.description or "",
+            float(amount),
+            currency,
+            status,
+            payment_id or "",
+            description or "",
         ])
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
+    return _save(wb)
 
 
-async def build_summary_xlsx(session: AsyncSession) -> bytes:
+def build_summary_xlsx(session: Session) -> bytes:
     """Сводка: итоги по пользователям, документам, выручке."""
-    total_users = await session.scalar(select(func.count(User.id)))
-    total_docs = await session.scalar(select(func.count(Document.id)))
-    total_paid = await session.scalar(
-        select(func.coalesce(func.sum(Transaction.amount), 0)).where(Transaction.status == "succeeded")
-    ) or 0
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Сводка"
+    # Готовые счётчики stats_counters (ведутся триггерами, сумма шардов) вместо COUNT/SUM по таблицам
+    counters = dict(
+        session.execute(stats_totals_stmt((STATS_USERS, STATS_DOCS, STATS_PAID))).all()
+    )
+    total_users = int(counters.get(STATS_USERS, 0))
+    total_docs = int(counters.get(STATS_DOCS, 0))
+    total_paid = counters.get(STATS_PAID, 0)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Сводка")
     ws.append(["Показатель", "Значение"])
     ws.append(["Всего пользователей", total_users])
     ws.append(["Обработано документов", total_docs])
     ws.append(["Выручка (успешные платежи), ₽", float(total_paid)])
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
+    return _save(wb)
 
 
-async def build_utm_xlsx(session: AsyncSession) -> bytes:
+def build_utm_xlsx(session: Session) -> bytes:
     """Выгрузка UTM: лист first_touch_summary (агрегаты) и raw_events (все записи)."""
-    from app.services.utm_stats import get_first_touch_aggregates, get_utm_totals
+    from app.services.utm_stats import get_first_touch_aggregates_sync, get_utm_totals_sync
 
-    totals = await get_utm_totals(session)
-    aggregates = await get_first_touch_aggregates(session)
-    result = await session.execute(
-        select(UserUTM, User.tg_id)
-        .join(User, UserUTM.user_id == User.id)
-        .order_by(UserUTM.created_at.desc())
-    )
-    raw_rows = result.all()
+    totals = get_utm_totals_sync(session)
+    aggregates = get_first_touch_aggregates_sync(session)
 
-    wb = Workbook()
-    ws_summary = wb.active
-    ws_summary.title = "first_touch_summary"
+    wb = Workbook(write_only=True)
+    ws_summary = wb.create_sheet("first_touch_summary")
     ws_summary.append(["utm_source", "utm_medium", "utm_campaign", "user_count"])
     for row in aggregates:
         ws_summary.append([
@@ -120,26 +147,47 @@ async def build_utm_xlsx(session: AsyncSession) -> bytes:
     ws_summary.append(["Всего переходов с UTM", totals["total_utm_events"]])
     ws_summary.append(["Пользователей с UTM (first-touch)", totals["total_users_with_utm"]])
 
+    stmt = (
+        select(
+            UserUTM.id,
+            UserUTM.user_id,
+            User.tg_id,
+            UserUTM.utm_source,
+            UserUTM.utm_medium,
+            UserUTM.utm_campaign,
+            UserUTM.utm_term,
+            UserUTM.utm_content,
+            UserUTM.raw_start_payload,
+            UserUTM.created_at,
+        )
+        .join(User, UserUTM.user_id == User.id)
+        .order_by(UserUTM.created_at.desc())
+    )
     ws_raw = wb.create_sheet("raw_events")
     ws_raw.append([
         "id", "user_id", "tg_id", "utm_source", "utm_medium", "utm_campaign",
         "utm_term", "utm_content", "raw_start_payload", "created_at",
     ])
-    for utm, tg_id in raw_rows:
+    for utm_id, user_id, tg_id, source, medium, campaign, term, content, payload, created_at in _stream(session, stmt):
         ws_raw.append([
-            utm.id,
-            utm.user_id,
+            utm_id,
+            user_id,
             tg_id,
-            utm.utm_source or "",
-            utm.utm_medium or "",
-            utm.utm_campaign or "",
-            utm.utm_term or "",
-            utm.utm_content or "",
-            utm.raw_start_payload or "",
-            utm.created_at.strftime("%Y-%m-%d %H:%M") if utm.created_at else "",
+            source or "",
+            medium or "",
+            campaign or "",
+            term or "",
+            content or "",
+            payload or "",
+            _fmt_dt(created_at),
         ])
+    return _save(wb)
 
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
+
+# Вид выгрузки (аргумент export_xlsx_task) → (построитель, имя файла, подпись)
+EXPORTS: dict[str, tuple[Callable[[Session], bytes], str, str]] = {
+    "users": (build_users_xlsx, "users.xlsx", "Выгрузка пользователей"),
+    "transactions": (build_transactions_xlsx, "transactions.xlsx", "Выгрузка транзакций"),
+    "summary": (build_summary_xlsx, "summary.xlsx", "Сводка"),
+    "utm": (build_utm_xlsx, "utm.xlsx", "Выгрузка UTM"),
+}
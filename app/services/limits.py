@@ -0,0 +1,59 @@
+"""
+Списание лимитов одним запросом (sync-путь воркера: доплата за страницы PDF, требующие ИИ).
+"""
+from __future__ import annotations
+
+from sqlalchemy import exists, func, or_, select, update
+
+from app.models import User, UserBalance
+
+
+def spend_limits_stmt(user_id: int, amount: int):
+    """
+    UPDATE ... RETURNING ded_free: списывает amount лимитов (сначала бесплатные, затем купленные).
+    CTE locked блокирует строку пользователя, только если лимитов хватает; купленная часть списывается
+    вложенным UPDATE с повторной проверкой остатка. Сумма в locked считается по снимку запроса, а
+    конкурентное списание купленных могло закоммититься раньше: без условия в самом UPDATE остаток
+    после перепроверки строки (READ COMMITTED) ушёл бы в минус. Если купленных уже не хватает,
+    бесплатные тоже не списываются — запрос ничего не меняет и не возвращает строк.
+    amount > 0.
+    """
+    locked = (
+        select(
+            User.id,
+            func.least(User.free_limits_remaining, amount).label("ded_free"),
+        )
+        # Строки user_balances может не быть (лимиты только бесплатные) — outer join, купленных тогда 0.
+        # FOR UPDATE только по users: nullable-сторону outer join блокировать нельзя, а списания
+        # по пользователю и так сериализуются блокировкой его строки
+        .outerjoin(UserBalance, UserBalance.user_id == User.id)
+        .where(
+            User.id == user_id,
+            User.free_limits_remaining + func.coalesce(UserBalance.purchased_credits, 0) >= amount,
+        )
+        .with_for_update(of=User)
+        .cte("locked")
+    )
+    paid_part = amount - locked.c.ded_free
+    # Купленная часть списывается, только если она ненулевая: без лишней записи строки баланса
+    paid = (
+        update(UserBalance)
+        .where(
+            UserBalance.user_id == locked.c.id,
+            locked.c.ded_free < amount,
+            UserBalance.purchased_credits >= paid_part,
+        )
+        .values(purchased_credits=UserBalance.purchased_credits - paid_part)
+        .returning(UserBalance.user_id)
+        .cte("paid")
+    )
+    return (
+        update(User)
+        .where(
+            User.id == locked.c.id,
+            or_(locked.c.ded_free >= amount, exists(select(paid.c.user_id))),
+        )
+        .values(free_limits_remaining=User.free_limits_remaining - locked.c.ded_free)
+        .returning(locked.c.ded_free)
+        .add_cte(paid)
+    )
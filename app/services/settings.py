@@ -5,7 +5,9 @@
 from __future__ import annotations
 
 import time
-from dataclasses import dataclass
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from decimal import Decimal
 from typing import Any
 
 from sqlalchemy import select
@@ -14,14 +16,19 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import BotSettings, PaymentPackage
 
 # In-memory кэш: key -> (value, expires_at). TTL 120 сек.
-_SETTINGS_CACHE: dict[str, tuple[str, float]] = {}
-# Кэш списка пакетов: (список DTO, время истечения)
+# value=None — ключа в БД нет (переопределение не задано): кэшируется так же, иначе каждый /buy
+# и каждый новый пользователь ходили бы в БД за отсутствующей настройкой
+_SETTINGS_CACHE: dict[str, tuple[str | None, float]] = {}
+# Маркер «в кэше нет записи» (в отличие от закэшированного отсутствия ключа)
+_NOT_CACHED: Any = object()
+# Кэш списка пакетов: (список DTO, индекс code -> DTO, время истечения).
+# Список None — сброшен точечной инвалидацией: индекс по остальным кодам ещё действителен
 _PACKAGES_CACHE_KEY = "payment_packages_list"
-_PACKAGES_CACHE: dict[str, tuple[list[PaymentPackageData], float]] = {}
+_PACKAGES_CACHE: dict[str, tuple[list[PaymentPackageData] | None, dict[str, PaymentPackageData], float]] = {}
 _CACHE_TTL = 120.0
 
 
-@dataclass(frozen=True)
+@dataclass(slots=True, frozen=True)
 class PaymentPackageData:
     """Данные пакета для отображения и создания платежа."""
 
@@ -33,6 +40,11 @@ class PaymentPackageData:
     currency: str
     is_active: bool
     sort_order: int
+    # Цена как Decimal (сумма транзакции) — разбирается один раз при создании DTO, а не на каждой покупке
+    price_decimal: Decimal = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "price_decimal", Decimal(self.price))
 
 
 def _now() -> float:
@@ -40,17 +52,18 @@ def _now() -> float:
 
 
 def _get_cached(key: str) -> str | None:
+    """Значение из кэша, None для закэшированного отсутствия ключа, _NOT_CACHED — записи нет."""
     entry = _SETTINGS_CACHE.get(key)
     if entry is None:
-        return None
+        return _NOT_CACHED
     val, expires = entry
     if _now() > expires:
         del _SETTINGS_CACHE[key]
-        return None
+        return _NOT_CACHED
     return val
 
 
-def _set_cached(key: str, value: str) -> None:
+def _set_cached(key: str, value: str | None) -> None:
     _SETTINGS_CACHE[key] = (value, _now() + _CACHE_TTL)
 
 
@@ -58,37 +71,71 @@ def _invalidate_cached(key: str) -> None:
     _SETTINGS_CACHE.pop(key, None)
 
 
-def _get_cached_packages() -> list[PaymentPackageData] | None:
+def _get_packages_entry() -> tuple[list[PaymentPackageData] | None, dict[str, PaymentPackageData], float] | None:
     entry = _PACKAGES_CACHE.get(_PACKAGES_CACHE_KEY)
     if entry is None:
         return None
-    val, expires = entry
-    if _now() > expires:
+    if _now() > entry[2]:
         _PACKAGES_CACHE.pop(_PACKAGES_CACHE_KEY, None)
         return None
-    return val
+    return entry
+
+
+def _get_cached_packages() -> list[PaymentPackageData] | None:
+    entry = _get_packages_entry()
+    return entry[0] if entry is not None else None
 
 
 def _set_cached_packages(packages: list[PaymentPackageData]) -> None:
-    _PACKAGES_CACHE[_PACKAGES_CACHE_KEY] = (packages, _now() + _CACHE_TTL)
+    by_code = {p.code: p for p in packages}
+    _PACKAGES_CACHE[_PACKAGES_CACHE_KEY] = (packages, by_code, _now() + _CACHE_TTL)
 
 
-def invalidate_packages_cache() -> None:
-    """Сбрасывает кэш списка активных пакетов. Вызывать после любого CRUD по payment_packages."""
-    _PACKAGES_CACHE.pop(_PACKAGES_CACHE_KEY, None)
+def invalidate_packages_cache(code: str | None = None) -> None:
+    """Сбрасывает кэш пакетов. Вызывать после любого CRUD по payment_packages.
+    code=None — сброс целиком; с кодом — только этот пакет и сам список (состав/порядок могли измениться),
+    пакеты с другими кодами по-прежнему отдаются get_cached_package_by_code без обращения к БД."""
+    entry = _PACKAGES_CACHE.get(_PACKAGES_CACHE_KEY)
+    if code is None or entry is None:
+        _PACKAGES_CACHE.pop(_PACKAGES_CACHE_KEY, None)
+        return
+    by_code = entry[1]
+    by_code.pop(code, None)
+    _PACKAGES_CACHE[_PACKAGES_CACHE_KEY] = (None, by_code, entry[2])
 
 
 async def get_setting(session: AsyncSession, key: str) -> str | None:
     """Возвращает значение настройки из БД (с кэшем)."""
     cached = _get_cached(key)
-    if cached is not None:
+    if cached is not _NOT_CACHED:
         return cached
-    result = await session.execute(select(BotSettings).where(BotSettings.key == key))
-    row = result.scalar_one_or_none()
-    if row is None:
-        return None
-    _set_cached(key, row.value)
-    return row.value
+    value = await session.scalar(select(BotSettings.value).where(BotSettings.key == key))
+    _set_cached(key, value)
+    return value
+
+
+async def get_settings_bulk(session: AsyncSession, keys: Iterable[str]) -> dict[str, str]:
+    """Значения нескольких настроек: из кэша, недостающие — одним SELECT ... WHERE key IN (...).
+    Ключей, которых нет в БД, в результате нет."""
+    out: dict[str, str] = {}
+    missing: list[str] = []
+    for key in keys:
+        cached = _get_cached(key)
+        if cached is _NOT_CACHED:
+            missing.append(key)
+        elif cached is not None:
+            out[key] = cached
+    if missing:
+        result = await session.execute(
+            select(BotSettings.key, BotSettings.value).where(BotSettings.key.in_(missing))
+        )
+        found = dict(result.all())
+        for key in missing:
+            value = found.get(key)
+            _set_cached(key, value)
+            if value is not None:
+                out[key] = value
+    return out
 
 
 async def set_setting(session: AsyncSession, key: str, value: str) -> None:
@@ -207,8 +254,19 @@ async def get_active_packages(session: AsyncSession) -> list[PaymentPackageData]
     return packages
 
 
+def get_cached_package_by_code(code: str) -> PaymentPackageData | None:
+    """Активный пакет по коду из кэша списка пакетов, без обращения к БД; None — кэш пуст или кода в нём нет."""
+    entry = _get_packages_entry()
+    if entry is None:
+        return None
+    return entry[1].get(code)
+
+
 async def get_package_by_code(session: AsyncSession, code: str) -> PaymentPackageData | None:
-    """Пакет по коду (для создания платежа). Не кэшируется по коду — список уже кэшируется."""
+    """Пакет по коду (для создания платежа): сначала из кэша активных пакетов, иначе из БД."""
+    cached = get_cached_package_by_code(code)
+    if cached is not None:
+        return cached
     result = await session.execute(select(PaymentPackage).where(PaymentPackage.code == code))
     pkg = result.scalar_one_or_none()
     if pkg is None:
@@ -226,6 +284,6 @@ async def get_all_packages(session: AsyncSession) -> list[PaymentPackageData]:
 
 async def get_package_by_id(session: AsyncSession, package_id: int) -> PaymentPackageData | None:
     """Пакет по id для админки."""
-    result = await session.execute(select(PaymentPackage).where(PaymentPackage.id == package_id))
-    pkg = result.scalar_one_or_none()
+    # Поиск по первичному ключу: после правки в том же хэндлере объект берётся из identity map без SELECT
+    pkg = await session.get(PaymentPackage, package_id)
     return _package_to_data(pkg) if pkg else None
@@ -5,12 +5,16 @@ from __future__ import annotations
 
 from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 
 from app.models import UserUTM
 
 
 def _first_touch_subquery():
-    """Подзапрос: первая запись UTM по каждому user_id (по created_at, затем id)."""
+    """
+    Подзапрос: первая запись UTM по каждому user_id (по created_at, затем id).
+    Только колонки, которые есть в ix_user_utm_first_touch, — чтение без обращения к таблице.
+    """
     rn = func.row_number().over(
         partition_by=UserUTM.user_id,
         order_by=[UserUTM.created_at.asc(), UserUTM.id.asc()],
@@ -21,8 +25,6 @@ def _first_touch_subquery():
             UserUTM.utm_source,
             UserUTM.utm_medium,
             UserUTM.utm_campaign,
-            UserUTM.utm_term,
-            UserUTM.utm_content,
             rn,
         )
         .select_from(UserUTM)
@@ -30,13 +32,9 @@ def _first_touch_subquery():
     )
 
 
-async def get_first_touch_aggregates(session: AsyncSession) -> list[dict]:
-    """
-    Агрегация по первой UTM пользователя: группировка по source/medium/campaign,
-    количество пользователей по каждой комбинации.
-    """
+def _first_touch_aggregates_stmt():
     subq = _first_touch_subquery()
-    stmt = (
+    return (
         select(
             subq.c.utm_source,
             subq.c.utm_medium,
@@ -47,8 +45,9 @@ async def get_first_touch_aggregates(session: AsyncSession) -> list[dict]:
         .group_by(subq.c.utm_source, subq.c.utm_medium, subq.c.utm_campaign)
         .order_by(func.count(subq.c.user_id).desc())
     )
-    result = await session.execute(stmt)
-    rows = result.fetchall()
+
+
+def _aggregates_to_dicts(rows) -> list[dict]:
     return [
         {
             "utm_source": row.utm_source or "",
@@ -60,13 +59,39 @@ async def get_first_touch_aggregates(session: AsyncSession) -> list[dict]:
     ]
 
 
+def _users_with_utm_stmt():
+    subq = _first_touch_subquery()
+    return select(func.count(subq.c.user_id)).select_from(subq).where(subq.c.rn == 1)
+
+
+async def get_first_touch_aggregates(session: AsyncSession) -> list[dict]:
+    """
+    Агрегация по первой UTM пользователя: группировка по source/medium/campaign,
+    количество пользователей по каждой комбинации.
+    """
+    result = await session.execute(_first_touch_aggregates_stmt())
+    return _aggregates_to_dicts(result.fetchall())
+
+
 async def get_utm_totals(session: AsyncSession) -> dict:
     """Общие итоги: всего записей UTM и сколько пользователей имеют хотя бы одну UTM (first-touch)."""
     total_events = await session.scalar(select(func.count(UserUTM.id)))
-    subq = _first_touch_subquery()
-    total_users_with_utm = await session.scalar(
-        select(func.count(subq.c.user_id)).select_from(subq).where(subq.c.rn == 1)
-    )
+    total_users_with_utm = await session.scalar(_users_with_utm_stmt())
+    return {
+        "total_utm_events": total_events or 0,
+        "total_users_with_utm": total_users_with_utm or 0,
+    }
+
+
+def get_first_touch_aggregates_sync(session: Session) -> list[dict]:
+    """То же, что get_first_touch_aggregates, для sync-сессии (Celery)."""
+    return _aggregates_to_dicts(session.execute(_first_touch_aggregates_stmt()).fetchall())
+
+
+def get_utm_totals_sync(session: Session) -> dict:
+    """То же, что get_utm_totals, для sync-сессии (Celery)."""
+    total_events = session.scalar(select(func.count(UserUTM.id)))
+    total_users_with_utm = session.scalar(_users_with_utm_stmt())
     return {
         "total_utm_events": total_events or 0,
         "total_users_with_utm": total_users_with_utm or 0,
@@ -22,7 +22,8 @@ from aiohttp import web
 from aiogram import Bot
 from pydantic import ValidationError
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload, selectinload
 
 from app.db import async_session_factory
 from app.models import RefundProcessed, Transaction, User, UserBalance
@@ -149,6 +150,10 @@ def _extract_effective_client_ip(request: web.Request) -> str | None:
     return peer_ip
 
 
+# Шаг округления сумм (копейки) для сверки с API
+_KOPECK = Decimal("0.01")
+
+
 def _amount_matches(api_value: str | None, txn_amount: Decimal) -> bool:
     """Сравнивает сумму из API (строка) с суммой транзакции (Decimal). Без float, с нормализацией до 2 знаков."""
     if api_value is None:
@@ -158,12 +163,28 @@ def _amount_matches(api_value: str | None, txn_amount: Decimal) -> bool:
     if not api_value:
         return False
     try:
-        api_decimal = Decimal(api_value).quantize(Decimal("0.01"))
-        return api_decimal == txn_amount.quantize(Decimal("0.01"))
+        api_decimal = Decimal(api_value).quantize(_KOPECK)
+        return api_decimal == txn_amount.quantize(_KOPECK)
     except Exception:
         return False
 
 
+async def _resolve_credits(session: AsyncSession, txn: Transaction, payment_id: str) -> int:
+    """
+    Число страниц к начислению: по снимку пакета в транзакции (package_pages, в том числе 0).
+    Legacy: старые pending без snapshot — размер пакета из настроек. После 24–48 ч с деплоя
+    можно убрать fallback на get_pack_size и удалить legacy-настройки.
+    """
+    if txn.package_pages is not None:
+        return txn.package_pages
+    credits = await get_pack_size(session)
+    logger.warning(
+        "Legacy transaction without package snapshot, payment_id=%s txn_id=%s, using get_pack_size=%s",
+        payment_id, txn.id, credits,
+    )
+    return credits
+
+
 async def yookassa_webhook_handler(request: web.Request) -> web.Response:
     """
     POST /yookassa/webhook — тело JSON от ЮKassa.
@@ -368,10 +389,7 @@ async def yookassa_webhook_handler(request: web.Request) -> web.Response:
             )
             return web.Response(status=200, text="ok")
 
-        result_user = await session.execute(
-            select(User).where(User.id == user_id).options(selectinload(User.balance))
-        )
-        user = result_user.scalar_one_or_none()
+        user = await session.get(User, user_id, options=[selectinload(User.balance), raiseload("*")])
         if not user:
             _log_webhook_outcome(
                 WEBHOOK_OUTCOME_API_VERIFY_FAILED,
@@ -391,15 +409,7 @@ async def yookassa_webhook_handler(request: web.Request) -> web.Response:
             await session.flush()
             await session.refresh(user, attribute_names=["balance"])
 
-        # Начисление по снимку пакета в транзакции. Legacy: старые pending без snapshot.
-        # После 24–48 ч с деплоя можно убрать fallback на get_pack_size и удалить legacy-настройки.
-        credits = txn.package_pages if txn.package_pages is not None else None
-        if credits is None:
-            credits = await get_pack_size(session)
-            logger.warning(
-                "Legacy transaction without package snapshot, payment_id=%s txn_id=%s, using get_pack_size=%s",
-                payment_id, txn.id, credits,
-            )
+        credits = await _resolve_credits(session, txn, payment_id)
         user.balance.purchased_credits += credits
         await session.commit()
         _log_webhook_outcome(
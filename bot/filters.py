@@ -4,17 +4,19 @@
 from __future__ import annotations
 
 import os
-import re
+from functools import lru_cache
 from typing import Any, cast
 
 from aiogram.filters import BaseFilter
 from aiogram.types import Message, CallbackQuery
-from sqlalchemy import select
+from sqlalchemy import bindparam, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import app.db as db_module
 from app.models import User
-from config import get_settings
+from config import Settings, get_settings
+
+_IS_ADMIN_STMT = select(User.is_admin).where(User.tg_id == bindparam("tg_id"))
 
 # Кэш is_admin в Redis (опционально, задаётся из main.py)
 _admin_cache_redis: Any = None
@@ -37,20 +39,29 @@ async def invalidate_admin_cache(tg_id: int) -> None:
         pass
 
 
+@lru_cache(maxsize=1)
+def _superadmin_ids() -> frozenset[int]:
+    """
+    Список суперадминов разбирается при первой проверке и один раз за процесс;
+    проверка прав — поиск во frozenset.
+    """
+    ids = get_settings().ADMIN_TG_IDS
+    if not ids and os.environ.get("ADMIN_TG_IDS"):
+        # Тот же разбор, что у валидатора Settings
+        ids = Settings.parse_admin_ids(os.environ["ADMIN_TG_IDS"])
+    return frozenset(ids)
+
+
 def is_superadmin(tg_id: int) -> bool:
     """Проверяет, входит ли tg_id в список суперадминистраторов (из .env)."""
-    ids = list(get_settings().ADMIN_TG_IDS)
-    if not ids and os.environ.get("ADMIN_TG_IDS"):
-        raw = os.environ.get("ADMIN_TG_IDS", "").strip()
-        ids = [int(x.strip()) for x in re.split(r"[,;\s]+", raw) if x.strip()]
-    return tg_id in ids
+    return tg_id in _superadmin_ids()
 
 
 def is_admin(tg_id: int, user: User | None = None) -> bool:
     """Проверяет, является ли пользователь администратором (суперадмин или флаг в БД)."""
     if is_superadmin(tg_id):
         return True
-    if user and getattr(user, "is_admin", False):
+    if user and user.is_admin:
         return True
     return False
 
@@ -78,7 +89,7 @@ class IsAdminFilter(BaseFilter):
         session = kwargs.get("session")
         if session is not None:
             session = cast(AsyncSession, session)
-            res = await session.execute(select(User.is_admin).where(User.tg_id == user_tg.id))
+            res = await session.execute(_IS_ADMIN_STMT, {"tg_id": user_tg.id})
             is_admin_flag = res.scalar_one_or_none()
             result = bool(is_admin_flag)
         else:
@@ -86,7 +97,7 @@ class IsAdminFilter(BaseFilter):
             if factory is None:
                 return False
             async with factory() as one_off:
-                res = await one_off.execute(select(User.is_admin).where(User.tg_id == user_tg.id))
+                res = await one_off.execute(_IS_ADMIN_STMT, {"tg_id": user_tg.id})
                 is_admin_flag = res.scalar_one_or_none()
                 result = bool(is_admin_flag)
         if cache is not None:
@@ -3,6 +3,9 @@ Inline-клавиатуры админ-панели.
 """
 from __future__ import annotations
 
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 # Префиксы callback_data (короткие для лимита Telegram 64 байт)
@@ -18,16 +21,17 @@ ADMIN_STATS_UTM = "adm:utm"
 ADMIN_EXPORT_UTM = "adm:ex:utm"
 ADMIN_BACK = "adm:back"
 ADMIN_CANCEL = "adm:cancel"
-# Пользователь: лимиты и бан (user_id в данных)
-ADMIN_USER_FREE_ADD = "adm:u:free+"
-ADMIN_USER_FREE_SUB = "adm:u:free-"
-ADMIN_USER_PAID_ADD = "adm:u:paid+"
-ADMIN_USER_PAID_SUB = "adm:u:paid-"
-ADMIN_USER_BAN = "adm:u:ban"
-ADMIN_USER_UNBAN = "adm:u:unban"
-ADMIN_USER_PROMOTE = "adm:u:prom"
-ADMIN_USER_DEMOTE = "adm:u:dem"
-ADMIN_USER_PREFIX = "adm:u:"
+# Пользователь: действия над профилем (action в AdminUserCB)
+ADMIN_USER_FREE_ADD = "free_add"
+ADMIN_USER_FREE_SUB = "free_sub"
+ADMIN_USER_PAID_ADD = "paid_add"
+ADMIN_USER_PAID_SUB = "paid_sub"
+ADMIN_USER_BAN = "ban"
+ADMIN_USER_UNBAN = "unban"
+ADMIN_USER_PROMOTE = "promote"
+ADMIN_USER_DEMOTE = "demote"
+# Префикс кнопок профиля до перехода на AdminUserCB: в уже отправленных карточках ещё встречается
+ADMIN_USER_LEGACY_PREFIX = "adm:u:"
 ADMIN_SETTING_EDIT_PREFIX = "adm:set:"
 ADMIN_BROADCAST_CONFIRM = "adm:bc:yes"
 ADMIN_BROADCAST_ABORT = "adm:bc:no"
@@ -38,6 +42,13 @@ ADMIN_PACKAGE_PREFIX = "adm:pkg:"   # adm:pkg:ID — открыть пакет I
 ADMIN_PACKAGE_EDIT_PREFIX = "adm:pkg:e:"  # adm:pkg:e:ID:field (name,pages,price,order,toggle)
 
 
+class AdminUserCB(CallbackData, prefix="au"):
+    """Кнопки профиля пользователя: au:<action>:<user_id>."""
+
+    action: str
+    user_id: int
+
+
 def admin_broadcast_confirm_keyboard() -> InlineKeyboardMarkup:
     """Кнопки подтверждения рассылки."""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -90,30 +101,38 @@ def admin_cancel_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
-def admin_user_profile_keyboard(
-    user_id: int, is_banned: bool, is_target_admin: bool = False, is_viewer_superadmin: bool = False
-) -> InlineKeyboardMarkup:
-    """Клавиатура профиля пользователя: лимиты, бан, назначение администратором."""
+@lru_cache(maxsize=8)
+def _profile_keyboard_template(
+    is_banned: bool, is_target_admin: bool, is_viewer_superadmin: bool
+) -> tuple[tuple[tuple[str, str], ...], ...]:
+    """Строки кнопок профиля (text, префикс callback_data без user_id) — по одному набору на комбинацию флагов."""
+    def _prefix(action: str) -> str:
+        sep = AdminUserCB.__separator__
+        return f"{AdminUserCB.__prefix__}{sep}{action}{sep}"
+
     ban_key = ADMIN_USER_UNBAN if is_banned else ADMIN_USER_BAN
     ban_text = "✅ Разблокировать" if is_banned else "🚫 Заблокировать"
-    
     rows = [
-        [
-            InlineKeyboardButton(text="➕ Беспл.", callback_data=f"{ADMIN_USER_FREE_ADD}{user_id}"),
-            InlineKeyboardButton(text="➖ Беспл.", callback_data=f"{ADMIN_USER_FREE_SUB}{user_id}"),
-        ],
-        [
-            InlineKeyboardButton(text="➕ Платн.", callback_data=f"{ADMIN_USER_PAID_ADD}{user_id}"),
-            InlineKeyboardButton(text="➖ Платн.", callback_data=f"{ADMIN_USER_PAID_SUB}{user_id}"),
-        ],
-        [InlineKeyboardButton(text=ban_text, callback_data=f"{ban_key}{user_id}")],
+        (("➕ Беспл.", _prefix(ADMIN_USER_FREE_ADD)), ("➖ Беспл.", _prefix(ADMIN_USER_FREE_SUB))),
+        (("➕ Платн.", _prefix(ADMIN_USER_PAID_ADD)), ("➖ Платн.", _prefix(ADMIN_USER_PAID_SUB))),
+        ((ban_text, _prefix(ban_key)),),
     ]
-    
     if is_viewer_superadmin:
         admin_text = "⬇️ Убрать из админов" if is_target_admin else "⬆️ Сделать админом"
         admin_action = ADMIN_USER_DEMOTE if is_target_admin else ADMIN_USER_PROMOTE
-        rows.append([InlineKeyboardButton(text=admin_text, callback_data=f"{admin_action}{user_id}")])
-        
+        rows.append(((admin_text, _prefix(admin_action)),))
+    return tuple(rows)
+
+
+def admin_user_profile_keyboard(
+    user_id: int, is_banned: bool, is_target_admin: bool = False, is_viewer_superadmin: bool = False
+) -> InlineKeyboardMarkup:
+    """Клавиатура профиля пользователя: лимиты, бан, назначение администратором."""
+    template = _profile_keyboard_template(bool(is_banned), bool(is_target_admin), bool(is_viewer_superadmin))
+    rows = [
+        [InlineKeyboardButton(text=text, callback_data=f"{prefix}{user_id}") for text, prefix in row]
+        for row in template
+    ]
     rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data=ADMIN_USERS)])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -3,22 +3,36 @@
 """
 from __future__ import annotations
 
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from app.services.settings import PaymentPackageData
 
 PAY_PACKAGE_PREFIX = "pay:pkg:"
+# Лимит callback_data в Telegram — 64 байта; код пакета только ASCII, так что байты = символы
+MAX_PACKAGE_CODE_LEN = 64 - len(PAY_PACKAGE_PREFIX)
+# Символ валюты пакета для подписей; неизвестная валюта выводится кодом
+CURRENCY_SYMBOLS: dict[str, str] = {"RUB": "₽", "USD": "$", "EUR": "€", "KZT": "₸"}
+
+
+@lru_cache(maxsize=64)
+def _pay_cb(code: str) -> str:
+    """callback_data кнопки пакета: pay:pkg:{code}; набор кодов мал — строка собирается один раз на код."""
+    return PAY_PACKAGE_PREFIX + code
 
 
+@lru_cache(maxsize=64)
 def format_package_button_label(pkg: PaymentPackageData) -> str:
-    """Текст кнопки: «Демо — 50 стр — 225 ₽»."""
-    return f"{pkg.name} — {pkg.pages} стр — {pkg.price} ₽"
+    """Текст кнопки: «Демо — 50 стр — 225 ₽». DTO неизменяемый и хэшируется по значению полей:
+    после правки пакета это другой ключ кэша, сброс не нужен."""
+    return f"{pkg.name} — {pkg.pages} стр — {pkg.price} {CURRENCY_SYMBOLS.get(pkg.currency, pkg.currency)}"
 
 
 def packages_keyboard(packages: list[PaymentPackageData]) -> InlineKeyboardMarkup:
     """Клавиатура выбора пакета. callback_data = pay:pkg:{code}."""
     rows = [
-        [InlineKeyboardButton(text=format_package_button_label(p), callback_data=f"{PAY_PACKAGE_PREFIX}{p.code}")]
+        [InlineKeyboardButton(text=format_package_button_label(p), callback_data=_pay_cb(p.code))]
         for p in packages
     ]
     return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -20,6 +20,7 @@ if _load_env.exists():
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 
 from app.db import init_db
 from bot.middlewares import DbSessionMiddleware, LimitsMiddleware, PolicyMiddleware
@@ -43,6 +44,15 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def _json_codec() -> dict:
+    """orjson для разбора апдейтов (webhook/getUpdates) и ответов Bot API, если установлен."""
+    try:
+        import orjson
+    except ImportError:
+        return {}  # стандартный json
+    return {"json_loads": orjson.loads, "json_dumps": lambda obj: orjson.dumps(obj).decode()}
+
+
 async def main() -> None:
     settings = get_settings()
 
@@ -68,6 +78,7 @@ async def main() -> None:
 
     bot = Bot(
         token=settings.BOT_TOKEN,
+        session=AiohttpSession(**_json_codec()),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
     dp = Dispatcher()
@@ -126,4 +137,9 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass  # Windows / без uvloop — стандартный цикл asyncio
     asyncio.run(main())
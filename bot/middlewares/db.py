@@ -38,7 +38,10 @@ class DbSessionMiddleware(BaseMiddleware):
             data["session"] = session
             try:
                 result = await handler(event, data)
-                await session.commit()
+                # Одна транзакция на апдейт; если хэндлер уже закоммитил сам (перед очередью Celery,
+                # ЮKassa или ответом в Telegram) и больше в БД не писал — коммитить нечего
+                if session.in_transaction():
+                    await session.commit()
                 return result
             except Exception:
                 await session.rollback()
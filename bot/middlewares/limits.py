@@ -8,13 +8,19 @@ from typing import Any, Awaitable, Callable, Dict
 
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import bindparam, func, select
 
-from app.models import User
+from app.models import User, UserBalance
 
 logger = logging.getLogger(__name__)
 
+# Сумма бесплатных и купленных лимитов одним запросом; None — пользователя нет
+_TOTAL_LIMITS_STMT = (
+    select(User.free_limits_remaining + func.coalesce(UserBalance.purchased_credits, 0))
+    .outerjoin(UserBalance, UserBalance.user_id == User.id)
+    .where(User.tg_id == bindparam("tg_id"))
+)
+
 
 def _is_document_event(event: TelegramObject) -> bool:
     """Проверяет, что апдейт — это отправка документа/фото (нужен лимит)."""
@@ -49,19 +55,10 @@ class LimitsMiddleware(BaseMiddleware):
         if not user_id:
             return await handler(event, data)
 
-        result = await session.execute(
-            select(User)
-            .where(User.tg_id == user_id)
-            .options(selectinload(User.balance))
-        )
-        user = result.scalar_one_or_none()
-        if not user:
+        total = await session.scalar(_TOTAL_LIMITS_STMT, {"tg_id": user_id})
+        if total is None:
             return await handler(event, data)
 
-        total = user.free_limits_remaining
-        if user.balance:
-            total += user.balance.purchased_credits
-
         if total <= 0:
             await event.answer(
                 "Лимит обработки исчерпан. Используйте /buy — выберите тариф и пополните баланс страниц."
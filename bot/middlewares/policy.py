@@ -3,12 +3,13 @@ Middleware 152-ФЗ: блокирует действия пользовател
 """
 from __future__ import annotations
 
+import functools
 import logging
 from typing import Any, Awaitable, Callable, Dict
 
 from aiogram import BaseMiddleware
 from aiogram.types import CallbackQuery, Message, TelegramObject
-from sqlalchemy import select
+from sqlalchemy import Row, bindparam, select
 
 from app.models import User
 from bot.filters import is_admin
@@ -18,15 +19,23 @@ logger = logging.getLogger(__name__)
 
 POLICY_CALLBACK = "policy_accepted"
 
+_POLICY_FLAGS_STMT = select(User.is_banned, User.is_admin, User.is_agreed_to_policy).where(
+    User.tg_id == bindparam("tg_id")
+)
+
 # Fallback-ссылки, если в конфиге не заданы (ваши документы на Telegraph)
 _DEFAULT_PRIVACY_URL = "https://telegra.ph/Politika-konfidencialnosti-02-23-23"
 _DEFAULT_OFFER_URL = "https://telegra.ph/Polzovatelskoe-soglashenie-02-23-17"
 _DEFAULT_CONSENT_URL = "https://telegra.ph/SOGLASIE-NA-OBRABOTKU-PERSONALNYH-DANNYH-02-23-7"
 
 
+@functools.cache
 def get_policy_text(prefix: str | None = None) -> str:
     """Возвращает текст политики с ссылками из конфига или fallback на telegra.ph.
 
+    Ссылки берутся из .env и в работе бота не меняются, поэтому текст (экранирование ссылок
+    и сборка строки) собирается один раз на каждый prefix.
+
     Args:
         prefix: при наличии добавляется в начало текста (например, для случая «файл без согласия»).
     """
@@ -82,7 +91,7 @@ class PolicyMiddleware(BaseMiddleware):
             return
 
         tg_id = event.from_user.id if event.from_user else 0
-        if getattr(user, "is_banned", False) and not is_admin(tg_id, user):
+        if user.is_banned and not is_admin(tg_id, user):
             if isinstance(event, Message):
                 await event.answer("Вы заблокированы. Обратитесь к администратору.")
             elif isinstance(event, CallbackQuery):
@@ -117,8 +126,8 @@ class PolicyMiddleware(BaseMiddleware):
             await event.answer()
         return
 
-    async def _get_user(self, event: TelegramObject, session) -> User | None:
-        """Извлекает user_id из апдейта и загружает User из БД."""
+    async def _get_user(self, event: TelegramObject, session) -> Row | None:
+        """Извлекает user_id из апдейта и читает из БД только флаги бана, админа и согласия."""
         user_id = None
         if isinstance(event, Message) and event.from_user:
             user_id = event.from_user.id
@@ -126,8 +135,9 @@ class PolicyMiddleware(BaseMiddleware):
             user_id = event.from_user.id
         if user_id is None:
             return None
-        result = await session.execute(select(User).where(User.tg_id == user_id))
-        return result.scalar_one_or_none()
+        # Колонки вместо ORM-объекта: middleware проходит каждый апдейт, а нужны ей три флага
+        result = await session.execute(_POLICY_FLAGS_STMT, {"tg_id": user_id})
+        return result.one_or_none()
 
     async def _is_allowed_event(self, event: TelegramObject) -> bool:
         """Разрешены: команда /start, /terms и callback policy_accepted."""
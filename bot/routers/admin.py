@@ -4,22 +4,27 @@
 """
 from __future__ import annotations
 
+import asyncio
 import logging
-from html import escape as html_escape
+import re
+import time
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
 
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BufferedInputFile, CallbackQuery, Message
-from sqlalchemy import func, select
-from sqlalchemy.orm import selectinload
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, Message
+from sqlalchemy import bindparam, func, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from app.models import Document, PaymentPackage, Transaction, User, UserBalance
-from app.services.export import build_summary_xlsx, build_transactions_xlsx, build_users_xlsx, build_utm_xlsx
+import app.db as db_module
+from app.models import PaymentPackage, User, UserBalance
+from app.models.stats import STATS_DOCS, STATS_PAID, STATS_USERS, stats_totals_stmt
 from app.services.settings import (
     get_all_packages,
     get_package_by_id,
-    get_setting,
+    get_settings_bulk,
     invalidate_packages_cache,
     set_setting,
 )
@@ -49,6 +54,7 @@ from bot.keyboards.admin import (
     ADMIN_USER_BAN,
     ADMIN_USER_PROMOTE,
     ADMIN_USER_DEMOTE,
+    ADMIN_USER_LEGACY_PREFIX,
     ADMIN_USER_FREE_ADD,
     ADMIN_USER_FREE_SUB,
     ADMIN_USER_PAID_ADD,
@@ -64,19 +70,86 @@ from bot.keyboards.admin import (
     admin_stats_menu,
     admin_utm_menu,
     admin_user_profile_keyboard,
+    AdminUserCB,
 )
+from bot.keyboards.payments import MAX_PACKAGE_CODE_LEN
 from bot.states.admin import AdminStates
 
 logger = logging.getLogger(__name__)
 
+# Задачи Celery импортируются один раз; если celery_app не загрузился (нет брокера/конфига),
+# обработчики отвечают «не удалось запустить», как и при ошибке постановки в очередь
+try:
+    from celery_app import broadcast_task, export_xlsx_task
+except Exception as e:
+    logger.warning("celery_app import failed, broadcast/export disabled: %s", e)
+    broadcast_task = export_xlsx_task = None
+
 router = Router(name="admin")
 
+# Статические клавиатуры (без данных пользователя) собираются один раз при импорте
+_CANCEL_KB = admin_cancel_keyboard()
+_BACK_KB = admin_back_to_main()
+_MAIN_MENU_KB = admin_main_menu()
+_STATS_MENU_KB = admin_stats_menu()
+_UTM_MENU_KB = admin_utm_menu()
+_BROADCAST_CONFIRM_KB = admin_broadcast_confirm_keyboard()
+
+
+# Экранирование HTML одним проходом str.translate (те же замены, что html.escape с quote=True)
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+# Обычные имена без спецсимволов возвращаются как есть — без построения новой строки
+_HTML_UNSAFE_SEARCH = re.compile(r"[&<>\"']").search
+
+
+def _esc(s: str) -> str:
+    return s if _HTML_UNSAFE_SEARCH(s) is None else s.translate(_HTML_TRANS)
+
+
+_ADMIN_DENIED_TEXT = (
+    "У вас нет доступа к этому разделу. "
+    "Если вы должны иметь доступ, обратитесь к администратору."
+)
+
+
+# Шаблоны сводки: (пользователей, документов, сумма оплат)
+_SUMMARY_TMPL = (
+    "📊 Краткая сводка:\n"
+    "Пользователей: %d\n"
+    "Обработано документов: %d\n"
+    "Оплачено (сумма): %s ₽\n\n"
+    "Выберите раздел:"
+)
+_STATS_TMPL = (
+    "📊 Статистика\n\n"
+    "Пользователей: %d\n"
+    "Обработано документов: %d\n"
+    "Оплачено (сумма): %s ₽\n\n"
+    "Выгрузка в Excel:"
+)
 
-def _admin_denied_message() -> str:
-    return (
-        "У вас нет доступа к этому разделу. "
-        "Если вы должны иметь доступ, обратитесь к администратору."
-    )
+
+# Пользователи, документы и сумма оплат — готовые счётчики (ведутся триггерами БД, сумма шардов), без COUNT/SUM по таблицам
+_STATS_KEYS = (STATS_USERS, STATS_DOCS, STATS_PAID)
+_ADMIN_STATS_STMT = stats_totals_stmt(_STATS_KEYS)
+
+# Кэш сводки: (users, docs, paid), expires_at. Админ кликает по меню — счётчики читаются не чаще раза в TTL
+_STATS_CACHE: tuple[tuple, float] | None = None
+_STATS_CACHE_TTL = 30.0
+
+
+async def _fetch_admin_stats(session) -> tuple:
+    """(users, docs, paid) для сводки /admin и раздела «Статистика»."""
+    global _STATS_CACHE
+    now = time.monotonic()
+    if _STATS_CACHE is not None and _STATS_CACHE[1] > now:
+        return _STATS_CACHE[0]
+    values = dict((await session.execute(_ADMIN_STATS_STMT)).all())
+    stats = tuple(values.get(key, 0) for key in _STATS_KEYS)
+    _STATS_CACHE = (stats, now + _STATS_CACHE_TTL)
+    return stats
 
 
 # —— Точка входа: кнопка «Админ-панель» и команда /admin ——
@@ -84,39 +157,28 @@ def _admin_denied_message() -> str:
 @router.message(F.text == "🛠 Админ-панель", IsAdminFilter())
 async def admin_open_panel(message: Message) -> None:
     """Открывает главное меню админки по кнопке."""
-    await message.answer("Админ-панель. Выберите раздел:", reply_markup=admin_main_menu())
+    await message.answer("Админ-панель. Выберите раздел:", reply_markup=_MAIN_MENU_KB)
 
 
 @router.message(Command("admin"), IsAdminFilter())
 async def cmd_admin(message: Message, session) -> None:
     """Команда /admin — то же, что кнопка: главное меню админки + краткая статистика."""
-    total_users = await session.scalar(select(func.count(User.id)))
-    total_docs = await session.scalar(select(func.count(Document.id)))
-    total_paid = await session.scalar(
-        select(func.coalesce(func.sum(Transaction.amount), 0)).where(Transaction.status == "succeeded")
-    ) or 0
-    text = (
-        "📊 Краткая сводка:\n"
-        f"Пользователей: {total_users}\n"
-        f"Обработано документов: {total_docs}\n"
-        f"Оплачено (сумма): {total_paid} ₽\n\n"
-        "Выберите раздел:"
-    )
-    await message.answer(text, reply_markup=admin_main_menu())
+    text = _SUMMARY_TMPL % await _fetch_admin_stats(session)
+    await message.answer(text, reply_markup=_MAIN_MENU_KB)
 
 
 @router.message(F.text == "🛠 Админ-панель")
 async def admin_denied_button(message: Message) -> None:
     """Не админ нажал кнопку «Админ-панель» — показать отказ."""
     if message.from_user:
-        await message.answer(_admin_denied_message())
+        await message.answer(_ADMIN_DENIED_TEXT)
 
 
 @router.message(Command("admin"))
 async def admin_denied_command(message: Message) -> None:
     """Не админ ввёл /admin — показать отказ (хэндлер без IsAdminFilter срабатывает после провала фильтра)."""
     if message.from_user:
-        await message.answer(_admin_denied_message())
+        await message.answer(_ADMIN_DENIED_TEXT)
 
 
 @router.message(Command("my_id"))
@@ -136,7 +198,7 @@ async def admin_cb_main(callback: CallbackQuery, state: FSMContext) -> None:
     """Возврат в главное меню админки."""
     await state.clear()
     if isinstance(callback.message, Message):
-        await callback.message.edit_text("Админ-панель. Выберите раздел:", reply_markup=admin_main_menu())
+        await callback.message.edit_text("Админ-панель. Выберите раздел:", reply_markup=_MAIN_MENU_KB)
     await callback.answer()
 
 
@@ -151,7 +213,7 @@ async def admin_cb_cancel(callback: CallbackQuery, state: FSMContext) -> None:
     """Отмена — сброс FSM и возврат в главное меню."""
     await state.clear()
     if isinstance(callback.message, Message):
-        await callback.message.edit_text("Отменено. Выберите раздел:", reply_markup=admin_main_menu())
+        await callback.message.edit_text("Отменено. Выберите раздел:", reply_markup=_MAIN_MENU_KB)
     await callback.answer()
 
 
@@ -160,79 +222,51 @@ async def admin_cb_cancel(callback: CallbackQuery, state: FSMContext) -> None:
 @router.callback_query(F.data == ADMIN_STATS, IsAdminFilter())
 async def admin_cb_stats(callback: CallbackQuery, session) -> None:
     """Раздел «Статистика»: цифры + кнопки выгрузки и Назад."""
-    total_users = await session.scalar(select(func.count(User.id)))
-    total_docs = await session.scalar(select(func.count(Document.id)))
-    total_paid = await session.scalar(
-        select(func.coalesce(func.sum(Transaction.amount), 0)).where(Transaction.status == "succeeded")
-    ) or 0
-    text = (
-        "📊 Статистика\n\n"
-        f"Пользователей: {total_users}\n"
-        f"Обработано документов: {total_docs}\n"
-        f"Оплачено (сумма): {total_paid} ₽\n\n"
-        "Выгрузка в Excel:"
-    )
+    text = _STATS_TMPL % await _fetch_admin_stats(session)
     if isinstance(callback.message, Message):
-        await callback.message.edit_text(text, reply_markup=admin_stats_menu())
+        await callback.message.edit_text(text, reply_markup=_STATS_MENU_KB)
     await callback.answer()
 
 
-@router.callback_query(F.data == ADMIN_EXPORT_USERS, IsAdminFilter())
-async def admin_export_users(callback: CallbackQuery, session) -> None:
-    """Выгрузка списка пользователей в Excel."""
-    await callback.answer("Подготовка выгрузки…")
-    try:
-        file_bytes = await build_users_xlsx(session)
-        if isinstance(callback.message, Message):
-            await callback.message.answer_document(
-                BufferedInputFile(file_bytes, filename="users.xlsx"),
-                caption="Выгрузка пользователей",
-            )
-    except Exception as e:
-        logger.exception("export users failed: %s", e)
-        if isinstance(callback.message, Message):
-            await callback.message.answer("Не удалось сформировать выгрузку. Попробуйте позже.")
+# Выгрузки Excel: callback_data → вид выгрузки для export_xlsx_task
+_EXPORT_KINDS = {
+    ADMIN_EXPORT_USERS: "users",
+    ADMIN_EXPORT_TXN: "transactions",
+    ADMIN_EXPORT_SUMMARY: "summary",
+    ADMIN_EXPORT_UTM: "utm",
+}
 
 
-@router.callback_query(F.data == ADMIN_EXPORT_TXN, IsAdminFilter())
-async def admin_export_transactions(callback: CallbackQuery, session) -> None:
-    """Выгрузка транзакций в Excel."""
-    await callback.answer("Подготовка выгрузки…")
-    try:
-        file_bytes = await build_transactions_xlsx(session)
-        if isinstance(callback.message, Message):
-            await callback.message.answer_document(
-                BufferedInputFile(file_bytes, filename="transactions.xlsx"),
-                caption="Выгрузка транзакций",
-            )
-    except Exception as e:
-        logger.exception("export transactions failed: %s", e)
-        if isinstance(callback.message, Message):
-            await callback.message.answer("Не удалось сформировать выгрузку. Попробуйте позже.")
-
-
-@router.callback_query(F.data == ADMIN_EXPORT_SUMMARY, IsAdminFilter())
-async def admin_export_summary(callback: CallbackQuery, session) -> None:
-    """Выгрузка сводки в Excel."""
-    await callback.answer("Подготовка выгрузки…")
+@router.callback_query(F.data.in_(_EXPORT_KINDS), IsAdminFilter())
+async def admin_export(callback: CallbackQuery) -> None:
+    """Выгрузка в Excel: файл строит Celery-воркер и присылает в этот чат."""
+    if not isinstance(callback.message, Message):
+        await callback.answer("Не удалось выполнить действие.")
+        return
+    if export_xlsx_task is None:
+        await callback.answer("Не удалось запустить выгрузку. Попробуйте позже.", show_alert=True)
+        return
     try:
-        file_bytes = await build_summary_xlsx(session)
-        if isinstance(callback.message, Message):
-            await callback.message.answer_document(
-                BufferedInputFile(file_bytes, filename="summary.xlsx"),
-                caption="Сводка",
-            )
+        # Публикация в брокер — блокирующий сокет; уводим её из event loop бота
+        await asyncio.to_thread(export_xlsx_task.delay, _EXPORT_KINDS[callback.data], callback.message.chat.id)
     except Exception as e:
-        logger.exception("export summary failed: %s", e)
-        if isinstance(callback.message, Message):
-            await callback.message.answer("Не удалось сформировать выгрузку. Попробуйте позже.")
+        logger.exception("export_xlsx_task.delay failed: %s", e)
+        await callback.answer("Не удалось запустить выгрузку. Попробуйте позже.", show_alert=True)
+        return
+    await callback.answer("Готовим выгрузку — файл придёт в этот чат.")
 
 
 @router.callback_query(F.data == ADMIN_STATS_UTM, IsAdminFilter())
 async def admin_cb_stats_utm(callback: CallbackQuery, session) -> None:
     """Раздел UTM: first-touch сводка и кнопка выгрузки."""
-    totals = await get_utm_totals(session)
-    aggregates = await get_first_touch_aggregates(session)
+    if db_module.async_session_factory is None:
+        totals = await get_utm_totals(session)
+        aggregates = await get_first_touch_aggregates(session)
+    else:
+        # Запросы независимы: каждый в своей сессии (AsyncSession не допускает параллельных запросов)
+        totals, aggregates = await asyncio.gather(
+            db_module.run_in_own_session(get_utm_totals), db_module.run_in_own_session(get_first_touch_aggregates)
+        )
     lines = [
         "📈 UTM (first-touch)\n",
         f"Всего переходов с метками: {totals['total_utm_events']}",
@@ -249,27 +283,10 @@ async def admin_cb_stats_utm(callback: CallbackQuery, session) -> None:
         lines.append("Нет данных.")
     text = "\n".join(lines)
     if isinstance(callback.message, Message):
-        await callback.message.edit_text(text, reply_markup=admin_utm_menu())
+        await callback.message.edit_text(text, reply_markup=_UTM_MENU_KB)
     await callback.answer()
 
 
-@router.callback_query(F.data == ADMIN_EXPORT_UTM, IsAdminFilter())
-async def admin_export_utm(callback: CallbackQuery, session) -> None:
-    """Выгрузка UTM в Excel."""
-    await callback.answer("Подготовка выгрузки…")
-    try:
-        file_bytes = await build_utm_xlsx(session)
-        if isinstance(callback.message, Message):
-            await callback.message.answer_document(
-                BufferedInputFile(file_bytes, filename="utm.xlsx"),
-                caption="Выгрузка UTM",
-            )
-    except Exception as e:
-        logger.exception("export utm failed: %s", e)
-        if isinstance(callback.message, Message):
-            await callback.message.answer("Не удалось сформировать выгрузку. Попробуйте позже.")
-
-
 # —— Заглушки для остальных разделов (реализуем далее) ——
 
 @router.callback_query(F.data == ADMIN_USERS, IsAdminFilter())
@@ -280,7 +297,7 @@ async def admin_cb_users(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.message.edit_text(
             "👥 Поиск пользователя.\nОтправьте <b>Telegram ID</b> (число) или <b>@username</b>.\n"
             "Для отмены нажмите кнопку ниже.",
-            reply_markup=admin_cancel_keyboard(),
+            reply_markup=_CANCEL_KB,
         )
     await callback.answer()
 
@@ -293,7 +310,7 @@ async def admin_cb_broadcast(callback: CallbackQuery, state: FSMContext) -> None
         await callback.message.edit_text(
             "📢 Рассылка.\nОтправьте одно сообщение (текст, фото или видео) для рассылки всем пользователям.\n"
             "Для отмены нажмите кнопку ниже.",
-            reply_markup=admin_cancel_keyboard(),
+            reply_markup=_CANCEL_KB,
         )
     await callback.answer()
 
@@ -317,14 +334,14 @@ async def admin_broadcast_message(message: Message, state: FSMContext) -> None:
         broadcast_photo_file_id=photo_file_id,
         broadcast_video_file_id=video_file_id,
     )
-    kbd = admin_broadcast_confirm_keyboard()
-    safe_caption = html_escape(text or "(без подписи)")
+    kbd = _BROADCAST_CONFIRM_KB
+    safe_caption = _esc(text or "(без подписи)")
     if photo_file_id:
         await message.answer_photo(photo=photo_file_id, caption=f"Превью (рассылка):\n{safe_caption}", reply_markup=kbd)
     elif video_file_id:
         await message.answer_video(video=video_file_id, caption=f"Превью (рассылка):\n{safe_caption}", reply_markup=kbd)
     else:
-        await message.answer(f"Превью (рассылка):\n\n{html_escape(text or '(пусто)')}", reply_markup=kbd)
+        await message.answer(f"Превью (рассылка):\n\n{_esc(text or '(пусто)')}", reply_markup=kbd)
     await state.set_state(AdminStates.waiting_broadcast)  # keep state until confirm/cancel
 
 
@@ -337,8 +354,11 @@ async def admin_broadcast_confirm(callback: CallbackQuery, session, state: FSMCo
     video_file_id = data.get("broadcast_video_file_id")
     await state.clear()
     try:
-        from celery_app import broadcast_task
-        broadcast_task.delay(text=text, photo_file_id=photo_file_id, video_file_id=video_file_id)
+        if broadcast_task is None:
+            raise RuntimeError("celery_app is not available")
+        await asyncio.to_thread(
+            broadcast_task.delay, text=text, photo_file_id=photo_file_id, video_file_id=video_file_id
+        )
     except Exception as e:
         logger.exception("broadcast_task.delay failed: %s", e)
         if isinstance(callback.message, Message):
@@ -355,33 +375,35 @@ async def admin_broadcast_abort(callback: CallbackQuery, state: FSMContext) -> N
     """Отмена рассылки."""
     await state.clear()
     if isinstance(callback.message, Message):
-        await callback.message.edit_text("Рассылка отменена. Выберите раздел:", reply_markup=admin_main_menu())
+        await callback.message.edit_text("Рассылка отменена. Выберите раздел:", reply_markup=_MAIN_MENU_KB)
     await callback.answer()
 
 
 # Ключи настроек, редактируемых из админки: (key, human_label, type)
 # Примечание: LLM/OCR сейчас читаются из .env (config); здесь — опциональные переопределения в БД на будущее.
-SETTINGS_KEYS = [
+SETTINGS_KEYS: tuple[tuple[str, str, str], ...] = (
     ("FREE_LIMITS_PER_MONTH", "Бесплатных страниц в месяц", "int"),
     ("LLM_REQUEST_TIMEOUT", "Таймаут запроса LLM (сек)", "int"),
     ("PDF_MAX_PAGES", "Макс. страниц PDF за раз", "int"),
     ("BOT_ABOUT_TEXT", "О боте (About)", "str"),
     ("PAYMENT_TARIFFS_HEADER", "Текст блока тарифов", "str"),
-]
+)
+# (key, label) для клавиатуры настроек — от запроса к запросу меняются только значения
+_SETTINGS_KEYLABELS: tuple[tuple[str, str], ...] = tuple((k, label) for k, label, _ in SETTINGS_KEYS)
+_SETTINGS_KEYS_ONLY: tuple[str, ...] = tuple(k for k, _, _ in SETTINGS_KEYS)
+# key → type: проверка ключа из callback и выбор парсера значения без прохода по SETTINGS_KEYS
+_SETTING_KEY_TYPES: dict[str, str] = {k: t for k, _, t in SETTINGS_KEYS}
 
 
 @router.callback_query(F.data == ADMIN_SETTINGS, IsAdminFilter())
 async def admin_cb_settings(callback: CallbackQuery, session) -> None:
     """Раздел «Настройки»: список настроек с текущими значениями."""
     cfg = get_cfg()
+    values_db = await get_settings_bulk(session, _SETTINGS_KEYS_ONLY)
     keys_with_values: list[tuple[str, str, str]] = []
-    for key, label, _ in SETTINGS_KEYS:
-        val_db = await get_setting(session, key)
-        if val_db is not None:
-            val = val_db
-        else:
-            val = str(getattr(cfg, key, ""))
-        keys_with_values.append((key, label, val))
+    for key, label in _SETTINGS_KEYLABELS:
+        val_db = values_db.get(key)
+        keys_with_values.append((key, label, val_db if val_db is not None else str(getattr(cfg, key, ""))))
     text = "⚙️ Настройки. Нажмите параметр для изменения:"
     if isinstance(callback.message, Message):
         await callback.message.edit_text(text, reply_markup=admin_settings_keyboard(keys_with_values))
@@ -392,15 +414,15 @@ async def admin_cb_settings(callback: CallbackQuery, session) -> None:
 async def admin_cb_setting_edit(callback: CallbackQuery, state: FSMContext) -> None:
     """Редактирование настройки: запрос нового значения."""
     key = (callback.data or "")[len(ADMIN_SETTING_EDIT_PREFIX):].strip()
-    if not key or not any(k == key for k, _, _ in SETTINGS_KEYS):
+    if key not in _SETTING_KEY_TYPES:
         await callback.answer("Такого параметра нет. Выберите из списка.")
         return
     await state.set_state(AdminStates.waiting_setting_value)
     await state.update_data(admin_setting_key=key)
     if isinstance(callback.message, Message):
         await callback.message.edit_text(
-            f"Введите новое значение для <b>{html_escape(key)}</b>. Для отмены нажмите кнопку.",
-            reply_markup=admin_cancel_keyboard(),
+            f"Введите новое значение для <b>{_esc(key)}</b>. Для отмены нажмите кнопку.",
+            reply_markup=_CANCEL_KB,
         )
     await callback.answer()
 
@@ -412,9 +434,9 @@ async def admin_setting_value_message(message: Message, session, state: FSMConte
     key = data.get("admin_setting_key")
     if not key:
         await state.clear()
-        await message.answer("Время действия истекло. Выберите действие заново.", reply_markup=admin_back_to_main())
+        await message.answer("Время действия истекло. Выберите действие заново.", reply_markup=_BACK_KB)
         return
-    typ = next((t for k, _, t in SETTINGS_KEYS if k == key), "str")
+    typ = _SETTING_KEY_TYPES.get(key, "str")
     raw = (message.text or "").strip()
     try:
         if typ == "int":
@@ -427,14 +449,19 @@ async def admin_setting_value_message(message: Message, session, state: FSMConte
         await message.answer("Неверный формат. Введите число или текст.")
         return
     await set_setting(session, key, val)
+    # Фиксируем до ответа в Telegram: транзакция не держится открытой на время сетевого вызова
     await session.commit()
     await state.clear()
 
-    await message.answer(f"Сохранено: {html_escape(key)} = {html_escape(val)}", reply_markup=admin_back_to_main())
+    await message.answer(f"Сохранено: {_esc(key)} = {_esc(val)}", reply_markup=_BACK_KB)
 
 
 # —— Тарифные пакеты ——
 
+_ACTIVE_PACKAGES_COUNT_STMT = select(func.count(PaymentPackage.id)).where(PaymentPackage.is_active.is_(True))
+_PACKAGE_CODE_EXISTS_STMT = select(PaymentPackage.id).where(PaymentPackage.code == bindparam("code"))
+
+
 @router.callback_query(F.data == ADMIN_PACKAGES, IsAdminFilter())
 async def admin_cb_packages(callback: CallbackQuery, session, state: FSMContext) -> None:
     """Раздел «Тарифы»: список пакетов."""
@@ -454,11 +481,32 @@ async def admin_cb_package_add(callback: CallbackQuery, state: FSMContext) -> No
     if isinstance(callback.message, Message):
         await callback.message.edit_text(
             "Введите <b>код</b> нового пакета (латиница, например demo2):",
-            reply_markup=admin_cancel_keyboard(),
+            reply_markup=_CANCEL_KB,
         )
     await callback.answer()
 
 
+_Q2 = Decimal("0.01")
+
+
+def _parse_price(raw: str) -> Decimal | None:
+    """Цена из ввода админа («225», «225,5») с округлением до копеек, без промежуточного float."""
+    try:
+        price = Decimal(raw.replace(",", ".")).quantize(_Q2, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+    return price if price.is_finite() else None
+
+
+# Подсказки при редактировании поля пакета
+_PACKAGE_FIELD_PROMPTS = {
+    "name": "Введите новое <b>название</b> пакета:",
+    "pages": "Введите новое количество <b>страниц</b> (целое число):",
+    "price": "Введите новую <b>цену</b> (руб, например 225.00):",
+    "order": "Введите <b>порядок</b> (целое число):",
+}
+
+
 def _parse_package_id(data: str) -> int | None:
     """Из adm:pkg:ID извлекает ID."""
     if not data or not data.startswith(ADMIN_PACKAGE_PREFIX):
@@ -481,7 +529,7 @@ async def admin_cb_package_open(callback: CallbackQuery, session) -> None:
         await callback.answer("Пакет не найден.")
         return
     text = (
-        f"📦 <b>{html_escape(pkg_data.name)}</b> ({pkg_data.code})\n"
+        f"📦 <b>{_esc(pkg_data.name)}</b> ({pkg_data.code})\n"
         f"Страниц: {pkg_data.pages}, цена: {pkg_data.price} ₽\n"
         f"Порядок: {pkg_data.sort_order}, активен: {'да' if pkg_data.is_active else 'нет'}"
     )
@@ -491,7 +539,7 @@ async def admin_cb_package_open(callback: CallbackQuery, session) -> None:
 
 
 @router.callback_query(F.data.startswith(ADMIN_PACKAGE_EDIT_PREFIX), IsAdminFilter())
-async def admin_cb_package_edit_field(callback: CallbackQuery, state: FSMContext) -> None:
+async def admin_cb_package_edit_field(callback: CallbackQuery, session, state: FSMContext) -> None:
     """Запрос нового значения поля пакета. data = adm:pkg:e:ID:field."""
     parts = (callback.data or "").split(":")
     if len(parts) < 5:
@@ -507,41 +555,34 @@ async def admin_cb_package_edit_field(callback: CallbackQuery, state: FSMContext
         await callback.answer("Неизвестное поле.")
         return
     if field == "toggle":
-        from app.db import async_session_factory
-        async with async_session_factory() as session:
-            result = await session.get(PaymentPackage, pkg_id)
-            if not result:
-                await callback.answer("Пакет не найден.")
-                return
-            active_count = await session.scalar(
-                select(func.count(PaymentPackage.id)).where(PaymentPackage.is_active.is_(True))
+        result = await session.get(PaymentPackage, pkg_id)
+        if not result:
+            await callback.answer("Пакет не найден.")
+            return
+        active_count = await session.scalar(_ACTIVE_PACKAGES_COUNT_STMT)
+        if result.is_active and (active_count or 0) <= 1:
+            await callback.answer("Нельзя отключить последний активный пакет.", show_alert=True)
+            return
+        result.is_active = not result.is_active
+        # commit до сброса кэша и ответа в Telegram: блокировка строки не держится на время сетевых вызовов,
+        # а кэш пакетов не успеет перечитать ещё не зафиксированное состояние
+        await session.commit()
+        invalidate_packages_cache(result.code)
+        await callback.answer("Пакет обновлён.")
+        # session.get из identity map — без повторного SELECT
+        pkg_data = await get_package_by_id(session, pkg_id)
+        if pkg_data and isinstance(callback.message, Message):
+            text = (
+                f"📦 <b>{_esc(pkg_data.name)}</b> ({pkg_data.code})\n"
+                f"Страниц: {pkg_data.pages}, цена: {pkg_data.price} ₽\n"
+                f"Порядок: {pkg_data.sort_order}, активен: {'да' if pkg_data.is_active else 'нет'}"
             )
-            if result.is_active and (active_count or 0) <= 1:
-                await callback.answer("Нельзя отключить последний активный пакет.", show_alert=True)
-            else:
-                result.is_active = not result.is_active
-                await session.commit()
-                invalidate_packages_cache()
-                await callback.answer("Пакет обновлён.")
-                pkg_data = await get_package_by_id(session, pkg_id)
-                if pkg_data and isinstance(callback.message, Message):
-                    text = (
-                        f"📦 <b>{html_escape(pkg_data.name)}</b> ({pkg_data.code})\n"
-                        f"Страниц: {pkg_data.pages}, цена: {pkg_data.price} ₽\n"
-                        f"Порядок: {pkg_data.sort_order}, активен: {'да' if pkg_data.is_active else 'нет'}"
-                    )
-                    await callback.message.edit_text(text, reply_markup=admin_package_edit_keyboard(pkg_id, pkg_data.is_active))
+            await callback.message.edit_text(text, reply_markup=admin_package_edit_keyboard(pkg_id, pkg_data.is_active))
         return
     await state.set_state(AdminStates.waiting_package_edit_value)
     await state.update_data(admin_package_id=pkg_id, admin_package_field=field)
-    prompts = {
-        "name": "Введите новое <b>название</b> пакета:",
-        "pages": "Введите новое количество <b>страниц</b> (целое число):",
-        "price": "Введите новую <b>цену</b> (руб, например 225.00):",
-        "order": "Введите <b>порядок</b> (целое число):",
-    }
     if isinstance(callback.message, Message):
-        await callback.message.edit_text(prompts.get(field, "Введите значение:"), reply_markup=admin_cancel_keyboard())
+        await callback.message.edit_text(_PACKAGE_FIELD_PROMPTS.get(field, "Введите значение:"), reply_markup=_CANCEL_KB)
     await callback.answer()
 
 
@@ -553,12 +594,12 @@ async def admin_package_edit_value_message(message: Message, session, state: FSM
     field = data.get("admin_package_field")
     if pkg_id is None or not field:
         await state.clear()
-        await message.answer("Время действия истекло.", reply_markup=admin_back_to_main())
+        await message.answer("Время действия истекло.", reply_markup=_BACK_KB)
         return
     pkg = await session.get(PaymentPackage, pkg_id)
     if not pkg:
         await state.clear()
-        await message.answer("Пакет не найден.", reply_markup=admin_back_to_main())
+        await message.answer("Пакет не найден.", reply_markup=_BACK_KB)
         return
     raw = (message.text or "").strip()
     if field == "name":
@@ -574,16 +615,14 @@ async def admin_package_edit_value_message(message: Message, session, state: FSM
             await message.answer("Введите целое число.")
             return
     elif field == "price":
-        try:
-            val = float(raw.replace(",", "."))
-            if val <= 0:
-                await message.answer("Введите положительное число.")
-                return
-            from decimal import Decimal
-            pkg.price = Decimal(str(round(val, 2)))
-        except ValueError:
+        price = _parse_price(raw)
+        if price is None:
             await message.answer("Введите число (например 225.00).")
             return
+        if price <= 0:
+            await message.answer("Введите положительное число.")
+            return
+        pkg.price = price
     elif field == "order":
         try:
             pkg.sort_order = int(raw)
@@ -591,39 +630,38 @@ async def admin_package_edit_value_message(message: Message, session, state: FSM
             await message.answer("Введите целое число.")
             return
     await session.commit()
-    invalidate_packages_cache()
+    invalidate_packages_cache(pkg.code)
     await state.clear()
-    pkg_data = await get_package_by_id(session, pkg_id)
-    if pkg_data:
-        text = (
-            f"Сохранено. 📦 <b>{html_escape(pkg_data.name)}</b> ({pkg_data.code})\n"
-            f"Страниц: {pkg_data.pages}, цена: {pkg_data.price} ₽"
-        )
-    else:
-        text = "Сохранено."
-    await message.answer(text, reply_markup=admin_back_to_main())
+    text = (
+        f"Сохранено. 📦 <b>{_esc(pkg.name)}</b> ({pkg.code})\n"
+        f"Страниц: {pkg.pages}, цена: {pkg.price} ₽"
+    )
+    await message.answer(text, reply_markup=_BACK_KB)
 
 
 @router.message(AdminStates.waiting_package_code, F.text, IsAdminFilter())
 async def admin_package_code_message(message: Message, session, state: FSMContext) -> None:
     raw = (message.text or "").strip().lower()
-    if not raw or not raw.replace("_", "").isalnum():
+    # isalnum() пропускает и кириллицу — отдельно isascii(); длина — чтобы pay:pkg:{code} влез в callback_data
+    if not raw or not raw.isascii() or not raw.replace("_", "").isalnum():
         await message.answer("Код должен содержать только латинские буквы, цифры и подчёркивание.")
         return
-    result = await session.execute(select(PaymentPackage).where(PaymentPackage.code == raw))
-    if result.scalar_one_or_none():
+    if len(raw) > MAX_PACKAGE_CODE_LEN:
+        await message.answer(f"Код не длиннее {MAX_PACKAGE_CODE_LEN} символов.")
+        return
+    if await session.scalar(_PACKAGE_CODE_EXISTS_STMT, {"code": raw}) is not None:
         await message.answer("Пакет с таким кодом уже есть.")
         return
     await state.update_data(admin_package_code=raw)
     await state.set_state(AdminStates.waiting_package_name)
-    await message.answer("Введите <b>название</b> пакета (например «Демо»):", reply_markup=admin_cancel_keyboard())
+    await message.answer("Введите <b>название</b> пакета (например «Демо»):", reply_markup=_CANCEL_KB)
 
 
 @router.message(AdminStates.waiting_package_name, F.text, IsAdminFilter())
 async def admin_package_name_message(message: Message, state: FSMContext) -> None:
     await state.update_data(admin_package_name=(message.text or "").strip() or "Пакет")
     await state.set_state(AdminStates.waiting_package_pages)
-    await message.answer("Введите количество <b>страниц</b> (целое число):", reply_markup=admin_cancel_keyboard())
+    await message.answer("Введите количество <b>страниц</b> (целое число):", reply_markup=_CANCEL_KB)
 
 
 @router.message(AdminStates.waiting_package_pages, F.text, IsAdminFilter())
@@ -637,22 +675,18 @@ async def admin_package_pages_message(message: Message, state: FSMContext) -> No
         return
     await state.update_data(admin_package_pages=pages)
     await state.set_state(AdminStates.waiting_package_price)
-    await message.answer("Введите <b>цену</b> в рублях (например 225.00):", reply_markup=admin_cancel_keyboard())
+    await message.answer("Введите <b>цену</b> в рублях (например 225.00):", reply_markup=_CANCEL_KB)
 
 
 @router.message(AdminStates.waiting_package_price, F.text, IsAdminFilter())
 async def admin_package_price_message(message: Message, state: FSMContext) -> None:
-    try:
-        price = float((message.text or "").strip().replace(",", "."))
-        if price <= 0:
-            raise ValueError("must be positive")
-    except ValueError:
+    price = _parse_price((message.text or "").strip())
+    if price is None or price <= 0:
         await message.answer("Введите положительное число (например 225.00).")
         return
-    from decimal import Decimal
-    await state.update_data(admin_package_price=str(round(price, 2)))
+    await state.update_data(admin_package_price=str(price))
     await state.set_state(AdminStates.waiting_package_sort_order)
-    await message.answer("Введите <b>порядок</b> отображения (целое число):", reply_markup=admin_cancel_keyboard())
+    await message.answer("Введите <b>порядок</b> отображения (целое число):", reply_markup=_CANCEL_KB)
 
 
 @router.message(AdminStates.waiting_package_sort_order, F.text, IsAdminFilter())
@@ -667,7 +701,6 @@ async def admin_package_sort_order_message(message: Message, session, state: FSM
     name = data.get("admin_package_name", "Пакет")
     pages = data.get("admin_package_pages", 10)
     price_str = data.get("admin_package_price", "100.00")
-    from decimal import Decimal
     pkg = PaymentPackage(
         code=code,
         name=name,
@@ -679,13 +712,91 @@ async def admin_package_sort_order_message(message: Message, session, state: FSM
     )
     session.add(pkg)
     await session.commit()
-    invalidate_packages_cache()
+    invalidate_packages_cache(code)
     await state.clear()
-    await message.answer(f"Пакет «{name}» добавлен.", reply_markup=admin_back_to_main())
+    await message.answer(f"Пакет «{name}» добавлен.", reply_markup=_BACK_KB)
 
 
 # —— FSM: поиск пользователя ——
 
+# Колонки профиля пользователя (для поиска в админке): строка результата, а не ORM-объект
+_PROFILE_COLUMNS = (
+    User.id,
+    User.tg_id,
+    User.username,
+    User.first_name,
+    User.last_name,
+    User.created_at,
+    User.free_limits_remaining,
+    User.is_banned,
+    User.is_admin,
+    func.coalesce(UserBalance.purchased_credits, 0).label("purchased"),
+    User.documents_count.label("docs_count"),
+)
+
+# Запросы поиска собираются один раз; на вызов — только подстановка параметров.
+# Только нужные для профиля колонки + купленные лимиты одним JOIN, без гидрации ORM-объектов
+_PROFILE_BASE = select(*_PROFILE_COLUMNS).outerjoin(UserBalance, UserBalance.user_id == User.id)
+_PROFILE_BY_NAME_STMT = _PROFILE_BASE.where(User.username == bindparam("name")).limit(1)
+# «12345» может быть как ID, так и именем пользователя; совпадение по tg_id приоритетнее
+_PROFILE_BY_TG_ID_OR_NAME_STMT = (
+    _PROFILE_BASE.where(or_(User.tg_id == bindparam("tg_id"), User.username == bindparam("name")))
+    .order_by((User.tg_id == bindparam("tg_id")).desc())
+    .limit(1)
+)
+
+
+def _fmt_dt(d: datetime | None) -> str:
+    """ДД.ММ.ГГГГ ЧЧ:ММ без strftime (формат фиксированный, локаль не нужна)."""
+    if d is None:
+        return "—"
+    return f"{d.day:02d}.{d.month:02d}.{d.year} {d.hour:02d}:{d.minute:02d}"
+
+
+_PROFILE_HEAD = "👤 <b>Профиль</b>"
+_ADMIN_TAG = " 👑 Администратор"
+
+
+def _retag_profile(html_text: str, is_admin: bool) -> str | None:
+    """Карточка профиля с обновлённой пометкой администратора; None, если текст — не карточка."""
+    head, sep, rest = html_text.partition("\n")
+    if not head.startswith(_PROFILE_HEAD):
+        return None
+    head = head.replace(_ADMIN_TAG, "")
+    return f"{head}{_ADMIN_TAG if is_admin else ''}{sep}{rest}"
+
+
+def _render_profile_text(user, purchased: int, docs_count: int | None) -> str:
+    """Текст карточки пользователя. user — ORM User или строка _PROFILE_COLUMNS (нужны одни и те же поля)."""
+    created = _fmt_dt(user.created_at)
+    ban_tag = " 🚫 Заблокирован" if user.is_banned else ""
+    admin_tag = _ADMIN_TAG if user.is_admin else ""
+    # Имя и фамилия экранируются одним вызовом: пробел между ними не затрагивается
+    full_name = f"{user.first_name or ''} {user.last_name or ''}"
+    return (
+        f"{_PROFILE_HEAD}{ban_tag}{admin_tag}\n\n"
+        f"ID: <code>{user.tg_id}</code>\n"
+        f"Username: @{_esc(user.username or '—')}\n"
+        f"Имя: {_esc(full_name)}\n"
+        f"Регистрация: {created}\n\n"
+        f"Бесплатных лимитов: {user.free_limits_remaining}\n"
+        f"Платных (куплено): {purchased}\n"
+        f"Обработано документов: {docs_count or 0}"
+    )
+
+
+def _render_profile(row, viewer_is_super: bool) -> tuple[str, InlineKeyboardMarkup]:
+    """Карточка пользователя и её клавиатура по строке _PROFILE_COLUMNS."""
+    text = _render_profile_text(row, row.purchased, row.docs_count)
+    markup = admin_user_profile_keyboard(
+        user_id=row.id,
+        is_banned=row.is_banned,
+        is_target_admin=row.is_admin,
+        is_viewer_superadmin=viewer_is_super,
+    )
+    return text, markup
+
+
 @router.message(AdminStates.waiting_user_query, F.text, IsAdminFilter())
 async def admin_user_query_message(message: Message, session, state: FSMContext) -> None:
     """Обработка ввода tg_id или @username для поиска пользователя."""
@@ -693,269 +804,255 @@ async def admin_user_query_message(message: Message, session, state: FSMContext)
     if not text:
         await message.answer("Введите Telegram ID (число) или @username.")
         return
-    user = None
-    if text.startswith("@"):
-        username = text.lstrip("@")
-        result = await session.execute(
-            select(User).where(User.username == username).options(selectinload(User.balance))
-        )
-        user = result.scalar_one_or_none()
+    if text[0] == "@":
+        result = await session.execute(_PROFILE_BY_NAME_STMT, {"name": text.lstrip("@")})
+    elif text.isascii() and text.isdigit():  # isdigit() пропускает и «²», «①» — int() на них падает
+        result = await session.execute(_PROFILE_BY_TG_ID_OR_NAME_STMT, {"tg_id": int(text), "name": text})
     else:
-        try:
-            tg_id = int(text)
-            result = await session.execute(
-                select(User).where(User.tg_id == tg_id).options(selectinload(User.balance))
-            )
-            user = result.scalar_one_or_none()
-        except ValueError:
-            pass
+        result = await session.execute(_PROFILE_BY_NAME_STMT, {"name": text})
+    user = result.first()
     if not user:
         await message.answer("Пользователь не найден. Проверьте ID или имя.")
         return
     await state.clear()
-    docs_count = await session.scalar(select(func.count(Document.id)).where(Document.user_id == user.id))
-    purchased = user.balance.purchased_credits if user.balance else 0
-    created = user.created_at.strftime("%d.%m.%Y %H:%M") if user.created_at else "—"
-    ban_tag = " 🚫 Заблокирован" if getattr(user, "is_banned", False) else ""
-    admin_tag = " 👑 Администратор" if getattr(user, "is_admin", False) else ""
-    
-    safe_username = html_escape(str(user.username or "—"))
-    safe_first = html_escape(str(user.first_name or ""))
-    safe_last = html_escape(str(user.last_name or ""))
-    profile_text = (
-        f"👤 <b>Профиль</b>{ban_tag}{admin_tag}\n\n"
-        f"ID: <code>{user.tg_id}</code>\n"
-        f"Username: @{safe_username}\n"
-        f"Имя: {safe_first} {safe_last}\n"
-        f"Регистрация: {created}\n\n"
-        f"Бесплатных лимитов: {user.free_limits_remaining}\n"
-        f"Платных (куплено): {purchased}\n"
-        f"Обработано документов: {docs_count or 0}"
-    )
-    
     viewer_is_super = is_superadmin(message.from_user.id) if message.from_user else False
-    
-    await message.answer(
-        profile_text,
-        reply_markup=admin_user_profile_keyboard(
-            user_id=user.id,
-            is_banned=getattr(user, "is_banned", False),
-            is_target_admin=getattr(user, "is_admin", False),
-            is_viewer_superadmin=viewer_is_super
-        ),
-    )
+    text, markup = _render_profile(user, viewer_is_super)
+    await message.answer(text, reply_markup=markup)
 
 
 # —— Callback: изменение лимитов и бан пользователя ——
 
-def _parse_user_id_from_callback(data: str, prefix: str) -> int | None:
-    if not data.startswith(prefix) or len(data) <= len(prefix):
-        return None
-    try:
-        return int(data[len(prefix):])
-    except ValueError:
-        return None
-
-
-@router.callback_query(F.data.startswith(ADMIN_USER_FREE_ADD), IsAdminFilter())
-async def admin_user_free_add(callback: CallbackQuery, state: FSMContext) -> None:
-    """Добавить бесплатные лимиты: просим ввести количество."""
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_FREE_ADD)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
+# Целое число во вводе админа: проверка регуляркой вместо int() с перехватом ValueError
+_INT_RE = re.compile(r"\s*([+-]?[0-9]+)\s*$")
+
+# Запросы количества для изменения лимитов: действие → (состояние FSM, подсказка)
+_LIMIT_PROMPTS: dict[str, tuple[object, str]] = {
+    ADMIN_USER_FREE_ADD: (
+        AdminStates.waiting_limit_free,
+        "Введите <b>число</b> — на сколько увеличить бесплатные лимиты. Для отмены нажмите кнопку.",
+    ),
+    ADMIN_USER_FREE_SUB: (
+        AdminStates.waiting_limit_free,
+        "Введите <b>число</b> — на сколько уменьшить бесплатные лимиты.",
+    ),
+    ADMIN_USER_PAID_ADD: (
+        AdminStates.waiting_limit_paid,
+        "Введите <b>число</b> — на сколько увеличить платные лимиты.",
+    ),
+    ADMIN_USER_PAID_SUB: (
+        AdminStates.waiting_limit_paid,
+        "Введите <b>число</b> — на сколько уменьшить платные лимиты.",
+    ),
+}
+
+
+@router.callback_query(AdminUserCB.filter(), IsAdminFilter())
+async def admin_user_action(callback: CallbackQuery, callback_data: AdminUserCB, session, state: FSMContext) -> None:
+    """Кнопки профиля пользователя: один обработчик, ветвление по действию."""
+    action = callback_data.action
+    user_id = callback_data.user_id
+    prompt = _LIMIT_PROMPTS.get(action)
+    if prompt is not None:
+        # Добавить/убрать бесплатные или платные лимиты: просим ввести количество
+        target_state, text = prompt
+        await state.set_state(target_state)
+        await state.update_data(admin_user_id=user_id, admin_limit_action=action)
+        if isinstance(callback.message, Message):
+            await callback.message.edit_text(text, reply_markup=_CANCEL_KB)
+        await callback.answer()
         return
-    await state.set_state(AdminStates.waiting_limit_free)
-    await state.update_data(admin_user_id=user_id, admin_limit_action="free_add")
-    if isinstance(callback.message, Message):
-        await callback.message.edit_text(
-            "Введите <b>число</b> — на сколько увеличить бесплатные лимиты. Для отмены нажмите кнопку.",
-            reply_markup=admin_cancel_keyboard(),
-        )
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith(ADMIN_USER_FREE_SUB), IsAdminFilter())
-async def admin_user_free_sub(callback: CallbackQuery, state: FSMContext) -> None:
-    await state.set_state(AdminStates.waiting_limit_free)
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_FREE_SUB)
-    if user_id is None:
+    handler = _USER_ACTIONS.get(action)
+    if handler is None:
         await callback.answer("Не удалось выполнить действие.")
         return
-    await state.update_data(admin_user_id=user_id, admin_limit_action="free_sub")
-    if isinstance(callback.message, Message):
-        await callback.message.edit_text(
-            "Введите <b>число</b> — на сколько уменьшить бесплатные лимиты.",
-            reply_markup=admin_cancel_keyboard(),
-        )
-    await callback.answer()
-
+    await handler(callback, session, user_id)
 
-@router.callback_query(F.data.startswith(ADMIN_USER_PAID_ADD), IsAdminFilter())
-async def admin_user_paid_add(callback: CallbackQuery, state: FSMContext) -> None:
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_PAID_ADD)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-    await state.set_state(AdminStates.waiting_limit_paid)
-    await state.update_data(admin_user_id=user_id, admin_limit_action="paid_add")
-    if isinstance(callback.message, Message):
-        await callback.message.edit_text(
-            "Введите <b>число</b> — на сколько увеличить платные лимиты.",
-            reply_markup=admin_cancel_keyboard(),
-        )
-    await callback.answer()
 
-
-@router.callback_query(F.data.startswith(ADMIN_USER_PAID_SUB), IsAdminFilter())
-async def admin_user_paid_sub(callback: CallbackQuery, state: FSMContext) -> None:
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_PAID_SUB)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-    await state.set_state(AdminStates.waiting_limit_paid)
-    await state.update_data(admin_user_id=user_id, admin_limit_action="paid_sub")
-    if isinstance(callback.message, Message):
-        await callback.message.edit_text(
-            "Введите <b>число</b> — на сколько уменьшить платные лимиты.",
-            reply_markup=admin_cancel_keyboard(),
-        )
-    await callback.answer()
+@router.callback_query(F.data.startswith(ADMIN_USER_LEGACY_PREFIX), IsAdminFilter())
+async def admin_user_legacy_action(callback: CallbackQuery) -> None:
+    """Кнопки карточек, отправленных до смены формата callback_data: без ответа висел бы индикатор загрузки."""
+    await callback.answer("Профиль устарел — откройте его заново через поиск пользователя.", show_alert=True)
 
 
-@router.message(AdminStates.waiting_limit_free, F.text, IsAdminFilter())
-async def admin_limit_free_apply(message: Message, session, state: FSMContext) -> None:
-    """Применить изменение бесплатных лимитов."""
+async def _read_limit_delta(message: Message, state: FSMContext, actions: tuple[str, ...]) -> tuple[int, str, int] | None:
+    """(user_id, action, delta) из FSM и текста сообщения; при ошибке отвечает пользователю и возвращает None."""
     data = await state.get_data()
     user_id = data.get("admin_user_id")
     action = data.get("admin_limit_action")
-    if user_id is None or action not in ("free_add", "free_sub"):
+    if user_id is None or action not in actions:
         await state.clear()
-        await message.answer("Время действия истекло. Выберите действие заново.", reply_markup=admin_back_to_main())
-        return
-    try:
-        delta = int((message.text or "").strip())
-    except ValueError:
+        await message.answer("Время действия истекло. Выберите действие заново.", reply_markup=_BACK_KB)
+        return None
+    m = _INT_RE.match(message.text or "")
+    if m is None:
         await message.answer("Введите целое число.")
-        return
+        return None
+    delta = int(m.group(1))
     if delta <= 0:
         await message.answer("Число должно быть больше 0.")
+        return None
+    return user_id, action, delta
+
+
+@router.message(AdminStates.waiting_limit_free, F.text, IsAdminFilter())
+async def admin_limit_free_apply(message: Message, session, state: FSMContext) -> None:
+    """Применить изменение бесплатных лимитов."""
+    parsed = await _read_limit_delta(message, state, ("free_add", "free_sub"))
+    if parsed is None:
         return
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
+    user_id, action, delta = parsed
+    # Атомарно в БД: без чтения строки и без гонки с другим админом/воркером, вычитание с отсечкой по 0
+    if action == "free_add":
+        new_value = User.free_limits_remaining + delta
+    else:
+        new_value = func.greatest(User.free_limits_remaining - delta, 0)
+    remaining = await session.scalar(
+        update(User)
+        .where(User.id == user_id)
+        .values(free_limits_remaining=new_value)
+        .returning(User.free_limits_remaining)
+    )
+    if remaining is None:
         await state.clear()
         await message.answer("Пользователь не найден. Проверьте ID или имя.")
         return
-    if action == "free_add":
-        user.free_limits_remaining += delta
-    else:
-        user.free_limits_remaining = max(0, user.free_limits_remaining - delta)
     await session.commit()
     await state.clear()
     await message.answer(
-        f"Готово. Бесплатных лимитов у пользователя: {user.free_limits_remaining}.",
-        reply_markup=admin_back_to_main(),
+        f"Готово. Бесплатных лимитов у пользователя: {remaining}.",
+        reply_markup=_BACK_KB,
     )
 
 
 @router.message(AdminStates.waiting_limit_paid, F.text, IsAdminFilter())
 async def admin_limit_paid_apply(message: Message, session, state: FSMContext) -> None:
     """Применить изменение платных лимитов."""
-    data = await state.get_data()
-    user_id = data.get("admin_user_id")
-    action = data.get("admin_limit_action")
-    if user_id is None or action not in ("paid_add", "paid_sub"):
-        await state.clear()
-        await message.answer("Время действия истекло. Выберите действие заново.", reply_markup=admin_back_to_main())
-        return
-    try:
-        delta = int((message.text or "").strip())
-    except ValueError:
-        await message.answer("Введите целое число.")
-        return
-    if delta <= 0:
-        await message.answer("Число должно быть больше 0.")
+    parsed = await _read_limit_delta(message, state, ("paid_add", "paid_sub"))
+    if parsed is None:
         return
-    result = await session.execute(
-        select(User).where(User.id == user_id).options(selectinload(User.balance))
+    user_id, action, delta = parsed
+    signed = delta if action == "paid_add" else -delta
+    # Один upsert вместо SELECT → INSERT → flush → UPDATE: строка баланса создаётся, если её нет,
+    # INSERT ... SELECT из users — для несуществующего пользователя вставка пустая и RETURNING ничего не вернёт
+    stmt = (
+        pg_insert(UserBalance)
+        .from_select(
+            ["user_id", "purchased_credits"],
+            select(User.id, literal(max(signed, 0))).where(User.id == user_id),
+        )
+        .on_conflict_do_update(
+            index_elements=[UserBalance.user_id],
+            set_={
+                "purchased_credits": func.greatest(UserBalance.purchased_credits + signed, 0),
+                "updated_at": func.now(),
+            },
+        )
+        .returning(UserBalance.purchased_credits)
     )
-    user = result.scalar_one_or_none()
-    if not user:
+    purchased = await session.scalar(stmt)
+    if purchased is None:
         await state.clear()
         await message.answer("Пользователь не найден. Проверьте ID или имя.")
         return
-    if user.balance is None:
-        user.balance = UserBalance(user_id=user.id)
-        session.add(user.balance)
-        await session.flush()
-    if action == "paid_add":
-        user.balance.purchased_credits += delta
-    else:
-        user.balance.purchased_credits = max(0, user.balance.purchased_credits - delta)
     await session.commit()
     await state.clear()
     await message.answer(
-        f"Готово. Платных лимитов у пользователя: {user.balance.purchased_credits}.",
-        reply_markup=admin_back_to_main(),
+        f"Готово. Платных лимитов у пользователя: {purchased}.",
+        reply_markup=_BACK_KB,
     )
 
 
-@router.callback_query(F.data.startswith(ADMIN_USER_BAN), IsAdminFilter())
-async def admin_user_ban(callback: CallbackQuery, session) -> None:
-    """Заблокировать пользователя."""
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_BAN)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
-        await callback.answer("Пользователь не найден. Проверьте ID или имя.")
-        return
-    user.is_banned = True
+_USER_EXISTS_STMT = select(User.id).where(User.id == bindparam("user_id"))
+
+
+async def _set_user_banned(callback: CallbackQuery, session, user_id: int, banned: bool) -> bool:
+    """UPDATE ... RETURNING: флаг бана и перерисовка кнопок за один запрос, без SELECT пользователя."""
+    row = (
+        await session.execute(
+            update(User)
+            .where(User.id == user_id, User.is_banned.is_not(banned))
+            .values(is_banned=banned)
+            .returning(User.tg_id, User.is_admin)
+        )
+    ).one_or_none()
+    if row is None:
+        # Повторное нажатие: флаг уже стоит — без commit и без правки клавиатуры
+        exists = await session.scalar(_USER_EXISTS_STMT, {"user_id": user_id})
+        if exists is None:
+            await callback.answer("Пользователь не найден. Проверьте ID или имя.")
+        else:
+            await callback.answer("Пользователь уже заблокирован" if banned else "Пользователь уже разблокирован")
+        return False
     await session.commit()
-    viewer_is_super = is_superadmin(callback.from_user.id) if callback.from_user else False
+    logger.info(
+        "admin_user_ban: ban flag changed",
+        extra={
+            "target_tg_id": row.tg_id,
+            "is_banned": banned,
+            "viewer_tg_id": callback.from_user.id if callback.from_user else None,
+        },
+    )
     if isinstance(callback.message, Message):
         await callback.message.edit_reply_markup(
             reply_markup=admin_user_profile_keyboard(
-                user_id=user.id,
-                is_banned=True,
-                is_target_admin=getattr(user, "is_admin", False),
-                is_viewer_superadmin=viewer_is_super
+                user_id=user_id,
+                is_banned=banned,
+                is_target_admin=row.is_admin,
+                is_viewer_superadmin=callback.from_user is not None and is_superadmin(callback.from_user.id),
             ),
         )
-    await callback.answer("Пользователь заблокирован")
+    return True
+
+
+async def admin_user_ban(callback: CallbackQuery, session, user_id: int) -> None:
+    """Заблокировать пользователя."""
+    if await _set_user_banned(callback, session, user_id, True):
+        await callback.answer("Пользователь заблокирован")
 
 
-@router.callback_query(F.data.startswith(ADMIN_USER_UNBAN), IsAdminFilter())
-async def admin_user_unban(callback: CallbackQuery, session) -> None:
+async def admin_user_unban(callback: CallbackQuery, session, user_id: int) -> None:
     """Разблокировать пользователя."""
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_UNBAN)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
+    if await _set_user_banned(callback, session, user_id, False):
+        await callback.answer("Пользователь разблокирован")
+
+
+async def _set_user_admin(callback: CallbackQuery, session, user_id: int, make_admin: bool) -> int | None:
+    """UPDATE ... RETURNING флага администратора; перерисовка карточки без повторного чтения профиля.
+
+    Возвращает tg_id пользователя или None, если он не найден.
+    """
+    row = (
+        await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(is_admin=make_admin)
+            .returning(User.tg_id, User.is_banned)
+        )
+    ).one_or_none()
+    if row is None:
         await callback.answer("Пользователь не найден. Проверьте ID или имя.")
-        return
-    user.is_banned = False
+        return None
     await session.commit()
-    viewer_is_super = is_superadmin(callback.from_user.id) if callback.from_user else False
+    # После commit сброс кэша в Redis и ответ Telegram независимы — выполняем параллельно
+    answer = "Назначен администратором" if make_admin else "Права администратора сняты"
+    await asyncio.gather(invalidate_admin_cache(row.tg_id), callback.answer(answer))
     if isinstance(callback.message, Message):
-        await callback.message.edit_reply_markup(
-            reply_markup=admin_user_profile_keyboard(
-                user_id=user.id,
-                is_banned=False,
-                is_target_admin=getattr(user, "is_admin", False),
-                is_viewer_superadmin=viewer_is_super
-            ),
+        markup = admin_user_profile_keyboard(
+            user_id=user_id,
+            is_banned=row.is_banned,
+            is_target_admin=make_admin,
+            is_viewer_superadmin=True
         )
-    await callback.answer("Пользователь разблокирован")
+        # Меняется только пометка 👑 в заголовке карточки — правим её в уже показанном тексте
+        text = _retag_profile(callback.message.html_text, make_admin)
+        if text is None:
+            await callback.message.edit_reply_markup(reply_markup=markup)
+        else:
+            await callback.message.edit_text(text, reply_markup=markup)
+    return row.tg_id
 
 
-@router.callback_query(F.data.startswith(ADMIN_USER_PROMOTE), IsAdminFilter())
-async def admin_user_promote(callback: CallbackQuery, session) -> None:
+async def admin_user_promote(callback: CallbackQuery, session, user_id: int) -> None:
     """Сделать пользователя администратором (только для суперадминов)."""
     if not callback.from_user or not is_superadmin(callback.from_user.id):
         logger.info(
@@ -964,105 +1061,26 @@ async def admin_user_promote(callback: CallbackQuery, session) -> None:
         )
         await callback.answer("У вас нет прав на назначение администраторов.")
         return
-        
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_PROMOTE)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-        
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
-        await callback.answer("Пользователь не найден. Проверьте ID или имя.")
-        return
-        
-    user.is_admin = True
-    await session.commit()
-    await invalidate_admin_cache(user.tg_id)
-    await callback.answer("Назначен администратором")
-    logger.info(
-        "admin_user_promote: user promoted to admin",
-        extra={"target_tg_id": user.tg_id, "viewer_tg_id": callback.from_user.id if callback.from_user else None},
-    )
-    if isinstance(callback.message, Message):
-        # Перерисовываем профиль, чтобы добавить пометку 👑 Администратор
-        docs_count = await session.scalar(select(func.count(Document.id)).where(Document.user_id == user.id))
-        purchased = user.balance.purchased_credits if user.balance else 0
-        created = user.created_at.strftime("%d.%m.%Y %H:%M") if user.created_at else "—"
-        ban_tag = " 🚫 Заблокирован" if getattr(user, "is_banned", False) else ""
-        admin_tag = " 👑 Администратор"
-        safe_username = html_escape(str(user.username or "—"))
-        safe_first = html_escape(str(user.first_name or ""))
-        safe_last = html_escape(str(user.last_name or ""))
-        profile_text = (
-            f"👤 <b>Профиль</b>{ban_tag}{admin_tag}\n\n"
-            f"ID: <code>{user.tg_id}</code>\n"
-            f"Username: @{safe_username}\n"
-            f"Имя: {safe_first} {safe_last}\n"
-            f"Регистрация: {created}\n\n"
-            f"Бесплатных лимитов: {user.free_limits_remaining}\n"
-            f"Платных (куплено): {purchased}\n"
-            f"Обработано документов: {docs_count or 0}"
-        )
-        await callback.message.edit_text(
-            profile_text,
-            reply_markup=admin_user_profile_keyboard(
-                user_id=user.id,
-                is_banned=getattr(user, "is_banned", False),
-                is_target_admin=True,
-                is_viewer_superadmin=True
-            )
+    tg_id = await _set_user_admin(callback, session, user_id, True)
+    if tg_id is not None:
+        logger.info(
+            "admin_user_promote: user promoted to admin",
+            extra={"target_tg_id": tg_id, "viewer_tg_id": callback.from_user.id},
         )
 
 
-@router.callback_query(F.data.startswith(ADMIN_USER_DEMOTE), IsAdminFilter())
-async def admin_user_demote(callback: CallbackQuery, session) -> None:
+async def admin_user_demote(callback: CallbackQuery, session, user_id: int) -> None:
     """Убрать пользователя из администраторов (только для суперадминов)."""
     if not callback.from_user or not is_superadmin(callback.from_user.id):
         await callback.answer("У вас нет прав на управление администраторами.")
         return
-        
-    user_id = _parse_user_id_from_callback(callback.data or "", ADMIN_USER_DEMOTE)
-    if user_id is None:
-        await callback.answer("Не удалось выполнить действие.")
-        return
-        
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
-        await callback.answer("Пользователь не найден. Проверьте ID или имя.")
-        return
-        
-    user.is_admin = False
-    await session.commit()
-    await invalidate_admin_cache(user.tg_id)
-    await callback.answer("Права администратора сняты")
+    await _set_user_admin(callback, session, user_id, False)
 
-    if isinstance(callback.message, Message):
-        # Перерисовываем профиль (убираем пометку)
-        docs_count = await session.scalar(select(func.count(Document.id)).where(Document.user_id == user.id))
-        purchased = user.balance.purchased_credits if user.balance else 0
-        created = user.created_at.strftime("%d.%m.%Y %H:%M") if user.created_at else "—"
-        ban_tag = " 🚫 Заблокирован" if getattr(user, "is_banned", False) else ""
-        safe_username = html_escape(str(user.username or "—"))
-        safe_first = html_escape(str(user.first_name or ""))
-        safe_last = html_escape(str(user.last_name or ""))
-        profile_text = (
-            f"👤 <b>Профиль</b>{ban_tag}\n\n"
-            f"ID: <code>{user.tg_id}</code>\n"
-            f"Username: @{safe_username}\n"
-            f"Имя: {safe_first} {safe_last}\n"
-            f"Регистрация: {created}\n\n"
-            f"Бесплатных лимитов: {user.free_limits_remaining}\n"
-            f"Платных (куплено): {purchased}\n"
-            f"Обработано документов: {docs_count or 0}"
-        )
-        await callback.message.edit_text(
-            profile_text,
-            reply_markup=admin_user_profile_keyboard(
-                user_id=user.id,
-                is_banned=getattr(user, "is_banned", False),
-                is_target_admin=False,
-                is_viewer_superadmin=True
-            )
-        )
+
+# Действия над пользователем из AdminUserCB (кроме лимитов — они в _LIMIT_PROMPTS)
+_USER_ACTIONS = {
+    ADMIN_USER_BAN: admin_user_ban,
+    ADMIN_USER_UNBAN: admin_user_unban,
+    ADMIN_USER_PROMOTE: admin_user_promote,
+    ADMIN_USER_DEMOTE: admin_user_demote,
+}
@@ -3,10 +3,13 @@
 """
 from __future__ import annotations
 
+import asyncio
 import logging
+import uuid
 
 from aiogram import F, Router
 from aiogram.types import Message
+from sqlalchemy import update
 
 from app.models import Document
 from bot.services.user import get_or_create_user, refund_user_limit, spend_user_limit
@@ -34,7 +37,8 @@ async def on_document(message: Message, session) -> None:
     if not user_tg:
         return
 
-    await message.answer("Проверяю файл…")
+    # Ответ в Telegram и работа с БД независимы — сообщение уходит параллельно с запросами
+    ack = asyncio.create_task(message.answer("Проверяю файл…"))
 
     try:
         user = await get_or_create_user(
@@ -45,6 +49,9 @@ async def on_document(message: Message, session) -> None:
             last_name=user_tg.last_name,
         )
         ok, ded_free, ded_paid = await spend_user_limit(session, user, amount=1)
+        # следующие ответы — строго после «Проверяю файл…»; сбой этой отправки не должен уводить в except
+        # уже после списания: middleware закоммитил бы лимит без документа
+        await asyncio.gather(ack, return_exceptions=True)
         if not ok:
             await message.answer("Лимит исчерпан. Используйте /buy — выберите тариф и оплатите пакет страниц.")
             return
@@ -60,6 +67,8 @@ async def on_document(message: Message, session) -> None:
         elif message.photo:
             file_unique_id = message.photo[-1].file_unique_id
 
+        # id задачи Celery известен заранее: документ коммитится один раз уже с ним
+        task_id = str(uuid.uuid4())
         doc = Document(
             user_id=user.id,
             telegram_file_id=file_id,
@@ -69,35 +78,47 @@ async def on_document(message: Message, session) -> None:
             status="pending",
             deducted_free=ded_free,
             deducted_paid=ded_paid,
+            celery_task_id=task_id,
         )
         session.add(doc)
-        await session.flush()
         await session.commit()  # воркер читает БД в другом процессе — без commit документа не видно
 
         try:
             from celery_app import process_document_task
-            result = process_document_task.delay(doc.id, file_id)
-            doc.celery_task_id = result.id
-            await session.commit()
+            process_document_task.apply_async(args=[doc.id, file_id], task_id=task_id)
         except Exception as e:
             logger.exception("Failed to enqueue document %s: %s", doc.id, e)
+            # Задача не поставлена: лимит возвращаем здесь, документ закрываем как error —
+            # иначе cleanup_stale_documents_task вернул бы лимит по нему второй раз
+            await session.execute(
+                update(Document)
+                .where(Document.id == doc.id)
+                .values(
+                    status="error",
+                    error_message="Не удалось поставить в очередь. Лимит возвращён.",
+                    deducted_free=0,
+                    deducted_paid=0,
+                )
+            )
             await refund_user_limit(session, user, ded_free, ded_paid)
             await message.answer(
                 "Сервис обработки временно недоступен. Ваш лимит не списан — попробуйте отправить файл через минуту."
             )
             return
 
-        await message.answer(
-            "Файл принят. Распознавание текста (AI) займёт до минуты, для PDF — дольше. "
-            "Результат придёт сюда отдельным сообщением. Если расшифровка не пришла за 2–3 минуты — напишите в поддержку."
+        from aiogram.enums import ChatAction
+        # Задача уже в очереди: сбой отправки подтверждения или chat action на неё не влияет
+        await asyncio.gather(
+            message.answer(
+                "Файл принят. Распознавание текста (AI) займёт до минуты, для PDF — дольше. "
+                "Результат придёт сюда отдельным сообщением. Если расшифровка не пришла за 2–3 минуты — напишите в поддержку."
+            ),
+            message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING),
+            return_exceptions=True,
         )
-        try:
-            from aiogram.enums import ChatAction
-            await message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-        except Exception:
-            pass
     except Exception as e:
         logger.exception("Error processing document from user %s: %s", user_tg.id, e)
+        await asyncio.gather(ack, return_exceptions=True)
         await message.answer(
             "Произошла ошибка при обработке файла. Попробуйте позже или обратитесь в поддержку."
         )
@@ -4,20 +4,28 @@
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 import uuid
 from datetime import datetime, timezone, timedelta
-from decimal import Decimal
+from functools import lru_cache
 
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from sqlalchemy import delete, func, select
+from sqlalchemy import bindparam, delete, func, insert, literal, select, update
 
+import app.db as db_module
 from app.models import Transaction, User
-from app.services.settings import PaymentPackageData, get_active_packages, get_package_by_code, get_setting
+from app.services.settings import (
+    PaymentPackageData,
+    get_active_packages,
+    get_cached_package_by_code,
+    get_package_by_code,
+    get_setting,
+)
 from app.yookassa_service import create_payment
-from bot.keyboards.payments import PAY_PACKAGE_PREFIX, packages_keyboard, payment_link_keyboard
+from bot.keyboards.payments import CURRENCY_SYMBOLS, PAY_PACKAGE_PREFIX, packages_keyboard, payment_link_keyboard
 from config import get_settings
 
 router = Router(name="payments")
@@ -27,6 +35,53 @@ MAX_PENDING_PAYMENTS = 5
 PENDING_PAYMENTS_WINDOW_MINUTES = 30
 
 
+def _recent_pending_count(user_id):
+    """Подзапрос: число недавних pending-платежей пользователя (окно — параметр since)."""
+    return (
+        select(func.count(Transaction.id))
+        .where(
+            Transaction.user_id == user_id,
+            Transaction.status == "pending",
+            Transaction.created_at >= bindparam("since"),
+        )
+        .scalar_subquery()
+    )
+
+
+# Покупатель по tg_id вместе с числом его недавних pending-платежей — один SELECT
+_BUYER_STMT = select(User.id, _recent_pending_count(User.id)).where(User.tg_id == bindparam("tg_id"))
+# То же условие прямо в INSERT ... SELECT
+_RECENT_PENDING_COUNT = _recent_pending_count(bindparam("user_id"))
+_TXN_INSERT_COLUMNS = (
+    "user_id", "idempotency_key", "yookassa_payment_id", "amount", "currency", "status", "description",
+    "package_code", "package_name", "package_pages", "package_price",
+)
+
+
+def _insert_pending_txn_stmt(values: tuple):
+    """INSERT pending-транзакции, только если у пользователя меньше MAX_PENDING_PAYMENTS недавних pending.
+    Проверка и вставка — один запрос (без отдельного COUNT и окна между ними); RETURNING id или ничего."""
+    return (
+        insert(Transaction)
+        .from_select(
+            _TXN_INSERT_COLUMNS,
+            select(
+                *(literal(v, Transaction.__table__.c[col].type) for col, v in zip(_TXN_INSERT_COLUMNS, values))
+            ).where(_RECENT_PENDING_COUNT < MAX_PENDING_PAYMENTS),
+        )
+        .returning(Transaction.id)
+    )
+
+
+async def _answer_too_many_pending(callback: CallbackQuery) -> None:
+    """Отказ при превышении MAX_PENDING_PAYMENTS."""
+    await callback.answer(
+        "Слишком много активных оплат. Дождитесь завершения или отмены одной из них.",
+        show_alert=True,
+    )
+
+
+@lru_cache(maxsize=64)
 def _format_tariff_line(pkg: PaymentPackageData) -> str:
     """Строка тарифа с ценой за страницу: «Демо — 50 стр — 225 ₽ (4,5 ₽/стр)»."""
     try:
@@ -35,7 +90,8 @@ def _format_tariff_line(pkg: PaymentPackageData) -> str:
         per_page_str = f"{per_page:.1f}".replace(".", ",")
     except (ValueError, TypeError):
         per_page_str = "—"
-    return f"{pkg.name} — {pkg.pages} стр — {pkg.price} ₽ ({per_page_str} ₽/стр)"
+    sym = CURRENCY_SYMBOLS.get(pkg.currency, pkg.currency)
+    return f"{pkg.name} — {pkg.pages} стр — {pkg.price} {sym} ({per_page_str} {sym}/стр)"
 
 
 async def _show_packages(message: Message, session) -> bool:
@@ -61,49 +117,61 @@ async def _do_buy_with_package(callback: CallbackQuery, session, package_code: s
         return False
     message = callback.message
 
-    result = await session.execute(select(User).where(User.tg_id == callback.from_user.id))
-    user = result.scalar_one_or_none()
-    if not user:
+    since = datetime.now(timezone.utc) - timedelta(minutes=PENDING_PAYMENTS_WINDOW_MINUTES)
+
+    async def _load_buyer(s):
+        result = await s.execute(_BUYER_STMT, {"tg_id": callback.from_user.id, "since": since})
+        return result.one_or_none()
+
+    async def _load_package(s) -> PaymentPackageData | None:
+        return await get_package_by_code(s, package_code)
+
+    # Пакет обычно уже в кэше списка тарифов (его только что показали) — тогда в БД только за пользователем
+    pkg = get_cached_package_by_code(package_code)
+    if pkg is not None or db_module.async_session_factory is None:
+        buyer = await _load_buyer(session)
+        if pkg is None:
+            pkg = await _load_package(session)
+    else:
+        # Пользователь и пакет независимы — читаем параллельно в отдельных коротких сессиях
+        buyer, pkg = await asyncio.gather(
+            db_module.run_in_own_session(_load_buyer), db_module.run_in_own_session(_load_package)
+        )
+    if buyer is None:
         await callback.answer("Сначала отправьте /start.")
         return False
-
-    pkg = await get_package_by_code(session, package_code)
+    user_id, pending = buyer
     if not pkg or not pkg.is_active:
         await callback.answer("Этот тариф недоступен.")
         return False
 
-    since = datetime.now(timezone.utc) - timedelta(minutes=PENDING_PAYMENTS_WINDOW_MINUTES)
-    pending_count_result = await session.execute(
-        select(func.count(Transaction.id)).where(
-            Transaction.user_id == user.id,
-            Transaction.status == "pending",
-            Transaction.created_at >= since,
-        )
-    )
-    pending_count = pending_count_result.scalar() or 0
-    if pending_count >= MAX_PENDING_PAYMENTS:
-        await callback.answer(
-            "Слишком много активных оплат. Дождитесь завершения или отмены одной из них.",
-            show_alert=True,
-        )
+    if pending >= MAX_PENDING_PAYMENTS:
+        await _answer_too_many_pending(callback)
         return False
-
-    amount_decimal = Decimal(pkg.price)
+    amount_decimal = pkg.price_decimal
     idem_key = str(uuid.uuid4())
-
-    txn = Transaction(
-        user_id=user.id,
-        idempotency_key=idem_key,
-        amount=amount_decimal,
-        currency="RUB",
-        status="pending",
-        description=f"{pkg.name}: {pkg.pages} страниц",
-        package_code=pkg.code,
-        package_name=pkg.name,
-        package_pages=pkg.pages,
-        package_price=amount_decimal,
+    # Сначала строка транзакции, затем платёж в ЮKassa: живого платежа без локальной записи не бывает.
+    # Лимит pending проверяется в самой вставке — на случай параллельных нажатий
+    txn_id = await session.scalar(
+        _insert_pending_txn_stmt((
+            user_id,
+            idem_key,
+            None,
+            amount_decimal,
+            "RUB",
+            "pending",
+            f"{pkg.name}: {pkg.pages} страниц",
+            pkg.code,
+            pkg.name,
+            pkg.pages,
+            amount_decimal,
+        )),
+        {"user_id": user_id, "since": since},
     )
-    session.add(txn)
+    if txn_id is None:
+        await _answer_too_many_pending(callback)
+        return False
+    # commit до HTTP-вызова ЮKassa: соединение и транзакция не держатся открытыми на время запроса
     await session.commit()
 
     try:
@@ -112,15 +180,15 @@ async def _do_buy_with_package(callback: CallbackQuery, session, package_code: s
             description=f"Пакет {pkg.name}: {pkg.pages} стр.",
             metadata={
                 "user_tg_id": str(callback.from_user.id),
-                "user_id": str(user.id),
+                "user_id": str(user_id),
                 "package_code": pkg.code,
-                "txn_id": str(txn.id),
+                "txn_id": str(txn_id),
             },
             idempotence_key=idem_key,
         )
     except Exception as e:
         logger.exception("YooKassa create_payment failed: %s", e)
-        await session.execute(delete(Transaction).where(Transaction.id == txn.id))
+        await session.execute(delete(Transaction).where(Transaction.id == txn_id))
         await session.commit()
         demo_url = get_settings().DEMO_PAYMENT_URL
         if demo_url:
@@ -136,7 +204,9 @@ async def _do_buy_with_package(callback: CallbackQuery, session, package_code: s
         await callback.answer()
         return False
 
-    txn.yookassa_payment_id = payment.id
+    await session.execute(
+        update(Transaction).where(Transaction.id == txn_id).values(yookassa_payment_id=payment.id)
+    )
     await session.commit()
 
     if not payment.confirmation_url:
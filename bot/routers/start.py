@@ -3,15 +3,16 @@
 """
 from __future__ import annotations
 
+import asyncio
 import logging
-from urllib.parse import parse_qs, unquote
+from urllib.parse import unquote, unquote_plus
 
 from aiogram import F, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from sqlalchemy import select
+from sqlalchemy import bindparam, func, select, update
 
-from app.models import User, UserUTM
+from app.models import User, UserBalance
 from bot.filters import is_admin
 from bot.keyboards.common import get_main_keyboard
 from bot.middlewares.policy import POLICY_CALLBACK, get_policy_text
@@ -21,20 +22,42 @@ logger = logging.getLogger(__name__)
 
 router = Router(name="start")
 
+_PROFILE_LIMITS_STMT = (
+    select(User.free_limits_remaining, func.coalesce(UserBalance.purchased_credits, 0))
+    .outerjoin(UserBalance, UserBalance.user_id == User.id)
+    .where(User.tg_id == bindparam("tg_id"))
+)
+
+
+# Короткие префиксы (s, m, c) и полные имена в Telegram-формате → utm_source, utm_medium, utm_campaign
+_UTM_KEY_ALIASES = {
+    "s": "utm_source", "src": "utm_source", "source": "utm_source",
+    "m": "utm_medium", "med": "utm_medium", "medium": "utm_medium",
+    "c": "utm_campaign", "cmp": "utm_campaign", "campaign": "utm_campaign",
+    "t": "utm_term", "term": "utm_term",
+    "cnt": "utm_content", "content": "utm_content",
+}
+# Ключи, которые читает cmd_start; остальные пары классического формата не сохраняются
+_UTM_KEYS = frozenset(_UTM_KEY_ALIASES.values())
+
 
 def _parse_start_payload(text: str) -> str | None:
     """Извлекает payload из /start (например utm_source_telegram)."""
-    if not text or not text.strip().lower().startswith("/start"):
+    if not text:
+        return None
+    text = text.strip()
+    # Частый случай — /start без payload: без lower() всей строки и без split
+    if text[:6].lower() != "/start" or len(text) == 6:
         return None
-    parts = text.strip().split(maxsplit=1)
+    parts = text.split(maxsplit=1)
     return parts[1] if len(parts) > 1 else None
 
 
-def _parse_utm_from_payload(payload: str | None) -> dict:
+def _parse_utm_from_payload(payload: str | None) -> dict[str, str]:
     """
-    Парсит UTM из строки. 
+    Парсит UTM из строки: ключ → значение (при повторе ключа берётся первое).
     Поддерживает:
-    1. Классический URL format (если передан): utm_source=xxx&utm_medium=yyy
+    1. Классический URL format (если передан): utm_source=xxx&utm_medium=yyy (только utm_*-ключи)
     2. Специальный формат для Telegram (только a-zA-Z0-9_-):
        source-xxx__medium-yyy__campaign-zzz
     3. Одиночная метка.
@@ -45,7 +68,21 @@ def _parse_utm_from_payload(payload: str | None) -> dict:
     
     # 1. Если каким-то чудом прошел классический формат
     if "=" in payload:
-        return parse_qs(payload)
+        # Разбор как parse_qsl (пары без значения пропускаются), но без списков и
+        # unquote_plus для частей, где нечего декодировать
+        result: dict[str, str] = {}
+        for part in payload.split("&"):
+            k, _, v = part.partition("=")
+            if not v:
+                continue
+            if "%" in k or "+" in k:
+                k = unquote_plus(k)
+            if k not in _UTM_KEYS:
+                continue
+            if "%" in v or "+" in v:
+                v = unquote_plus(v)
+            result.setdefault(k, v)
+        return result
     
     # 2. Телеграм-совместимый формат: source-xxx__medium-yyy
     # Используем двойное подчеркивание '__' для разделения параметров,
@@ -54,26 +91,14 @@ def _parse_utm_from_payload(payload: str | None) -> dict:
         result = {}
         pairs = payload.split("__") if "__" in payload else payload.split("_")
         for pair in pairs:
-            if "-" in pair:
-                parts = pair.split("-", 1)
-                if len(parts) == 2:
-                    k, v = parts
-                    # Короткие префиксы (s, m, c) и полные имена → utm_source, utm_medium, utm_campaign
-                    utm_keys = {
-                        "s": "utm_source", "src": "utm_source", "source": "utm_source",
-                        "m": "utm_medium", "med": "utm_medium", "medium": "utm_medium",
-                        "c": "utm_campaign", "cmp": "utm_campaign", "campaign": "utm_campaign",
-                        "t": "utm_term", "term": "utm_term",
-                        "cnt": "utm_content", "content": "utm_content",
-                    }
-                    if k in utm_keys:
-                        k = utm_keys[k]
-                    result[k] = [v]
+            k, sep, v = pair.partition("-")
+            if sep:
+                result[_UTM_KEY_ALIASES.get(k, k)] = v
         if result:
             return result
 
     # 3. Одиночная строка (например, start=partner123)
-    return {"raw": [payload]}
+    return {"raw": payload}
 
 
 @router.message(CommandStart())
@@ -82,30 +107,27 @@ async def cmd_start(message: Message, session) -> None:
     user_tg = message.from_user
     if not user_tg:
         return
+    payload = _parse_start_payload(message.text or "")
+    utm_values = None
+    if payload:
+        utm = _parse_utm_from_payload(payload)
+        utm_values = {
+            "raw_start_payload": payload,
+            "utm_source": utm.get("utm_source"),
+            "utm_medium": utm.get("utm_medium"),
+            "utm_campaign": utm.get("utm_campaign"),
+            "utm_term": utm.get("utm_term"),
+            "utm_content": utm.get("utm_content"),
+        }
+    # UTM-запись пишется тем же запросом, что и создание/обновление пользователя
     user = await get_or_create_user(
         session,
         tg_id=user_tg.id,
         username=user_tg.username,
         first_name=user_tg.first_name,
         last_name=user_tg.last_name,
+        utm=utm_values,
     )
-    payload = _parse_start_payload(message.text or "")
-    if payload:
-        utm = _parse_utm_from_payload(payload)
-
-        def _first(v):
-            return v[0] if isinstance(v, list) and v else None
-
-        utm_record = UserUTM(
-            user_id=user.id,
-            raw_start_payload=payload,
-            utm_source=_first(utm.get("utm_source")),
-            utm_medium=_first(utm.get("utm_medium")),
-            utm_campaign=_first(utm.get("utm_campaign")),
-            utm_term=_first(utm.get("utm_term")),
-            utm_content=_first(utm.get("utm_content")),
-        )
-        session.add(utm_record)
 
     if not user.is_agreed_to_policy:
         keyboard = InlineKeyboardMarkup(
@@ -129,21 +151,26 @@ async def on_policy_accepted(callback: CallbackQuery, session) -> None:
     if not callback.from_user:
         return
     from datetime import datetime, timezone
-    result = await session.execute(select(User).where(User.tg_id == callback.from_user.id))
-    user = result.scalar_one_or_none()
+    # Один UPDATE ... RETURNING вместо загрузки пользователя и изменения атрибутов
+    user = (
+        await session.execute(
+            update(User)
+            .where(User.tg_id == callback.from_user.id)
+            .values(is_agreed_to_policy=True, policy_agreed_at=datetime.now(timezone.utc))
+            .returning(User.is_admin)
+        )
+    ).one_or_none()
     if not user:
         await callback.answer("Сначала отправьте /start.")
         return
-    user.is_agreed_to_policy = True
-    user.policy_agreed_at = datetime.now(timezone.utc)
     reply_kbd = get_main_keyboard(is_admin=is_admin(callback.from_user.id, user))
+    # Согласие фиксируем до ответов; сами ответы в Telegram независимы — отправляем параллельно
+    await session.commit()
+    replies = [callback.answer("Готово.")]
     if isinstance(callback.message, Message):
-        await callback.message.edit_text("Спасибо! Теперь вы можете отправлять документы и фото.")
-        await callback.message.answer(
-            "Выберите действие:",
-            reply_markup=reply_kbd,
-        )
-    await callback.answer("Готово.")
+        replies.append(callback.message.edit_text("Спасибо! Теперь вы можете отправлять документы и фото."))
+        replies.append(callback.message.answer("Выберите действие:", reply_markup=reply_kbd))
+    await asyncio.gather(*replies)
 
 
 @router.message(F.text == "👤 Мой профиль")
@@ -151,19 +178,15 @@ async def cmd_my_profile(message: Message, session) -> None:
     """Кнопка «Мой профиль»: баланс и лимиты."""
     if not message.from_user:
         return
-    from sqlalchemy import select
-    from sqlalchemy.orm import selectinload
-    result = await session.execute(
-        select(User).where(User.tg_id == message.from_user.id).options(selectinload(User.balance))
-    )
-    user = result.scalar_one_or_none()
-    if not user:
+    # Лимиты и купленный баланс одним JOIN (selectinload давал второй запрос за балансом)
+    row = (await session.execute(_PROFILE_LIMITS_STMT, {"tg_id": message.from_user.id})).one_or_none()
+    if row is None:
         await message.answer("Сначала отправьте /start.")
         return
-    purchased = user.balance.purchased_credits if user.balance else 0
+    free_left, purchased = row
     text = (
         "👤 Ваш профиль\n\n"
-        f"Бесплатных лимитов: {user.free_limits_remaining}\n"
+        f"Бесплатных лимитов: {free_left}\n"
         f"Платных (куплено): {purchased}\n\n"
         "Отправьте фото или PDF для распознавания текста. Пополнение страниц — кнопка «💳 Купить лимиты» (выбор тарифа)."
     )
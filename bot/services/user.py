@@ -3,109 +3,181 @@
 """
 from __future__ import annotations
 
-from sqlalchemy import select
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import exists, func, insert, literal, literal_column, or_, select, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased
 
-from app.models import User, UserBalance
+from app.models import User, UserBalance, UserUTM
 from app.services.settings import get_setting
 from config import get_settings
 
 
+async def _default_free_limit(session: AsyncSession) -> int:
+    """Стартовые бесплатные лимиты: переопределение из bot_settings (кэшируется) или .env."""
+    limit_str = await get_setting(session, "FREE_LIMITS_PER_MONTH")
+    try:
+        return int(limit_str) if (limit_str is not None and str(limit_str).strip()) else get_settings().FREE_LIMITS_PER_MONTH
+    except (TypeError, ValueError):
+        return get_settings().FREE_LIMITS_PER_MONTH
+
+
 async def get_or_create_user(
     session: AsyncSession,
     tg_id: int,
     username: str | None = None,
     first_name: str | None = None,
     last_name: str | None = None,
+    utm: dict[str, str | None] | None = None,
 ) -> User:
-    """Возвращает пользователя по tg_id или создаёт нового."""
-    result = await session.execute(select(User).where(User.tg_id == tg_id).options(selectinload(User.balance)))
-    user = result.scalar_one_or_none()
-    if user:
-        user.username = username or user.username
-        user.first_name = first_name or user.first_name
-        user.last_name = last_name or user.last_name
-        return user
-    limit_str = await get_setting(session, "FREE_LIMITS_PER_MONTH")
-    try:
-        limit = int(limit_str) if (limit_str is not None and str(limit_str).strip()) else get_settings().FREE_LIMITS_PER_MONTH
-    except (TypeError, ValueError):
-        limit = get_settings().FREE_LIMITS_PER_MONTH
-    user = User(
-        tg_id=tg_id,
-        username=username,
-        first_name=first_name,
-        last_name=last_name,
-        free_limits_remaining=limit,
+    """Возвращает пользователя по tg_id или создаёт нового.
+
+    Один запрос: INSERT ... ON CONFLICT (tg_id) DO UPDATE ... RETURNING в CTE — и поиск, и создание,
+    и обновление имени, без гонки двух параллельных /start. Строка обновляется, только если имя
+    действительно изменилось (иначе каждый /start и каждый документ писал бы новую версию строки в WAL);
+    без обновления RETURNING пуст, и существующая строка берётся тем же запросом. В том же запросе
+    (data-modifying CTE) новому пользователю создаётся строка баланса, а при переданном utm
+    (колонки UserUTM без user_id) пишется UTM-запись. Связь balance не загружается.
+    """
+    values = {
+        "tg_id": tg_id,
+        "username": username,
+        "first_name": first_name,
+        "last_name": last_name,
+        "free_limits_remaining": await _default_free_limit(session),
+    }
+    excluded = pg_insert(User).excluded
+    # Пустые значения из Telegram ("" или NULL) не затирают сохранённые
+    new_names = {
+        col: func.coalesce(func.nullif(excluded[col], ""), User.__table__.c[col])
+        for col in ("username", "first_name", "last_name")
+    }
+    upserted = (
+        pg_insert(User)
+        .values(values)
+        .on_conflict_do_update(
+            index_elements=[User.tg_id],
+            set_=new_names,
+            where=or_(*(new.is_distinct_from(User.__table__.c[col]) for col, new in new_names.items())),
+        )
+        # xmax = 0 только у только что вставленной строки
+        .returning(*User.__table__.c, literal_column("xmax = 0").label("inserted"))
+        .cte("upserted")
     )
-    session.add(user)
-    try:
-        await session.flush()
-    except IntegrityError as e:
-        orig = getattr(e, "orig", e)
-        msg, name = str(orig), type(orig).__name__
-        if "ix_users_tg_id" not in msg and "UniqueViolationError" not in name:
-            raise
-        await session.rollback()
-        result = await session.execute(
-            select(User).where(User.tg_id == tg_id).options(selectinload(User.balance))
+    # Конфликт без изменений: RETURNING пуст — та же строка из таблицы
+    unchanged = select(*User.__table__.c, literal(False).label("inserted")).where(
+        User.tg_id == tg_id, ~exists(select(upserted.c.id))
+    )
+    user_row = union_all(select(*upserted.c), unchanged).cte("user_row")
+    balance = (
+        pg_insert(UserBalance)
+        .from_select(["user_id"], select(upserted.c.id).where(upserted.c.inserted))
+        .on_conflict_do_nothing(index_elements=[UserBalance.user_id])
+        .cte("new_balance")
+    )
+    stmt = (
+        select(aliased(User, user_row))
+        .add_cte(balance)
+        .execution_options(populate_existing=True)
+    )
+    if utm:
+        columns = list(utm)
+        stmt = stmt.add_cte(
+            insert(UserUTM)
+            .from_select(
+                ["user_id", *columns],
+                select(user_row.c.id, *(literal(utm[c], UserUTM.__table__.c[c].type) for c in columns)),
+            )
+            .cte("new_utm")
         )
-        existing = result.scalar_one_or_none()
-        if not existing:
-            raise
-        existing.username = username or existing.username
-        existing.first_name = first_name or existing.first_name
-        existing.last_name = last_name or existing.last_name
-        return existing
-    balance = UserBalance(user_id=user.id)
-    session.add(balance)
-    await session.flush()
-    await session.refresh(user, attribute_names=["balance"])
+    user = (await session.execute(stmt)).scalar_one_or_none()
+    if user is None:
+        # Параллельный /start вставил строку после снимка нашего запроса: конфликт без изменений,
+        # а в снимке строки ещё нет. Повтор видит её уже закоммиченной
+        user = (await session.execute(stmt)).scalar_one()
     return user
 
 
 async def spend_user_limit(session: AsyncSession, user: User, amount: int = 1) -> tuple[bool, int, int]:
     """
     Списывает заданное количество лимитов: сначала бесплатные, затем купленные.
-    Использует блокировку строки (FOR UPDATE).
+    Обычный случай — один условный UPDATE ... RETURNING без отдельного чтения строки; любое списание
+    держит блокировку строки users (как и _spend_limits_sync воркера), списания не обгоняют друг друга.
     Возвращает: (success, deducted_free, deducted_paid)
     """
-    result = await session.execute(
-        select(User)
-        .where(User.id == user.id)
-        .options(selectinload(User.balance))
+    # Хватает бесплатных
+    free_left = await session.scalar(
+        update(User)
+        .where(User.id == user.id, User.free_limits_remaining >= amount)
+        .values(free_limits_remaining=User.free_limits_remaining - amount)
+        .returning(User.free_limits_remaining)
+    )
+    if free_left is not None:
+        return True, amount, 0
+
+    # Бесплатных нет совсем — списываем только купленные. Строка users блокируется в том же запросе
+    # (CTE ... FOR UPDATE): списания бота и воркера (_spend_limits_sync) сериализуются на ней,
+    # порядок блокировок тот же — сначала users, затем user_balances
+    locked_user = (
+        select(User.id)
+        .where(User.id == user.id, User.free_limits_remaining == 0)
         .with_for_update()
+        .cte("locked_user")
     )
-    u = result.scalar_one()
-    
-    total_available = u.free_limits_remaining + (u.balance.purchased_credits if u.balance else 0)
-    if total_available < amount:
+    paid_left = await session.scalar(
+        update(UserBalance)
+        .where(
+            UserBalance.user_id == locked_user.c.id,
+            UserBalance.purchased_credits >= amount,
+        )
+        .values(purchased_credits=UserBalance.purchased_credits - amount)
+        .returning(UserBalance.purchased_credits)
+    )
+    if paid_left is not None:
+        return True, 0, amount
+
+    # Смешанное списание (amount > 1): остаток бесплатных + часть купленных под блокировкой
+    # Без строки баланса бесплатных уже не хватило (первый UPDATE) — списывать нечего
+    row = (
+        await session.execute(
+            select(User.free_limits_remaining, UserBalance.purchased_credits)
+            .join(UserBalance, UserBalance.user_id == User.id)
+            .where(User.id == user.id)
+            .with_for_update()
+        )
+    ).one_or_none()
+    if row is None:
         return False, 0, 0
-        
-    deducted_free = 0
-    deducted_paid = 0
-    
-    if u.free_limits_remaining >= amount:
-        u.free_limits_remaining -= amount
-        deducted_free = amount
-    else:
-        deducted_free = u.free_limits_remaining
-        u.free_limits_remaining = 0
-        deducted_paid = amount - deducted_free
-        if u.balance:
-            u.balance.purchased_credits -= deducted_paid
-            
+    free, paid = row
+    if free + paid < amount:
+        return False, 0, 0
+    deducted_free = min(free, amount)
+    deducted_paid = amount - deducted_free
+    await session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(free_limits_remaining=User.free_limits_remaining - deducted_free)
+    )
+    if deducted_paid:
+        await session.execute(
+            update(UserBalance)
+            .where(UserBalance.user_id == user.id)
+            .values(purchased_credits=UserBalance.purchased_credits - deducted_paid)
+        )
     return True, deducted_free, deducted_paid
 
 
 async def refund_user_limit(session: AsyncSession, user: User, deducted_free: int = 1, deducted_paid: int = 0) -> None:
-    """Возвращает списанные лимиты в соответствующие счетчики."""
-    result = await session.execute(
-        select(User).where(User.id == user.id).options(selectinload(User.balance)).with_for_update()
-    )
-    u = result.scalar_one()
-    u.free_limits_remaining += deducted_free
-    if u.balance and deducted_paid > 0:
-        u.balance.purchased_credits += deducted_paid
+    """Возвращает списанные лимиты в соответствующие счетчики (атомарные UPDATE, без чтения строк)."""
+    if deducted_free > 0:
+        await session.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(free_limits_remaining=User.free_limits_remaining + deducted_free)
+        )
+    if deducted_paid > 0:
+        await session.execute(
+            update(UserBalance)
+            .where(UserBalance.user_id == user.id)
+            .values(purchased_credits=UserBalance.purchased_credits + deducted_paid)
+        )
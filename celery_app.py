@@ -4,16 +4,24 @@ Celery app: брокер Redis, задачи обработки документ
 from __future__ import annotations
 
 # ruff: noqa: E402 — imports below depend on setup_logging / config
+import asyncio
+import concurrent.futures
+import json
 import logging
 import os
+import re
+import tempfile
+import threading
 import time
-from datetime import datetime, timezone
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
 
 import httpx
 from celery import Celery
 from celery.schedules import crontab
-from celery.signals import setup_logging
+from celery.signals import setup_logging, worker_init, worker_process_init
+from kombu.serialization import register as register_serializer
 
 @setup_logging.connect
 def setup_celery_logging(**kwargs):
@@ -28,15 +36,31 @@ def setup_celery_logging(**kwargs):
     except ImportError:
         pass
 
-from sqlalchemy import create_engine, select, update
+from sqlalchemy import Integer, column, create_engine, func, select, update
+from sqlalchemy import values as sa_values
+from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import sessionmaker, selectinload
 
-from app.models import Document, User
+from app.models import Document, User, UserBalance
+from app.services.limits import spend_limits_stmt
 from app.services.settings import get_setting_str_sync
 from config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# PDFium (pypdfium2): текстовый слой в разы быстрее чистого Python pypdf и рендер страниц в памяти;
+# без него — pypdf и poppler (pdf2image)
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# orjson (Rust) — сериализация сообщений Celery и JSON запросов к Bot API; без него — штатный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 settings = get_settings()
 
 if settings.SENTRY_DSN:
@@ -63,16 +87,41 @@ celery_app = Celery(
 )
 # На Windows prefork падает с PermissionError (billiard); solo — один процесс, без fork
 _is_windows = os.name == "nt"
+
+# Очереди: долгий OCR/PDF (десятки секунд на вызов LLM) отдельно от коротких задач, чтобы рассылки,
+# выгрузки и обслуживание не ждали за документами. Воркеры запускаются по очередям:
+#   celery -A celery_app worker -Q ocr --prefetch-multiplier=1 -O fair
+#   celery -A celery_app worker -Q notify,maint --prefetch-multiplier=8
+# -O fair: задача отдаётся свободному дочернему процессу, а не занятому длинным PDF.
+# Один воркер на всё (Windows, solo): -Q ocr,notify,maint
+OCR_QUEUE = "ocr"
+NOTIFY_QUEUE = "notify"
+MAINT_QUEUE = "maint"
+
+# Формат на проводе тот же (application/json): процессы с orjson и без него читают сообщения друг друга
+if orjson is not None:
+    register_serializer("orjson", orjson.dumps, orjson.loads, content_type="application/json", content_encoding="utf-8")
+TASK_SERIALIZER = "orjson" if orjson is not None else "json"
+
 celery_app.conf.update(
-    task_serializer="json",
-    accept_content=["json"],
-    result_serializer="json",
+    task_serializer=TASK_SERIALIZER,
+    accept_content=[TASK_SERIALIZER, "json"] if orjson is not None else ["json"],
+    result_serializer=TASK_SERIALIZER,
     time_zone="UTC",
     enable_utc=True,
     task_acks_late=True,
     worker_prefetch_multiplier=1,
     max_tasks_per_child=10,
     worker_pool="solo" if _is_windows else "prefork",
+    task_default_queue=OCR_QUEUE,
+    task_routes={
+        "celery_app.process_document_task": {"queue": OCR_QUEUE},
+        "celery_app.broadcast_task": {"queue": NOTIFY_QUEUE},
+        "celery_app.broadcast_chunk_task": {"queue": NOTIFY_QUEUE},
+        "celery_app.export_xlsx_task": {"queue": MAINT_QUEUE},
+        "celery_app.reset_free_limits_task": {"queue": MAINT_QUEUE},
+        "celery_app.cleanup_stale_documents_task": {"queue": MAINT_QUEUE},
+    },
 )
 
 # Расписание сброса бесплатных лимитов (по умолчанию 1-е число месяца, 00:00 UTC)
@@ -95,32 +144,101 @@ celery_app.conf.beat_schedule = {
     "cleanup-stale-documents": {
         "task": "celery_app.cleanup_stale_documents_task",
         "schedule": crontab(minute="*/15"),  # каждые 15 минут
+        # Не выполнять запуск, пролежавший в очереди дольше интервала: следующий уже в пути
+        "options": {"expires": 14 * 60},
     },
 }
 
-# Синхронная сессия БД для воркера
+# Синхронная сессия БД для воркера. Дочерний процесс prefork выполняет одну задачу за раз — ему хватает
+# пары соединений; solo (Windows) крутит всё в одном процессе и держит пул побольше
 sync_engine = create_engine(
-    settings.get_database_url_sync(), 
+    settings.get_database_url_sync(),
     pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20,
+    pool_size=10 if _is_windows else 2,
+    max_overflow=20 if _is_windows else 4,
     pool_recycle=3600,
 )
 SyncSession = sessionmaker(sync_engine, expire_on_commit=False, autocommit=False, autoflush=False)
 
 
-# HTTP client session for reuse across tasks
-http_client = httpx.Client(timeout=60.0, limits=httpx.Limits(max_keepalive_connections=20, max_connections=100))
+# HTTP client session for reuse across tasks. HTTP/2 — если установлен h2 (httpx[http2]): запросы к
+# api.telegram.org идут по одному соединению; без h2 — обычный keep-alive HTTP/1.1
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+http_client = httpx.Client(
+    timeout=60.0,
+    # http2/limits задаются на транспорте: при явном transport одноимённые аргументы Client не действуют.
+    # retries — повтор только неудавшегося подключения (запрос ещё не ушёл), без риска двойной отправки
+    transport=httpx.HTTPTransport(
+        http2=_HTTP2,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=300.0),
+    ),
+)
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _json_body(payload: dict) -> dict:
+    """Аргументы httpx для JSON-тела: готовые байты orjson или json= (штатная сериализация httpx)."""
+    if orjson is None:
+        return {"json": payload}
+    return {"content": orjson.dumps(payload), "headers": _JSON_HEADERS}
+
+
+def _json_loads(content: bytes):
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+@worker_process_init.connect
+def _reset_db_pool(**kwargs):
+    """Дочерний процесс не должен использовать соединения пула, унаследованные от родителя при fork."""
+    sync_engine.dispose(close=False)
+
+
+def _warm_http_client_request() -> None:
+    try:
+        http_client.get(f"https://api.telegram.org/bot{settings.BOT_TOKEN}/getMe", timeout=2.0)
+    except Exception as e:
+        logger.debug("Telegram connection warm-up failed: %s", e)
+
+
+@worker_process_init.connect
+def _warm_http_client(**kwargs):
+    """
+    Открывает соединение с Bot API в каждом процессе воркера заранее, до первой задачи.
+    В фоновом потоке: worker_process_init должен завершиться за worker_proc_alive_timeout (4 с),
+    а медленный api.telegram.org (с повторами подключения транспорта) не должен задерживать UP процесса.
+    """
+    threading.Thread(target=_warm_http_client_request, name="tg-warmup", daemon=True).start()
+
+
+@worker_init.connect
+def _preload_heavy_modules(**kwargs):
+    """
+    Импортирует тяжёлые модули обработки документов в главном процессе воркера до fork: дочерние
+    процессы (max_tasks_per_child их пересоздаёт) получают их готовыми, а импорты внутри функций
+    становятся поиском в sys.modules. В процессе бота (он импортирует celery_app ради .delay) не вызывается.
+    """
+    for module in ("pypdf", "pdf2image", "PIL.Image", "app.llm_ocr", "app.services.export"):
+        try:
+            __import__(module)
+        except Exception as e:
+            logger.warning("Preload of %s failed: %s", module, e)
 
 # Maximum file size allowed to process (default 20MB to protect memory)
 MAX_FILE_SIZE_BYTES = 20 * 1024 * 1024
+# Порция потокового скачивания файла из Telegram
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
 
 
 def _sanitize_error_message(raw: str, max_length: int = 500) -> str:
     """
     Удаляет из текста ошибки чувствительные данные (api_key, token, пути) перед записью в БД.
     """
-    import re
     if not raw or not isinstance(raw, str):
         return ""
     text = raw[: max_length * 2]
@@ -137,34 +255,35 @@ def _sanitize_error_message(raw: str, max_length: int = 500) -> str:
     return text[:max_length]
 
 
-def _download_telegram_file(file_id: str) -> bytes:
-    """Скачивает файл по file_id через Telegram Bot API."""
+def _file_too_large() -> ValueError:
+    return ValueError(f"FILE_TOO_LARGE: Файл слишком большой. Максимальный размер - {MAX_FILE_SIZE_BYTES // (1024*1024)} МБ.")
+
+
+def _download_telegram_file(file_id: str) -> bytearray:
+    """
+    Скачивает файл по file_id через Telegram Bot API.
+    Всегда потоком, порциями в один bytearray: без промежуточного списка чанков и их склейки
+    (пик памяти — один размер файла), с обрывом загрузки сразу после превышения MAX_FILE_SIZE_BYTES,
+    даже если file_size не пришёл или неверен.
+    """
     token = settings.BOT_TOKEN
     r = http_client.get(f"https://api.telegram.org/bot{token}/getFile", params={"file_id": file_id})
     r.raise_for_status()
-    file_info = r.json()["result"]
+    file_info = _json_loads(r.content)["result"]
     file_size = file_info.get("file_size")
 
     if file_size is not None and file_size > MAX_FILE_SIZE_BYTES:
-        raise ValueError(f"FILE_TOO_LARGE: Файл слишком большой. Максимальный размер - {MAX_FILE_SIZE_BYTES // (1024*1024)} МБ.")
+        raise _file_too_large()
 
     path = file_info["file_path"]
-    if file_size is None:
-        # Telegram не вернул file_size — скачиваем потоком и проверяем размер
-        with http_client.stream("GET", f"https://api.telegram.org/file/bot{token}/{path}") as resp:
-            resp.raise_for_status()
-            chunks = []
-            total = 0
-            for chunk in resp.iter_bytes():
-                total += len(chunk)
-                if total > MAX_FILE_SIZE_BYTES:
-                    raise ValueError(f"FILE_TOO_LARGE: Файл слишком большой. Максимальный размер - {MAX_FILE_SIZE_BYTES // (1024*1024)} МБ.")
-                chunks.append(chunk)
-            return b"".join(chunks)
-
-    r2 = http_client.get(f"https://api.telegram.org/file/bot{token}/{path}")
-    r2.raise_for_status()
-    return r2.content
+    buf = bytearray()
+    with http_client.stream("GET", f"https://api.telegram.org/file/bot{token}/{path}") as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+            if len(buf) + len(chunk) > MAX_FILE_SIZE_BYTES:
+                raise _file_too_large()
+            buf += chunk
+    return buf
 
 def _send_telegram_message(chat_id: int, text: str, parse_mode: str | None = "HTML") -> None:
     """Отправляет сообщение пользователю от имени бота."""
@@ -172,16 +291,25 @@ def _send_telegram_message(chat_id: int, text: str, parse_mode: str | None = "HT
     payload = {"chat_id": chat_id, "text": text}
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    r = http_client.post(f"https://api.telegram.org/bot{token}/sendMessage", json=payload, timeout=30.0)
+    r = http_client.post(f"https://api.telegram.org/bot{token}/sendMessage", **_json_body(payload), timeout=30.0)
     r.raise_for_status()
 
-def _send_telegram_document(chat_id: int, file_bytes: bytes, filename: str = "result.txt") -> None:
+def _send_telegram_document(
+    chat_id: int,
+    file_bytes: bytes,
+    filename: str = "result.txt",
+    mime_type: str = "text/plain",
+    caption: str = "",
+) -> None:
     """Отправляет файл пользователю в чат."""
     token = settings.BOT_TOKEN
+    data = {"chat_id": chat_id}
+    if caption:
+        data["caption"] = caption
     r = http_client.post(
         f"https://api.telegram.org/bot{token}/sendDocument",
-        data={"chat_id": chat_id},
-        files={"document": (filename, file_bytes, "text/plain")},
+        data=data,
+        files={"document": (filename, file_bytes, mime_type)},
         timeout=60.0,
     )
     r.raise_for_status()
@@ -192,7 +320,7 @@ def _send_telegram_photo(chat_id: int, photo_file_id: str, caption: str = "") ->
     payload = {"chat_id": chat_id, "photo": photo_file_id}
     if caption:
         payload["caption"] = caption[:1024]
-    r = http_client.post(f"https://api.telegram.org/bot{token}/sendPhoto", json=payload, timeout=30.0)
+    r = http_client.post(f"https://api.telegram.org/bot{token}/sendPhoto", **_json_body(payload), timeout=30.0)
     r.raise_for_status()
 
 def _send_telegram_video(chat_id: int, video_file_id: str, caption: str = "") -> None:
@@ -201,7 +329,7 @@ def _send_telegram_video(chat_id: int, video_file_id: str, caption: str = "") ->
     payload = {"chat_id": chat_id, "video": video_file_id}
     if caption:
         payload["caption"] = caption[:1024]
-    r = http_client.post(f"https://api.telegram.org/bot{token}/sendVideo", json=payload, timeout=60.0)
+    r = http_client.post(f"https://api.telegram.org/bot{token}/sendVideo", **_json_body(payload), timeout=60.0)
     r.raise_for_status()
 
 
@@ -225,6 +353,10 @@ def _run_ocr_on_image(image_bytes: bytes) -> str:
     )
 
 
+# Разделители строк str.splitlines()
+_LINE_BREAK_RE = re.compile("[\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]")
+
+
 def _page_text_sufficient(text: str, min_chars: int) -> bool:
     """
     Страница считается «лёгкой» (достаточно pypdf) только если символов >= min_chars
@@ -232,70 +364,179 @@ def _page_text_sufficient(text: str, min_chars: int) -> bool:
     """
     if len(text) < min_chars:
         return False
-    lines = [s for s in text.strip().splitlines() if s.strip()]
-    return len(lines) >= 2
+    # После strip первая и последняя строки непустые: две непустые строки ⇔ внутри есть разрыв строки.
+    # Поиск останавливается на первом разрыве — без разбиения всей страницы на строки
+    return _LINE_BREAK_RE.search(text.strip()) is not None
+
+
+def _open_pdf(data: bytes):
+    """Открывает PDF: PdfDocument pypdfium2 (PDFium, C++), если установлен, иначе PdfReader pypdf."""
+    if pdfium is not None:
+        return pdfium.PdfDocument(BytesIO(data))
+    from pypdf import PdfReader
+
+    return PdfReader(BytesIO(data))
+
+
+def _pdf_page_count(pdf) -> int:
+    return len(pdf) if pdfium is not None else len(pdf.pages)
 
 
-def _pdf_analyze_pages(pdf_bytes: bytes) -> tuple[list[str], int]:
+def _pdf_page_text(pdf, index: int) -> str:
+    """Текстовый слой страницы (index с нуля)."""
+    if pdfium is None:
+        return pdf.pages[index].extract_text() or ""
+    page = pdf[index]
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range().replace("\r\n", "\n")
+    finally:
+        textpage.close()
+        page.close()
+
+
+def _pdf_analyze_pages(pdf) -> tuple[list[str], int]:
     """
-    Извлекает текст pypdf по каждой странице (без вызова LLM).
+    Извлекает текстовый слой по каждой странице (без вызова LLM). pdf — уже открытый _open_pdf
+    документ (чтобы не разбирать файл второй раз) или байты PDF.
     Возвращает (список строк по страницам, число страниц с текстом ниже порога — для LLM).
     """
-    from pypdf import PdfReader
-
-    reader = PdfReader(BytesIO(pdf_bytes))
-    pages = reader.pages
-    total_pages = len(pages)
+    if isinstance(pdf, (bytes, bytearray)):
+        pdf = _open_pdf(pdf)
+    total_pages = _pdf_page_count(pdf)
     max_pages = getattr(settings, "PDF_MAX_PAGES", 50) or 50
     if total_pages > max_pages:
         logger.warning("PDF has %s pages, capping to %s", total_pages, max_pages)
-    pages = pages[:max_pages]
 
     min_chars = getattr(settings, "PDF_MIN_CHARS_PER_PAGE", 150) or 150
     texts: list[str] = []
-    for page in pages:
-        t = page.extract_text()
-        texts.append((t or "").strip())
-    llm_page_count = sum(1 for t in texts if not _page_text_sufficient(t, min_chars))
-    for i, t in enumerate(texts, 1):
-        decision = "pypdf" if _page_text_sufficient(t, min_chars) else "LLM"
-        logger.info("PDF page %s: %s chars -> %s", i, len(t), decision)
+    llm_page_count = 0
+    for i in range(min(total_pages, max_pages)):
+        t = _pdf_page_text(pdf, i).strip()
+        texts.append(t)
+        sufficient = _page_text_sufficient(t, min_chars)
+        if not sufficient:
+            llm_page_count += 1
+        logger.info("PDF page %s: %s chars -> %s", i + 1, len(t), "pypdf" if sufficient else "LLM")
     return texts, llm_page_count
 
 
-def _run_llm_for_pdf_page(
-    pdf_bytes: bytes, page_num: int, temp_dir: str
-) -> str:
-    """Рендерит одну страницу PDF в изображение и распознаёт через LLM. Возвращает текст или заглушку."""
+# Параметры JPEG для pdftoppm при рендере страниц PDF под LLM
+PDF_RENDER_JPEGOPT = {"quality": 85, "progressive": True, "optimize": True}
+
+
+def _page_runs(page_nums: list[int]) -> list[tuple[int, int]]:
+    """Группирует возрастающие номера страниц в непрерывные диапазоны: [1, 2, 3, 7] → [(1, 3), (7, 7)]."""
+    runs: list[tuple[int, int]] = []
+    for n in page_nums:
+        if runs and runs[-1][1] == n - 1:
+            runs[-1] = (runs[-1][0], n)
+        else:
+            runs.append((n, n))
+    return runs
+
+
+def _render_pdf_pages_poppler(
+    pdf_bytes: bytes, page_nums: list[int], temp_dir: str
+) -> tuple[dict[int, str], dict[int, str]]:
+    """
+    Рендерит страницы PDF в JPEG-файлы во temp_dir: один вызов poppler на непрерывный диапазон страниц
+    (а не pdfinfo + pdftoppm на каждую страницу), внутри диапазона poppler работает в несколько процессов.
+    JPEG вместо PNG: файлы в разы меньше, а для LLM-распознавания разницы нет.
+    Возвращает (номер страницы → путь к JPEG, номер страницы → заглушка об ошибке конвертации).
+    """
     from pdf2image import convert_from_bytes
-    from app.llm_ocr import extract_text_via_llm
 
     dpi = getattr(settings, "PDF_OCR_DPI", 200) or 200
     poppler_path = (getattr(settings, "POPPLER_PATH", None) or "").strip() or None
-    try:
+    images: dict[int, str] = {}
+    errors: dict[int, str] = {}
+    for first, last in _page_runs(page_nums):
         kwargs: dict = {
             "dpi": dpi,
-            "first_page": page_num,
-            "last_page": page_num,
+            "first_page": first,
+            "last_page": last,
             "output_folder": temp_dir,
+            "fmt": "jpeg",
+            "jpegopt": PDF_RENDER_JPEGOPT,
+            "paths_only": True,
+            "thread_count": min(os.cpu_count() or 1, last - first + 1),
         }
         if poppler_path is not None:
             kwargs["poppler_path"] = poppler_path
-        images = convert_from_bytes(pdf_bytes, **kwargs)
-        if not images:
-            return f"[Страница {page_num}: не удалось преобразовать]"
-    except Exception as e:
-        logger.warning("Failed to convert page %s: %s", page_num, e)
-        err_msg = str(e)[:80]
-        if "poppler" in err_msg.lower():
-            logger.info("Poppler not found: set POPPLER_PATH in .env to poppler bin folder (Windows: poppler-windows on GitHub)")
-        return f"[Страница {page_num}: ошибка конвертации — {err_msg}]"
+        try:
+            paths = convert_from_bytes(pdf_bytes, **kwargs)
+        except Exception as e:
+            logger.warning("Failed to convert pages %s-%s: %s", first, last, e)
+            err_msg = str(e)[:80]
+            if "poppler" in err_msg.lower():
+                logger.info("Poppler not found: set POPPLER_PATH in .env to poppler bin folder (Windows: poppler-windows on GitHub)")
+            for page_num in range(first, last + 1):
+                errors[page_num] = f"[Страница {page_num}: ошибка конвертации — {err_msg}]"
+            continue
+        # paths отсортированы по номеру страницы
+        for page_num in range(first, last + 1):
+            i = page_num - first
+            if i < len(paths):
+                images[page_num] = paths[i]
+            else:
+                errors[page_num] = f"[Страница {page_num}: не удалось преобразовать]"
+    return images, errors
+
+
+def _encode_page_jpeg(img) -> bytes:
+    """Сжимает отрендеренную страницу в JPEG не больше LLM_MAX_IMAGE_SIZE — prepare_image_for_llm отдаст его как есть."""
+    from PIL import Image
 
-    img = images[0]
+    max_side = settings.LLM_MAX_IMAGE_SIZE
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), getattr(Image, "Resampling", Image).LANCZOS)
     buf = BytesIO()
-    img.save(buf, format="PNG")
-    img_bytes = buf.getvalue()
-    img.close()
+    img.convert("RGB").save(buf, format="JPEG", **PDF_RENDER_JPEGOPT)
+    return buf.getvalue()
+
+
+def _render_pdf_pages_pdfium(pdf_bytes: bytes, page_nums: list[int]) -> tuple[dict[int, bytes], dict[int, str]]:
+    """Рендерит страницы PDFium прямо в память: без подпроцесса poppler и временных файлов."""
+    scale = (getattr(settings, "PDF_OCR_DPI", 200) or 200) / 72
+    images: dict[int, bytes] = {}
+    errors: dict[int, str] = {}
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        for page_num in page_nums:
+            try:
+                page = pdf[page_num - 1]
+                try:
+                    images[page_num] = _encode_page_jpeg(page.render(scale=scale).to_pil())
+                finally:
+                    page.close()
+            except Exception as e:
+                logger.warning("Failed to render page %s: %s", page_num, e)
+                errors[page_num] = f"[Страница {page_num}: ошибка конвертации — {str(e)[:80]}]"
+    finally:
+        pdf.close()
+    return images, errors
+
+
+def _render_pdf_pages(pdf_bytes: bytes, page_nums: list[int]) -> tuple[dict[int, bytes], dict[int, str]]:
+    """
+    Рендерит страницы PDF для LLM в JPEG-байты: через PDFium в памяти, без него — poppler во временную папку.
+    Возвращает (номер страницы → JPEG, номер страницы → заглушка об ошибке конвертации).
+    """
+    if pdfium is not None:
+        return _render_pdf_pages_pdfium(pdf_bytes, page_nums)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths, errors = _render_pdf_pages_poppler(pdf_bytes, page_nums, temp_dir)
+        images: dict[int, bytes] = {}
+        for page_num, path in paths.items():
+            with open(path, "rb") as f:
+                images[page_num] = f.read()
+    return images, errors
+
+
+def _run_llm_for_pdf_page(img_bytes: bytes, page_num: int) -> str:
+    """Распознаёт отрендеренную страницу PDF (JPEG) через LLM. Возвращает текст или заглушку."""
+    from app.llm_ocr import extract_text_via_llm
 
     api_key = settings.OPENROUTER_API_KEY
     model = settings.LLM_VISION_MODEL
@@ -329,48 +570,45 @@ def _process_pdf_hybrid(pdf_bytes: bytes, pypdf_texts: list[str]) -> str:
     иначе рендер в картинку + LLM (одна строка — всегда в ИИ).
     """
     min_chars = getattr(settings, "PDF_MIN_CHARS_PER_PAGE", 150) or 150
-    try:
-        import pdf2image  # noqa: F401 — check availability for _run_llm_for_pdf_page
-    except Exception as e:
-        logger.warning("pdf2image not available: %s", e)
-        return "\n\n---\n\n".join(
-            t if _page_text_sufficient(t, min_chars) else f"[Страница {i + 1}: pdf2image недоступен]"
-            for i, t in enumerate(pypdf_texts)
-        )
+    if pdfium is None:
+        try:
+            import pdf2image  # noqa: F401 — check availability for _render_pdf_pages
+        except Exception as e:
+            logger.warning("pdf2image not available: %s", e)
+            return "\n\n---\n\n".join(
+                t if _page_text_sufficient(t, min_chars) else f"[Страница {i + 1}: pdf2image недоступен]"
+                for i, t in enumerate(pypdf_texts)
+            )
 
-    import tempfile
-    import concurrent.futures
 
     page_results: list[str] = [""] * len(pypdf_texts)
-    pypdf_used = 0
-    llm_used = 0
-    
-    tasks = []
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for i, pypdf_text in enumerate(pypdf_texts):
-            page_num = i + 1
-            if _page_text_sufficient(pypdf_text, min_chars):
-                page_results[i] = pypdf_text
-                pypdf_used += 1
-            else:
-                tasks.append((i, page_num))
-                llm_used += 1
-
-        if tasks:
-            max_workers = min(10, len(tasks))
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_index = {
-                    executor.submit(_run_llm_for_pdf_page, pdf_bytes, page_num, temp_dir): idx
-                    for idx, page_num in tasks
-                }
-                for future in concurrent.futures.as_completed(future_to_index):
-                    idx = future_to_index[future]
-                    try:
-                        page_results[idx] = future.result()
-                    except Exception as e:
-                        logger.exception("Error processing page %s in ThreadPoolExecutor: %s", idx + 1, e)
-                        page_results[idx] = f"[Страница {idx + 1}: непредвиденная ошибка — {e}]"
+    llm_indices: list[int] = []
+    for i, pypdf_text in enumerate(pypdf_texts):
+        if _page_text_sufficient(pypdf_text, min_chars):
+            page_results[i] = pypdf_text
+        else:
+            llm_indices.append(i)
+    pypdf_used = len(pypdf_texts) - len(llm_indices)
+    llm_used = len(llm_indices)
+
+    if llm_indices:
+        # Вызовы LLM — сетевое ожидание: страницы распознаются параллельно, порядок держит индекс
+        max_workers = min(getattr(settings, "LLM_CONCURRENCY", 8) or 8, len(llm_indices))
+        images, errors = _render_pdf_pages(pdf_bytes, [idx + 1 for idx in llm_indices])
+        for page_num, stub in errors.items():
+            page_results[page_num - 1] = stub
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_index = {
+                executor.submit(_run_llm_for_pdf_page, img_bytes, page_num): page_num - 1
+                for page_num, img_bytes in images.items()
+            }
+            for future in concurrent.futures.as_completed(future_to_index):
+                idx = future_to_index[future]
+                try:
+                    page_results[idx] = future.result()
+                except Exception as e:
+                    logger.exception("Error processing page %s in ThreadPoolExecutor: %s", idx + 1, e)
+                    page_results[idx] = f"[Страница {idx + 1}: непредвиденная ошибка — {e}]"
 
     logger.info("PDF hybrid: %s pypdf, %s LLM", pypdf_used, llm_used)
     return "\n\n---\n\n".join(page_results)
@@ -405,17 +643,53 @@ def _process_document_bytes(
 TG_MESSAGE_MAX_LENGTH = 4096
 
 
+_MD_BOLD_STARS_RE = re.compile(r"\*\*(.+?)\*\*")
+_MD_BOLD_UNDERSCORES_RE = re.compile(r"__(.+?)__")
+
+
 def _strip_markdown_from_ocr_text(text: str) -> str:
     """Убирает маркдаун-выделение (** и __) из ответа LLM, чтобы в Telegram не светились звёздочки."""
     if not text or not text.strip():
         return text
-    import re
-    # Удаляем ** и __ (жирный в Markdown), оставляя содержимое
-    t = re.sub(r"\*\*(.+?)\*\*", r"\1", text)
-    t = re.sub(r"__(.+?)__", r"\1", t)
+    # Удаляем ** и __ (жирный в Markdown), оставляя содержимое; без маркеров регулярки не запускаем
+    t = text
+    if "**" in t:
+        t = _MD_BOLD_STARS_RE.sub(r"\1", t)
+    if "__" in t:
+        t = _MD_BOLD_UNDERSCORES_RE.sub(r"\1", t)
     return t
 
 
+def _refund_limits_sync(session, user_id: int, deducted_free: int, deducted_paid: int) -> None:
+    """Возвращает списанные лимиты атомарными UPDATE — без SELECT ... FOR UPDATE пользователя и баланса."""
+    if deducted_free > 0:
+        session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(free_limits_remaining=User.free_limits_remaining + deducted_free)
+        )
+    if deducted_paid > 0:
+        session.execute(
+            update(UserBalance)
+            .where(UserBalance.user_id == user_id)
+            .values(purchased_credits=UserBalance.purchased_credits + deducted_paid)
+        )
+
+
+def _spend_limits_sync(session, user_id: int, amount: int) -> tuple[int, int] | None:
+    """
+    Списывает amount лимитов (сначала бесплатные, затем купленные) одним UPDATE ... RETURNING
+    (spend_limits_stmt). Возвращает (deducted_free, deducted_paid) или None, если лимитов не хватает —
+    тогда запрос ничего не изменил.
+    """
+    if amount <= 0:
+        return 0, 0
+    ded_free = session.scalar(spend_limits_stmt(user_id, amount))
+    if ded_free is None:
+        return None
+    return ded_free, amount - ded_free
+
+
 @celery_app.task(bind=True, max_retries=3)
 def process_document_task(self, document_id: int, file_id: str) -> None:
     """
@@ -423,11 +697,14 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
     текстом (если ≤4096 символов) или одним .txt файлом.
     """
     session = SyncSession()
+    doc = None
+    chat_id = None
     try:
         doc = session.execute(select(Document).where(Document.id == document_id).options(selectinload(Document.user))).scalar_one_or_none()
         if not doc:
             logger.warning("Document %s not found", document_id)
             return
+        chat_id = doc.user.tg_id
         doc.status = "processing"
         session.commit()
 
@@ -438,65 +715,48 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
         )
         pdf_preanalyzed: tuple[list[str], int] | None = None
         if is_pdf:
-            from pypdf import PdfReader
-
+            # Один разбор PDF: тот же документ идёт в _pdf_analyze_pages
+            reader = None
             try:
-                reader = PdfReader(BytesIO(file_bytes))
-                total_pages = len(reader.pages)
+                reader = _open_pdf(file_bytes)
+                total_pages = _pdf_page_count(reader)
             except Exception as e:
                 logger.warning("Failed to read PDF to count pages: %s", e)
                 total_pages = 1
             max_pages = getattr(settings, "PDF_MAX_PAGES", 50) or 50
             if total_pages > max_pages:
                 _send_telegram_message(
-                    doc.user.tg_id,
+                    chat_id,
                     f"В вашем файле {total_pages} стр. Согласно ограничениям системы, будут обработаны только первые {max_pages} стр.",
                 )
 
-            pypdf_texts, llm_page_count = _pdf_analyze_pages(file_bytes)
+            pypdf_texts, llm_page_count = _pdf_analyze_pages(reader if reader is not None else file_bytes)
+            del reader
             pdf_preanalyzed = (pypdf_texts, llm_page_count)
 
             if llm_page_count > 0:
                 additional_limits_needed = llm_page_count - 1
-                user_record = session.execute(
-                    select(User).where(User.id == doc.user_id).options(selectinload(User.balance)).with_for_update()
-                ).scalar_one()
-                total_available = user_record.free_limits_remaining
-                if user_record.balance:
-                    total_available += user_record.balance.purchased_credits
-
-                if total_available < additional_limits_needed:
-                    user_record.free_limits_remaining += doc.deducted_free
-                    if user_record.balance:
-                        user_record.balance.purchased_credits += doc.deducted_paid
-                    
+                spent = _spend_limits_sync(session, doc.user_id, additional_limits_needed)
+                if spent is None:
+                    total_available = session.scalar(
+                        select(User.free_limits_remaining + func.coalesce(UserBalance.purchased_credits, 0))
+                        .outerjoin(UserBalance, UserBalance.user_id == User.id)
+                        .where(User.id == doc.user_id)
+                    ) or 0
+                    _refund_limits_sync(session, doc.user_id, doc.deducted_free, doc.deducted_paid)
                     doc.status = "error"
                     doc.error_message = "Not enough limits for PDF pages requiring AI"
-                    
-                    _send_telegram_message(
-                        doc.user.tg_id,
-                        f"Для распознавания части страниц нужен ИИ. Требуется {llm_page_count} лимитов, у вас осталось {total_available + 1}. Пополните баланс или отправьте файл меньшего размера.",
-                    )
-                    
                     doc.deducted_free = 0
                     doc.deducted_paid = 0
                     session.commit()
+
+                    _send_telegram_message(
+                        chat_id,
+                        f"Для распознавания части страниц нужен ИИ. Требуется {llm_page_count} лимитов, у вас осталось {total_available + 1}. Пополните баланс или отправьте файл меньшего размера.",
+                    )
                     return  # лимит уже возвращён, выходим
 
-                remaining_to_deduct = additional_limits_needed
-                new_ded_free = 0
-                new_ded_paid = 0
-                
-                if user_record.free_limits_remaining >= remaining_to_deduct:
-                    user_record.free_limits_remaining -= remaining_to_deduct
-                    new_ded_free = remaining_to_deduct
-                else:
-                    new_ded_free = user_record.free_limits_remaining
-                    user_record.free_limits_remaining = 0
-                    new_ded_paid = remaining_to_deduct - new_ded_free
-                    if user_record.balance:
-                        user_record.balance.purchased_credits -= new_ded_paid
-                
+                new_ded_free, new_ded_paid = spent
                 doc.deducted_free += new_ded_free
                 doc.deducted_paid += new_ded_paid
                 session.commit()
@@ -512,7 +772,6 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
         doc.error_message = None
         session.commit()
 
-        chat_id = doc.user.tg_id
         if len(text) <= TG_MESSAGE_MAX_LENGTH:
             _send_telegram_message(chat_id, text or "(Текст не распознан)", parse_mode=None)
         else:
@@ -527,9 +786,20 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
     except Exception as e:
         logger.exception("process_document_task failed: %s", e)
         session.rollback()
-        doc = session.execute(
-            select(Document).where(Document.id == document_id).options(selectinload(Document.user))
-        ).scalar_one_or_none()
+        if doc is None:
+            doc = session.execute(
+                select(Document).where(Document.id == document_id).options(selectinload(Document.user))
+            ).scalar_one_or_none()
+            chat_id = doc.user.tg_id if doc and doc.user else None
+        else:
+            # Документ уже загружен: после rollback перечитываем только нужные поля, без повторного JOIN users.
+            # Строку могли удалить (cleanup_stale_documents_task) — тогда обрабатывать нечего, исходная
+            # ошибка не должна подменяться ошибкой refresh
+            try:
+                session.refresh(doc, attribute_names=["user_id", "status", "deducted_free", "deducted_paid"])
+            except InvalidRequestError:
+                logger.warning("Document %s disappeared before error handling", document_id)
+                doc = None
         if doc:
             doc.status = "error"
             doc.error_message = _sanitize_error_message(str(e))
@@ -545,33 +815,27 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
             
             if is_llm_or_config_error or is_file_too_large:
                 # Refund exactly what was deducted
-                user_record = session.execute(
-                    select(User).where(User.id == doc.user_id).options(selectinload(User.balance)).with_for_update()
-                ).scalar_one_or_none()
-                if user_record:
-                    user_record.free_limits_remaining += doc.deducted_free
-                    if user_record.balance:
-                        user_record.balance.purchased_credits += doc.deducted_paid
-                    doc.deducted_free = 0
-                    doc.deducted_paid = 0
+                _refund_limits_sync(session, doc.user_id, doc.deducted_free, doc.deducted_paid)
+                doc.deducted_free = 0
+                doc.deducted_paid = 0
             session.commit()
             try:
-                if doc.user:
+                if chat_id is not None:
                     if is_file_too_large:
                         # Уведомляем пользователя о превышении размера файла
                         error_text = str(e).split("FILE_TOO_LARGE:")[-1].strip()
                         _send_telegram_message(
-                            doc.user.tg_id,
+                            chat_id,
                             f"❌ Ошибка: {error_text} Пожалуйста, уменьшите размер файла и попробуйте снова. Списанный лимит возвращён.",
                         )
                     elif is_llm_or_config_error:
                         _send_telegram_message(
-                            doc.user.tg_id,
+                            chat_id,
                             "Сервис распознавания временно недоступен. Обратитесь к администратору. Ваш лимит возвращён.",
                         )
                     else:
                         _send_telegram_message(
-                            doc.user.tg_id,
+                            chat_id,
                             "Не удалось обработать документ. Ваш лимит возвращён. Попробуйте позже или обратитесь в поддержку.",
                         )
             except Exception:
@@ -586,6 +850,63 @@ def process_document_task(self, document_id: int, file_id: str) -> None:
 
 
 BROADCAST_CHUNK_SIZE = 50
+# Сколько tg_id читается из серверного курсора за один fetch при формировании батчей рассылки
+BROADCAST_FETCH_BATCH = 5000
+# Темп отправки внутри одной задачи-батча; воркер очереди notify с --concurrency=2 даёт около 30 сообщений/с —
+# общий лимит Telegram на бота
+BROADCAST_RATE_PER_SECOND = 15
+
+
+def _broadcast_request(
+    chat_id: int, text: str, photo_file_id: str | None, video_file_id: str | None
+) -> tuple[str, dict]:
+    """Метод Bot API и тело запроса рассылки для одного получателя (как _send_telegram_photo/_video/_message)."""
+    if photo_file_id:
+        payload = {"chat_id": chat_id, "photo": photo_file_id}
+        if text:
+            payload["caption"] = text[:1024]
+        return "sendPhoto", payload
+    if video_file_id:
+        payload = {"chat_id": chat_id, "video": video_file_id}
+        if text:
+            payload["caption"] = text[:1024]
+        return "sendVideo", payload
+    return "sendMessage", {"chat_id": chat_id, "text": text or "(Пусто)"}
+
+
+async def _broadcast_chunk_async(
+    tg_ids: list, text: str, photo_file_id: str | None, video_file_id: str | None
+) -> int:
+    """
+    Отправляет батч рассылки через один AsyncClient: запросы стартуют с шагом 1/BROADCAST_RATE_PER_SECOND
+    и идут параллельно (ожидание ответа Telegram не тормозит следующий). На 429 — одна повторная
+    попытка через retry_after. Возвращает число доставленных сообщений.
+    """
+
+    base_url = f"https://api.telegram.org/bot{settings.BOT_TOKEN}"
+    interval = 1.0 / BROADCAST_RATE_PER_SECOND
+
+    async with httpx.AsyncClient(timeout=60.0) as client:
+
+        async def _send(chat_id: int, delay: float) -> bool:
+            await asyncio.sleep(delay)
+            method, payload = _broadcast_request(chat_id, text, photo_file_id, video_file_id)
+            try:
+                body = _json_body(payload)
+                r = await client.post(f"{base_url}/{method}", **body)
+                if r.status_code == 429:
+                    retry_after = (_json_loads(r.content).get("parameters") or {}).get("retry_after", 1)
+                    await asyncio.sleep(retry_after)
+                    r = await client.post(f"{base_url}/{method}", **body)
+                r.raise_for_status()
+                return True
+            except Exception as e:
+                logger.warning("broadcast to %s failed: %s", chat_id, e)
+                return False
+
+        results = await asyncio.gather(*(_send(chat_id, i * interval) for i, chat_id in enumerate(tg_ids)))
+    return sum(results)
+
 
 @celery_app.task
 def broadcast_chunk_task(
@@ -597,18 +918,9 @@ def broadcast_chunk_task(
     """
     Отправляет рассылку одному батчу пользователей (вызывается из broadcast_task).
     """
-    import time
-    for chat_id in tg_ids:
-        try:
-            if photo_file_id:
-                _send_telegram_photo(chat_id, photo_file_id, text)
-            elif video_file_id:
-                _send_telegram_video(chat_id, video_file_id, text)
-            else:
-                _send_telegram_message(chat_id, text or "(Пусто)", parse_mode=None)
-        except Exception as e:
-            logger.warning("broadcast to %s failed: %s", chat_id, e)
-        time.sleep(0.05)
+
+    sent = asyncio.run(_broadcast_chunk_async(tg_ids, text, photo_file_id, video_file_id))
+    logger.info("broadcast_chunk_task: sent %s of %s", sent, len(tg_ids))
 
 
 @celery_app.task
@@ -618,18 +930,52 @@ def broadcast_task(text: str = "", photo_file_id: str | None = None, video_file_
     Разбивает получателей на батчи и запускает broadcast_chunk_task для каждого,
     чтобы не блокировать воркер одной длинной задачей.
     """
+    stmt = (
+        select(User.tg_id)
+        .where(User.is_agreed_to_policy)
+        .where(~User.is_banned)
+        .execution_options(yield_per=BROADCAST_FETCH_BATCH)
+    )
+    chunks = 0
+    users = 0
     session = SyncSession()
     try:
-        result = session.execute(
-            select(User.tg_id).where(User.is_agreed_to_policy).where(~User.is_banned)
-        )
-        tg_ids = [row[0] for row in result.fetchall()]
+        # Серверный курсор: батчи уходят в очередь по мере чтения, без списка всех tg_id в памяти
+        for chunk in session.execute(stmt).scalars().partitions(BROADCAST_CHUNK_SIZE):
+            broadcast_chunk_task.delay(list(chunk), text, photo_file_id, video_file_id)
+            chunks += 1
+            users += len(chunk)
+    finally:
+        session.close()
+    logger.info("broadcast_task: dispatched %s chunks for %s users", chunks, users)
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+@celery_app.task
+def export_xlsx_task(kind: str, chat_id: int) -> None:
+    """
+    Выгрузка Excel для админки (users / transactions / summary / utm): строится в воркере,
+    чтобы не занимать event loop бота, и отправляется файлом в чат администратора.
+    """
+    from app.services.export import EXPORTS
+
+    builder, filename, caption = EXPORTS[kind]
+    session = SyncSession()
+    try:
+        file_bytes = builder(session)
+    except Exception as e:
+        logger.exception("export_xlsx_task %s failed: %s", kind, e)
+        _send_telegram_message(chat_id, "Не удалось сформировать выгрузку. Попробуйте позже.", parse_mode=None)
+        return
     finally:
         session.close()
-    for i in range(0, len(tg_ids), BROADCAST_CHUNK_SIZE):
-        chunk = tg_ids[i : i + BROADCAST_CHUNK_SIZE]
-        broadcast_chunk_task.delay(chunk, text, photo_file_id, video_file_id)
-    logger.info("broadcast_task: dispatched %s chunks for %s users", (len(tg_ids) + BROADCAST_CHUNK_SIZE - 1) // BROADCAST_CHUNK_SIZE, len(tg_ids))
+    _send_telegram_document(chat_id, file_bytes, filename=filename, mime_type=XLSX_MIME, caption=caption)
+    logger.info("export_xlsx_task: sent %s (%s bytes) to %s", filename, len(file_bytes), chat_id)
+
+
+# Пользователей на один UPDATE при сбросе бесплатных лимитов (диапазон id)
+RESET_LIMITS_BATCH = 10_000
 
 
 @celery_app.task
@@ -652,15 +998,19 @@ def reset_free_limits_task() -> None:
         except (ValueError, TypeError):
             limit = settings.FREE_LIMITS_PER_MONTH
         now = datetime.now(timezone.utc)
-        result = session.execute(
-            update(User).values(
-                free_limits_remaining=limit,
-                free_limits_reset_at=now,
+        # Диапазонами id с commit после каждого: короткие транзакции не держат блокировки строк всей таблицы,
+        # списания лимитов проходят между батчами. Повтор батча безопасен — значения фиксированы
+        max_id = session.scalar(select(func.max(User.id))) or 0
+        count = 0
+        for lo in range(0, max_id + 1, RESET_LIMITS_BATCH):
+            result = session.execute(
+                update(User)
+                .where(User.id >= lo, User.id < lo + RESET_LIMITS_BATCH)
+                .values(free_limits_remaining=limit, free_limits_reset_at=now)
+                .execution_options(synchronize_session=False)
             )
-        )
-        session.commit()
-        rcount = getattr(result, "rowcount", None)
-        count = rcount if rcount is not None and rcount >= 0 else "?"
+            session.commit()
+            count += max(result.rowcount or 0, 0)
         logger.info("reset_free_limits_task: updated %s users, limit=%s", count, limit)
     except Exception as e:
         logger.exception("reset_free_limits_task failed: %s", e)
@@ -673,53 +1023,87 @@ def reset_free_limits_task() -> None:
 def cleanup_stale_documents_task() -> None:
     """
     Находит документы в pending/processing старше STALE_DOCUMENT_MINUTES минут,
-    возвращает один лимит пользователю и помечает документ как error.
+    возвращает списанные по ним лимиты и помечает документы как error.
+    Пакетно: UPDATE документов с RETURNING прежних списаний, по одному UPDATE на users и user_balances
+    с суммами по пользователям, один commit — независимо от числа зависших документов.
     """
-    from datetime import timedelta
 
     session = SyncSession()
     try:
-        now = datetime.now(timezone.utc)
-        since = now - timedelta(minutes=STALE_DOCUMENT_MINUTES)
-        result = session.execute(
-            select(Document).where(
+        since = datetime.now(timezone.utc) - timedelta(minutes=STALE_DOCUMENT_MINUTES)
+        # Прежние значения списаний: RETURNING в UPDATE отдаёт уже обнулённые
+        stale = (
+            select(Document.id, Document.deducted_free, Document.deducted_paid)
+            .where(
                 Document.status.in_(["pending", "processing"]),
                 Document.created_at < since,
-            ).options(selectinload(Document.user))
+            )
+            .with_for_update(skip_locked=True)
+            .subquery()
         )
-        stale_docs = result.scalars().all()
-        if not stale_docs:
+        rows = session.execute(
+            update(Document)
+            .where(Document.id == stale.c.id)
+            .values(
+                status="error",
+                error_message="Превышено время обработки. Лимит возвращён.",
+                deducted_free=0,
+                deducted_paid=0,
+            )
+            .returning(Document.id, Document.user_id, stale.c.deducted_free, stale.c.deducted_paid)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if not rows:
+            session.commit()
             return
-        for doc in stale_docs:
-            tg_id = doc.user.tg_id if doc.user else None
-            try:
-                user_row = session.execute(
-                    select(User).where(User.id == doc.user_id).options(selectinload(User.balance)).with_for_update()
-                ).scalar_one_or_none()
-                if user_row:
-                    user_row.free_limits_remaining += doc.deducted_free
-                    if user_row.balance:
-                        user_row.balance.purchased_credits += doc.deducted_paid
-                    doc.deducted_free = 0
-                    doc.deducted_paid = 0
-                doc.status = "error"
-                doc.error_message = "Превышено время обработки. Лимит возвращён."
-                session.commit()
-                if tg_id:
-                    try:
-                        _send_telegram_message(
-                            tg_id,
-                            "Обработка файла не была завершена вовремя. Списанные лимиты возвращены на ваш счёт. Попробуйте отправить файл снова.",
-                            parse_mode=None,
-                        )
-                    except Exception as e:
-                        logger.warning("Failed to notify user %s about stale doc: %s", tg_id, e)
-                logger.info("cleanup_stale_documents: refunded limit for doc_id=%s user_id=%s", doc.id, doc.user_id)
-            except Exception as e:
-                logger.exception("cleanup_stale_documents failed for doc %s: %s", doc.id, e)
-                session.rollback()
+
+        refund_free: dict[int, int] = defaultdict(int)
+        refund_paid: dict[int, int] = defaultdict(int)
+        for _doc_id, user_id, ded_free, ded_paid in rows:
+            refund_free[user_id] += ded_free
+            refund_paid[user_id] += ded_paid
+
+        free_refunds = sa_values(
+            column("user_id", Integer), column("amount", Integer), name="free_refunds"
+        ).data(list(refund_free.items()))
+        # Все затронутые пользователи (и с нулевым возвратом бесплатных) — ради tg_id для уведомлений
+        tg_ids = dict(
+            session.execute(
+                update(User)
+                .where(User.id == free_refunds.c.user_id)
+                .values(free_limits_remaining=User.free_limits_remaining + free_refunds.c.amount)
+                .returning(User.id, User.tg_id)
+                .execution_options(synchronize_session=False)
+            ).all()
+        )
+        paid = [(user_id, amount) for user_id, amount in refund_paid.items() if amount > 0]
+        if paid:
+            paid_refunds = sa_values(
+                column("user_id", Integer), column("amount", Integer), name="paid_refunds"
+            ).data(paid)
+            session.execute(
+                update(UserBalance)
+                .where(UserBalance.user_id == paid_refunds.c.user_id)
+                .values(purchased_credits=UserBalance.purchased_credits + paid_refunds.c.amount)
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
     except Exception as e:
         logger.exception("cleanup_stale_documents_task failed: %s", e)
         session.rollback()
+        return
     finally:
         session.close()
+
+    for doc_id, user_id, _ded_free, _ded_paid in rows:
+        tg_id = tg_ids.get(user_id)
+        if tg_id:
+            try:
+                _send_telegram_message(
+                    tg_id,
+                    "Обработка файла не была завершена вовремя. Списанные лимиты возвращены на ваш счёт. Попробуйте отправить файл снова.",
+                    parse_mode=None,
+                )
+            except Exception as e:
+                logger.warning("Failed to notify user %s about stale doc: %s", tg_id, e)
+        logger.info("cleanup_stale_documents: refunded limit for doc_id=%s user_id=%s", doc_id, user_id)
@@ -4,7 +4,8 @@
 """
 from __future__ import annotations
 
-import re
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 from pathlib import Path
 
 from pydantic import field_validator, Field
@@ -13,13 +14,18 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 # .env всегда из корня проекта (где config.py), чтобы воркер Celery подхватывал настройки
 _PROJECT_ROOT = Path(__file__).resolve().parent
 _ENV_FILE = _PROJECT_ROOT / ".env"
+# Путь к .env определяется один раз при импорте; без файла в корне — .env из текущей папки
+_ENV_FILE_STR = str(_ENV_FILE) if _ENV_FILE.exists() else ".env"
+
+# ADMIN_TG_IDS: «,» и «;» → пробел (прочие пробельные символы str.split() режет сам)
+_ADMIN_SEP_TRANS = str.maketrans(",;", "  ")
 
 
 class Settings(BaseSettings):
     """Настройки приложения из .env."""
 
     model_config = SettingsConfigDict(
-        env_file=str(_ENV_FILE) if _ENV_FILE.exists() else ".env",
+        env_file=_ENV_FILE_STR,
         env_file_encoding="utf-8",
         extra="ignore",
     )
@@ -40,6 +46,13 @@ class Settings(BaseSettings):
         description="Synchronous PostgreSQL URL for Alembic/Celery (postgresql://...)",
     )
 
+    # Пул соединений async engine бота (app.db)
+    DB_POOL_SIZE: int = Field(default=20, description="Постоянных соединений в пуле бота")
+    DB_MAX_OVERFLOW: int = Field(default=40, description="Дополнительных соединений сверх пула при пиках")
+    DB_POOL_TIMEOUT: int = Field(default=30, description="Ожидание свободного соединения из пула, сек")
+    DB_POOL_RECYCLE: int = Field(default=3600, description="Пересоздавать соединения старше N сек (NAT/LB рвут простаивающие)")
+    DB_COMMAND_TIMEOUT: int = Field(default=60, description="Таймаут одного запроса asyncpg, сек")
+
     # Redis
     REDIS_URL: str = Field(default="redis://localhost:6379/0", description="Redis URL for Celery broker")
 
@@ -85,6 +98,7 @@ class Settings(BaseSettings):
     )
     LLM_MAX_IMAGE_SIZE: int = Field(default=2048, ge=512, le=4096, description="Max image side (px) before sending to LLM; reduces tokens.")
     LLM_REQUEST_TIMEOUT: int = Field(default=90, ge=30, le=300, description="Timeout for single LLM request (seconds).")
+    LLM_CONCURRENCY: int = Field(default=8, ge=1, le=32, description="Max parallel LLM requests per PDF (bounded by OpenRouter rate limits).")
     PDF_OCR_DPI: int = Field(default=200, ge=150, le=300, description="DPI for PDF pages when converting to images for LLM.")
     PDF_MAX_PAGES: int = Field(default=50, ge=1, le=200, description="Max PDF pages to process in one document (cost control).")
     PDF_MIN_CHARS_PER_PAGE: int = Field(
@@ -104,11 +118,20 @@ class Settings(BaseSettings):
     def parse_admin_ids(cls, v: str | list[int]) -> list[int]:
         if isinstance(v, list):
             return v
-        if isinstance(v, str) and v.strip():
-            parts = re.split(r"[,;\s]+", v.strip())
-            return [int(x) for x in parts if x.strip()]
+        if isinstance(v, str):
+            # Разделители «,», «;» и пробельные символы: translate в пробел и str.split() без regex
+            return [int(x) for x in v.translate(_ADMIN_SEP_TRANS).split()]
         return []
 
+    @field_validator("PAYMENT_PACK_PRICE")
+    @classmethod
+    def normalize_pack_price(cls, v: str) -> str:
+        """Цена приводится к виду «100.00» один раз при загрузке настроек (ЮKassa ждёт два знака)."""
+        try:
+            return f"{Decimal(v.strip()):.2f}"
+        except InvalidOperation as e:
+            raise ValueError(f"PAYMENT_PACK_PRICE: не число: {v!r}") from e
+
     def get_celery_broker_url(self) -> str:
         """URL брокера для Celery."""
         return self.CELERY_BROKER_URL or self.REDIS_URL
@@ -124,6 +147,10 @@ class Settings(BaseSettings):
         return self.DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
 
 
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
-    """Возвращает экземпляр настроек (singleton при повторном вызове с кэшем — опционально)."""
+    """
+    Возвращает экземпляр настроек — один на процесс: .env читается и валидируется при первом вызове.
+    После изменения окружения (тесты) — get_settings.cache_clear().
+    """
     return Settings()
@@ -28,8 +28,8 @@ LEGACY_KEYS = (
 
 def upgrade() -> None:
     conn = op.get_bind()
-    for key in LEGACY_KEYS:
-        conn.execute(text("DELETE FROM bot_settings WHERE key = :key"), {"key": key})
+    # Один DELETE с массивом ключей вместо запроса на каждый ключ
+    conn.execute(text("DELETE FROM bot_settings WHERE key = ANY(:keys)"), {"keys": list(LEGACY_KEYS)})
 
 
 def downgrade() -> None:
@@ -38,19 +38,21 @@ def upgrade() -> None:
     op.add_column("transactions", sa.Column("package_name", sa.String(128), nullable=True))
     op.add_column("transactions", sa.Column("package_pages", sa.Integer(), nullable=True))
     op.add_column("transactions", sa.Column("package_price", sa.Numeric(10, 2), nullable=True))
+    # Снимок у старых транзакций не заполняется: они куплены по единому пакету (PAYMENT_PACK_SIZE)
+    # до появления payment_packages, сопоставить их с тарифами не по чему. Webhook начисляет такие
+    # pending по get_pack_size — UPDATE ... FROM payment_packages записал бы в них чужие тарифы
 
     # Seed 3 тарифов только при пустой таблице (идемпотентный upgrade)
     op.execute(
         sa.text("""
             INSERT INTO payment_packages (code, name, pages, price, currency, is_active, sort_order)
-            SELECT 'demo', 'Демо', 50, 225.00, 'RUB', true, 1
-            WHERE NOT EXISTS (SELECT 1 FROM payment_packages LIMIT 1)
-            UNION ALL
-            SELECT 'basic', 'Базовый', 300, 900.00, 'RUB', true, 2
-            WHERE NOT EXISTS (SELECT 1 FROM payment_packages LIMIT 1)
-            UNION ALL
-            SELECT 'pro', 'Про', 1000, 2900.00, 'RUB', true, 3
-            WHERE NOT EXISTS (SELECT 1 FROM payment_packages LIMIT 1)
+            SELECT v.code, v.name, v.pages, v.price, v.currency, v.is_active, v.sort_order
+            FROM (VALUES
+                ('demo', 'Демо', 50, 225.00, 'RUB', true, 1),
+                ('basic', 'Базовый', 300, 900.00, 'RUB', true, 2),
+                ('pro', 'Про', 1000, 2900.00, 'RUB', true, 3)
+            ) AS v (code, name, pages, price, currency, is_active, sort_order)
+            WHERE NOT EXISTS (SELECT 1 FROM payment_packages)
         """)
     )
 
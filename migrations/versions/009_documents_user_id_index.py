@@ -0,0 +1,39 @@
+"""index on documents.user_id (подсчёт документов пользователя в админке)
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "009"
+down_revision: Union[str, None] = "008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_documents_user_id"),
+            "documents",
+            ["user_id"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f("ix_documents_user_id"),
+            table_name="documents",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,121 @@
+"""stats_counters и users.documents_count, поддерживаемые триггерами
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision: str = "010"
+down_revision: Union[str, None] = "009"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "stats_counters",
+        sa.Column("key", sa.String(length=32), nullable=False),
+        sa.Column("value", sa.Numeric(20, 2), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+    )
+    op.add_column(
+        "users",
+        sa.Column("documents_count", sa.Integer(), server_default="0", nullable=False),
+    )
+
+    # Функции триггеров: счётчики меняются в той же транзакции, что и исходная строка
+    op.execute(
+        """
+        CREATE FUNCTION stats_users_trg() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_counters SET value = value + (CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END)
+            WHERE key = 'users';
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE FUNCTION stats_documents_trg() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE stats_counters SET value = value + 1 WHERE key = 'docs';
+                UPDATE users SET documents_count = documents_count + 1 WHERE id = NEW.user_id;
+            ELSE
+                UPDATE stats_counters SET value = value - 1 WHERE key = 'docs';
+                UPDATE users SET documents_count = documents_count - 1 WHERE id = OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE FUNCTION stats_transactions_trg() RETURNS trigger AS $$
+        DECLARE
+            delta numeric := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'succeeded' THEN
+                delta := delta + NEW.amount;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'succeeded' THEN
+                delta := delta - OLD.amount;
+            END IF;
+            IF delta <> 0 THEN
+                UPDATE stats_counters SET value = value + delta WHERE key = 'paid';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        "CREATE TRIGGER stats_users AFTER INSERT OR DELETE ON users "
+        "FOR EACH ROW EXECUTE FUNCTION stats_users_trg()"
+    )
+    op.execute(
+        "CREATE TRIGGER stats_documents AFTER INSERT OR DELETE ON documents "
+        "FOR EACH ROW EXECUTE FUNCTION stats_documents_trg()"
+    )
+    op.execute(
+        "CREATE TRIGGER stats_transactions AFTER INSERT OR UPDATE OF status, amount OR DELETE ON transactions "
+        "FOR EACH ROW EXECUTE FUNCTION stats_transactions_trg()"
+    )
+
+    # Начальные значения — по текущим данным (после создания триггеров, в той же транзакции миграции)
+    op.execute(
+        """
+        INSERT INTO stats_counters (key, value)
+        SELECT 'users', count(*) FROM users
+        UNION ALL
+        SELECT 'docs', count(*) FROM documents
+        UNION ALL
+        SELECT 'paid', coalesce(sum(amount), 0) FROM transactions WHERE status = 'succeeded'
+        """
+    )
+    op.execute(
+        """
+        UPDATE users u SET documents_count = d.cnt
+        FROM (SELECT user_id, count(*) AS cnt FROM documents GROUP BY user_id) d
+        WHERE d.user_id = u.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS stats_transactions ON transactions")
+    op.execute("DROP TRIGGER IF EXISTS stats_documents ON documents")
+    op.execute("DROP TRIGGER IF EXISTS stats_users ON users")
+    op.execute("DROP FUNCTION IF EXISTS stats_transactions_trg()")
+    op.execute("DROP FUNCTION IF EXISTS stats_documents_trg()")
+    op.execute("DROP FUNCTION IF EXISTS stats_users_trg()")
+    op.drop_column("users", "documents_count")
+    op.drop_table("stats_counters")
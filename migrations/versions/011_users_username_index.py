@@ -0,0 +1,39 @@
+"""index on users.username (поиск пользователя в админке)
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "011"
+down_revision: Union[str, None] = "010"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_users_username"),
+            "users",
+            ["username"],
+            unique=False,
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f("ix_users_username"),
+            table_name="users",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
@@ -0,0 +1,41 @@
+"""partial index on documents (created_at) WHERE status IN ('pending', 'processing') (очистка зависших)
+
+Revision ID: 013
+Revises: 012
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision: str = "013"
+down_revision: Union[str, None] = "012"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_documents_active_created",
+            "documents",
+            ["created_at"],
+            unique=False,
+            postgresql_where=sa.text("status IN ('pending', 'processing')"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_documents_active_created",
+            table_name="documents",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
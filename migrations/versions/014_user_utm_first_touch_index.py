@@ -0,0 +1,40 @@
+"""index on user_utm (user_id, created_at, id) INCLUDE (utm_source, utm_medium, utm_campaign) (first-touch UTM)
+
+Revision ID: 014
+Revises: 013
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "014"
+down_revision: Union[str, None] = "013"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_user_utm_first_touch",
+            "user_utm",
+            ["user_id", "created_at", "id"],
+            unique=False,
+            postgresql_include=["utm_source", "utm_medium", "utm_campaign"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_user_utm_first_touch",
+            table_name="user_utm",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
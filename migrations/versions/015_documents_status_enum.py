@@ -0,0 +1,48 @@
+"""documents.status: varchar(50) → enum document_status
+
+Revision ID: 015
+Revises: 014
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision: str = "015"
+down_revision: Union[str, None] = "014"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DOCUMENT_STATUSES = ("pending", "processing", "done", "error")
+
+
+def _create_active_index() -> None:
+    op.create_index(
+        "ix_documents_active_created",
+        "documents",
+        ["created_at"],
+        unique=False,
+        postgresql_where=sa.text("status IN ('pending', 'processing')"),
+    )
+
+
+def upgrade() -> None:
+    # 4 байта на строку вместо varchar; частичный индекс 013 пересоздаётся — его условие ссылается на status
+    sa.Enum(*DOCUMENT_STATUSES, name="document_status").create(op.get_bind(), checkfirst=True)
+    op.drop_index("ix_documents_active_created", table_name="documents", if_exists=True)
+    op.execute("ALTER TABLE documents ALTER COLUMN status DROP DEFAULT")
+    op.execute("ALTER TABLE documents ALTER COLUMN status TYPE document_status USING status::document_status")
+    op.execute("ALTER TABLE documents ALTER COLUMN status SET DEFAULT 'pending'")
+    _create_active_index()
+
+
+def downgrade() -> None:
+    op.drop_index("ix_documents_active_created", table_name="documents", if_exists=True)
+    op.execute("ALTER TABLE documents ALTER COLUMN status DROP DEFAULT")
+    op.execute("ALTER TABLE documents ALTER COLUMN status TYPE varchar(50) USING status::text")
+    op.execute("ALTER TABLE documents ALTER COLUMN status SET DEFAULT 'pending'")
+    _create_active_index()
+    sa.Enum(name="document_status").drop(op.get_bind(), checkfirst=True)
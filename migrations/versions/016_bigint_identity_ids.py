@@ -0,0 +1,40 @@
+"""documents.id, transactions.id: integer SERIAL → bigint GENERATED BY DEFAULT AS IDENTITY
+
+Revision ID: 016
+Revises: 015
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "016"
+down_revision: Union[str, None] = "015"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Таблицы с самым быстрым ростом; на них нет внешних ключей, менять тип ссылающихся колонок не нужно
+TABLES = ("documents", "transactions")
+
+
+def upgrade() -> None:
+    # Смена типа переписывает таблицу под эксклюзивной блокировкой — дешевле, пока таблицы небольшие
+    for table in TABLES:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id TYPE bigint")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id DROP DEFAULT")
+        op.execute(f"DROP SEQUENCE IF EXISTS {table}_id_seq")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY")
+        op.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(max(id), 0) + 1, false) FROM {table}"
+        )
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id TYPE integer")
+        op.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_id_seq AS integer OWNED BY {table}.id")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')")
+        op.execute(f"SELECT setval('{table}_id_seq', COALESCE(max(id), 0) + 1, false) FROM {table}")
@@ -0,0 +1,148 @@
+"""stats_counters: шардированные строки счётчиков вместо одной строки на ключ
+
+Revision ID: 017
+Revises: 016
+Create Date: 2026-10-15
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "017"
+down_revision: Union[str, None] = "016"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Число шардов на ключ (app.models.stats.STATS_SHARDS). Триггеры пишут дельту в строку шарда
+# pg_backend_pid() % N: параллельные /start, загрузки и оплаты с разных соединений пула не ждут
+# друг друга на одной строке счётчика до commit. Чтение — sum(value) по ключу.
+STATS_SHARDS = 16
+
+# Прибавить дельту к строке шарда текущего соединения (строка создаётся при первой записи)
+_BUMP = (
+    "INSERT INTO stats_counters (key, shard, value) VALUES ({key}, pg_backend_pid() % "
+    f"{STATS_SHARDS}, {{delta}}) "
+    "ON CONFLICT (key, shard) DO UPDATE SET value = stats_counters.value + EXCLUDED.value"
+)
+
+
+def _bump(key: str, delta: str) -> str:
+    return _BUMP.format(key=f"'{key}'", delta=delta)
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE stats_counters ADD COLUMN shard smallint NOT NULL DEFAULT 0")
+    op.execute("ALTER TABLE stats_counters DROP CONSTRAINT stats_counters_pkey")
+    op.execute("ALTER TABLE stats_counters ADD CONSTRAINT stats_counters_pkey PRIMARY KEY (key, shard)")
+
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION stats_users_trg() RETURNS trigger AS $$
+        BEGIN
+            {_bump("users", "CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END")};
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION stats_documents_trg() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {_bump("docs", "1")};
+                UPDATE users SET documents_count = documents_count + 1 WHERE id = NEW.user_id;
+            ELSE
+                {_bump("docs", "-1")};
+                UPDATE users SET documents_count = documents_count - 1 WHERE id = OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION stats_transactions_trg() RETURNS trigger AS $$
+        DECLARE
+            delta numeric := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'succeeded' THEN
+                delta := delta + NEW.amount;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'succeeded' THEN
+                delta := delta - OLD.amount;
+            END IF;
+            IF delta <> 0 THEN
+                {_bump("paid", "delta")};
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+
+
+def downgrade() -> None:
+    # Функции одной строки на ключ (как в 010)
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION stats_users_trg() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_counters SET value = value + (CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END)
+            WHERE key = 'users';
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION stats_documents_trg() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE stats_counters SET value = value + 1 WHERE key = 'docs';
+                UPDATE users SET documents_count = documents_count + 1 WHERE id = NEW.user_id;
+            ELSE
+                UPDATE stats_counters SET value = value - 1 WHERE key = 'docs';
+                UPDATE users SET documents_count = documents_count - 1 WHERE id = OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION stats_transactions_trg() RETURNS trigger AS $$
+        DECLARE
+            delta numeric := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'succeeded' THEN
+                delta := delta + NEW.amount;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'succeeded' THEN
+                delta := delta - OLD.amount;
+            END IF;
+            IF delta <> 0 THEN
+                UPDATE stats_counters SET value = value + delta WHERE key = 'paid';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # Шарды сворачиваются в строку шарда 0 (исходные строки из 010 получили shard = 0 по умолчанию)
+    op.execute(
+        """
+        UPDATE stats_counters c SET value = t.total
+        FROM (SELECT key, sum(value) AS total FROM stats_counters GROUP BY key) t
+        WHERE c.key = t.key AND c.shard = 0
+        """
+    )
+    op.execute("DELETE FROM stats_counters WHERE shard <> 0")
+    op.execute("ALTER TABLE stats_counters DROP CONSTRAINT stats_counters_pkey")
+    op.execute("ALTER TABLE stats_counters DROP COLUMN shard")
+    op.execute("ALTER TABLE stats_counters ADD CONSTRAINT stats_counters_pkey PRIMARY KEY (key)")
@@ -5,28 +5,58 @@ import sys
 if sys.platform != "win32":
     sys.exit(0)
 
-try:
-    out = subprocess.run(
-        ["wmic", "process", "where", "name='python.exe'", "get", "processid,commandline"],
-        capture_output=True,
-        text=True,
-        timeout=10,
-    )
-except Exception as e:
-    print("wmic error:", e)
-    sys.exit(0)
+# Один вызов PowerShell: отбор по WQL-фильтру на стороне CIM и Terminate без taskkill на каждый PID.
+# wmic устарел и в новых сборках Windows 11 отсутствует
+PS_COMMAND = (
+    "Get-CimInstance Win32_Process -Filter \"Name='python.exe' AND CommandLine LIKE '%bot.main%'\" | "
+    "ForEach-Object { if (($_ | Invoke-CimMethod -MethodName Terminate).ReturnValue -eq 0) { $_.ProcessId } }"
+)
+
+
+def _kill_via_powershell() -> list[int] | None:
+    """PID остановленных процессов; None — PowerShell недоступен."""
+    try:
+        out = subprocess.run(
+            ["powershell", "-NoProfile", "-NonInteractive", "-Command", PS_COMMAND],
+            capture_output=True,
+            text=True,
+            timeout=15,
+        )
+    except Exception as e:
+        print("powershell error:", e)
+        return None
+    return [int(line) for line in out.stdout.splitlines() if line.strip().isdigit()]
+
+
+def _kill_via_wmic() -> list[int]:
+    """Запасной путь: вывод wmic читается потоком, процесс снимается сразу при найденной строке."""
+    killed = []
+    try:
+        with subprocess.Popen(
+            ["wmic", "process", "where", "name='python.exe'", "get", "processid,commandline"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ) as proc:
+            for line in proc.stdout:
+                if "bot.main" not in line:
+                    continue
+                pid = line.split()[-1]
+                if not pid.isdigit():
+                    continue
+                try:
+                    subprocess.run(["taskkill", "/F", "/PID", pid], capture_output=True, timeout=5)
+                    killed.append(int(pid))
+                except Exception:
+                    pass
+    except Exception as e:
+        print("wmic error:", e)
+    return killed
+
 
-for line in out.stdout.splitlines():
-    if "bot.main" not in line:
-        continue
-    parts = line.strip().split()
-    for i, p in enumerate(parts):
-        if p.isdigit() and i > 0:
-            pid = int(p)
-            try:
-                subprocess.run(["taskkill", "/F", "/PID", str(pid)], capture_output=True, timeout=5)
-                print("Killed bot PID:", pid)
-            except Exception:
-                pass
-            break
+pids = _kill_via_powershell()
+if pids is None:
+    pids = _kill_via_wmic()
+for pid in pids:
+    print("Killed bot PID:", pid)
 print("Done")
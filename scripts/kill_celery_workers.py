@@ -5,37 +5,63 @@ import sys
 if sys.platform != "win32":
     sys.exit(0)
 
-# Ищем python.exe и celery.exe, в командной строке — celery_app (наша очередь)
-try:
-    out = subprocess.run(
-        ["wmic", "process", "get", "processid,commandline"],
-        capture_output=True,
-        text=True,
-        timeout=15,
-    )
-except Exception as e:
-    print("wmic error:", e)
-    sys.exit(0)
+# python.exe и celery.exe, в командной строке — celery_app и worker (наша очередь).
+# Один вызов PowerShell: отбор по WQL-фильтру на стороне CIM и Terminate без taskkill на каждый PID
+PS_COMMAND = (
+    "Get-CimInstance Win32_Process -Filter \"Name <> 'powershell.exe' AND CommandLine LIKE '%celery_app%' "
+    "AND CommandLine LIKE '%worker%'\" | "
+    "ForEach-Object { if (($_ | Invoke-CimMethod -MethodName Terminate).ReturnValue -eq 0) { $_.ProcessId } }"
+)
+
+
+def _kill_via_powershell() -> list[int] | None:
+    """PID остановленных процессов; None — PowerShell недоступен."""
+    try:
+        out = subprocess.run(
+            ["powershell", "-NoProfile", "-NonInteractive", "-Command", PS_COMMAND],
+            capture_output=True,
+            text=True,
+            timeout=15,
+        )
+    except Exception as e:
+        print("powershell error:", e)
+        return None
+    return [int(line) for line in out.stdout.splitlines() if line.strip().isdigit()]
+
+
+def _kill_via_wmic() -> list[int]:
+    """Запасной путь: вывод wmic читается потоком, процесс снимается сразу при найденной строке."""
+    killed = []
+    try:
+        with subprocess.Popen(
+            ["wmic", "process", "get", "processid,commandline"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ) as proc:
+            for line in proc.stdout:
+                line_lower = line.lower()
+                if "celery_app" not in line_lower or "worker" not in line_lower:
+                    continue
+                pid = line.split()[-1]
+                if not pid.isdigit():
+                    continue
+                try:
+                    subprocess.run(["taskkill", "/F", "/PID", pid], capture_output=True, timeout=5)
+                    killed.append(int(pid))
+                except Exception:
+                    pass
+    except Exception as e:
+        print("wmic error:", e)
+    return killed
+
 
-killed = 0
-for line in out.stdout.splitlines():
-    line_lower = line.lower()
-    if "celery_app" not in line_lower or "worker" not in line_lower:
-        continue
-    if "celery" not in line_lower:
-        continue
-    parts = line.strip().split()
-    for i, p in enumerate(parts):
-        if p.isdigit() and i > 0:
-            pid = int(p)
-            try:
-                subprocess.run(["taskkill", "/F", "/PID", str(pid)], capture_output=True, timeout=5)
-                print("Killed Celery worker PID:", pid)
-                killed += 1
-            except Exception:
-                pass
-            break
-if not killed:
+pids = _kill_via_powershell()
+if pids is None:
+    pids = _kill_via_wmic()
+for pid in pids:
+    print("Killed Celery worker PID:", pid)
+if not pids:
     print("No Celery worker processes found.")
 else:
     print("Done.")
@@ -3,4 +3,4 @@ REM Запуск воркера Celery для обработки фото/PDF и
 REM Без запущенного воркера пользователи не получают результат распознавания.
 cd /d "%~dp0.."
 if exist "venv\Scripts\activate.bat" call venv\Scripts\activate.bat
-celery -A celery_app worker -l info -P solo
+celery -A celery_app worker -l info -P solo -Q ocr,notify,maint
@@ -1,26 +1,40 @@
 import difflib
 
-def is_duplicate(new_line, existing_lines):
-    new_norm = new_line.replace(" ", "").lower()
-    trans = str.maketrans("abcehopxyM", "авсенорхум")
-    new_norm = new_norm.translate(trans)
-    
-    for ex in existing_lines:
-        ex_norm = ex.replace(" ", "").lower().translate(trans)
-        
+_TRANS = str.maketrans("abcehopxyM", "авсенорхум")
+_THRESHOLD = 0.75
+
+
+def normalize(line):
+    return line.replace(" ", "").lower().translate(_TRANS)
+
+
+def build_norm(lines):
+    # Normalize existing lines once, not on every is_duplicate call
+    return [(normalize(line), line) for line in lines]
+
+
+def is_duplicate(new_line, existing_norm):
+    new_norm = normalize(new_line)
+    # b2j is built for seq2 only: keep the new line there and swap existing lines into seq1
+    sm = difflib.SequenceMatcher(None)
+    sm.set_seq2(new_norm)
+
+    for ex_norm, ex in existing_norm:
         # Substring match
         if new_norm in ex_norm or ex_norm in new_norm:
             return True, ex
-            
-        # Fuzzy match
-        ratio = difflib.SequenceMatcher(None, new_norm, ex_norm).ratio()
-        if ratio > 0.75:
+
+        # Fuzzy match: cheap upper bounds first (real_quick_ratio is the length bound),
+        # full ratio() only when they pass
+        sm.set_seq1(ex_norm)
+        if sm.real_quick_ratio() <= _THRESHOLD or sm.quick_ratio() <= _THRESHOLD:
+            continue
+        if sm.ratio() > _THRESHOLD:
             return True, ex
-            
+
     return False, None
 
-existing = ["на работу системы"]
+existing = build_norm(["на работу системы"])
 print(is_duplicate("Ha раб системы.", existing))
 print(is_duplicate("a ie \ ‚м", existing))
 print(is_duplicate("NALie ЛЕ i]", existing))
-
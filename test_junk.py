@@ -1,5 +1,8 @@
 import re
 
+_WORD_RE = re.compile(r'[а-яА-Яa-zA-Z]+')
+_WEIRD_RE = re.compile(r'[^а-яА-Яa-zA-Z0-9\s.,!?:\-]')
+
 lines = [
     "Гарантия 60 днеи”",
     "на работу системы.",
@@ -15,19 +18,20 @@ def is_junk(line: str) -> bool:
     chars = line.replace(" ", "")
     if not chars:
         return True
-    letters = len(re.findall(r'[а-яА-Яa-zA-Z]', chars))
+    # Count letters from the words: one regex pass instead of two
+    words = _WORD_RE.findall(line)
+    letters = sum(len(w) for w in words)
     if letters < 3:
         return True
     if letters / len(chars) < 0.5:
         return True
-    words = re.findall(r'[а-яА-Яa-zA-Z]+', line)
     
     # Needs at least one word of 4+ letters OR multiple 3-letter words
     long_words = sum(1 for w in words if len(w) >= 3)
     if long_words == 0 and not any(len(w) >= 4 for w in words):
         return True
         
-    weird = len(re.findall(r'[^а-яА-Яa-zA-Z0-9\s.,!?:\-]', line))
+    weird = sum(1 for _ in _WEIRD_RE.finditer(line))
     if weird > 2:
         return True
     
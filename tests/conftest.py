@@ -7,7 +7,10 @@ os.environ["BOT_TOKEN"] = "test"
 os.environ["DATABASE_URL"] = "postgresql+asyncpg://u:p@localhost/db"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def settings():
     from config import get_settings
+
+    # Настройки кэшируются на процесс: один сброс за сессию, чтобы кэш совпадал с окружением выше
+    get_settings.cache_clear()
     return get_settings()
@@ -0,0 +1,159 @@
+"""
+Тесты callback_data кнопок профиля пользователя в админке.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot.keyboards.admin import AdminUserCB, admin_user_profile_keyboard
+from bot.routers.admin import (
+    _LIMIT_PROMPTS,
+    _USER_ACTIONS,
+    _render_profile_text,
+    _retag_profile,
+    admin_user_ban,
+    admin_user_legacy_action,
+    admin_user_promote,
+)
+
+
+def _callback_datas(markup) -> list[str]:
+    return [btn.callback_data for row in markup.inline_keyboard for btn in row]
+
+
+def test_profile_buttons_fit_telegram_limit_and_dispatch():
+    """Все кнопки профиля укладываются в 64 байта и имеют обработчик."""
+    markup = admin_user_profile_keyboard(
+        user_id=2_147_483_647, is_banned=False, is_target_admin=False, is_viewer_superadmin=True
+    )
+    actions = set()
+    for data in _callback_datas(markup):
+        assert len(data.encode()) <= 64
+        if not data.startswith("au:"):
+            continue
+        cb = AdminUserCB.unpack(data)
+        assert cb.user_id == 2_147_483_647
+        actions.add(cb.action)
+    assert actions == set(_LIMIT_PROMPTS) | {"ban", "promote"}
+    assert actions <= set(_LIMIT_PROMPTS) | set(_USER_ACTIONS)
+
+
+def test_profile_buttons_banned_admin():
+    """Для заблокированного админа — разбан и снятие прав."""
+    markup = admin_user_profile_keyboard(
+        user_id=7, is_banned=True, is_target_admin=True, is_viewer_superadmin=True
+    )
+    actions = {AdminUserCB.unpack(d).action for d in _callback_datas(markup) if d.startswith("au:")}
+    assert {"unban", "demote"} <= actions
+    assert not {"ban", "promote"} & actions
+
+
+@pytest.mark.asyncio
+async def test_legacy_profile_button_answered():
+    """Кнопка карточки старого формата (adm:u:...) не остаётся без ответа."""
+    from bot.keyboards.admin import ADMIN_USER_LEGACY_PREFIX
+    assert not AdminUserCB(action="ban", user_id=1).pack().startswith(ADMIN_USER_LEGACY_PREFIX)
+    callback = AsyncMock()
+    callback.data = "adm:u:ban:42"
+    await admin_user_legacy_action(callback)
+    callback.answer.assert_awaited_once()
+    assert callback.answer.await_args.kwargs["show_alert"] is True
+
+
+@pytest.mark.asyncio
+async def test_ban_single_update_returning():
+    """Бан — один UPDATE ... RETURNING и commit, без предварительного SELECT."""
+    session = AsyncMock()
+    result = MagicMock()
+    result.one_or_none.return_value = SimpleNamespace(tg_id=100, is_admin=False)
+    session.execute = AsyncMock(return_value=result)
+    callback = AsyncMock()
+    callback.from_user = SimpleNamespace(id=1)
+    callback.message = None
+
+    await admin_user_ban(callback, session, 42)
+
+    assert session.execute.await_count == 1
+    stmt = session.execute.await_args.args[0]
+    assert str(stmt).startswith("UPDATE users")
+    session.commit.assert_awaited_once()
+    callback.answer.assert_awaited_once_with("Пользователь заблокирован")
+
+
+@pytest.mark.asyncio
+async def test_ban_missing_user():
+    """Пользователь не найден — без commit."""
+    session = AsyncMock()
+    result = MagicMock()
+    result.one_or_none.return_value = None
+    session.execute = AsyncMock(return_value=result)
+    session.scalar = AsyncMock(return_value=None)
+    callback = AsyncMock()
+
+    await admin_user_ban(callback, session, 42)
+
+    session.commit.assert_not_awaited()
+    callback.answer.assert_awaited_once_with("Пользователь не найден. Проверьте ID или имя.")
+
+
+@pytest.mark.asyncio
+async def test_ban_already_banned_is_noop():
+    """Повторный бан — без commit и без правки клавиатуры."""
+    session = AsyncMock()
+    result = MagicMock()
+    result.one_or_none.return_value = None
+    session.execute = AsyncMock(return_value=result)
+    session.scalar = AsyncMock(return_value=42)
+    callback = AsyncMock()
+
+    await admin_user_ban(callback, session, 42)
+
+    session.commit.assert_not_awaited()
+    callback.message.edit_reply_markup.assert_not_awaited()
+    callback.answer.assert_awaited_once_with("Пользователь уже заблокирован")
+
+
+def test_retag_profile_matches_full_render():
+    """Правка пометки 👑 в показанной карточке совпадает с полной перерисовкой."""
+    user = SimpleNamespace(
+        created_at=None, is_banned=True, is_admin=False, tg_id=5,
+        username="u", first_name="A", last_name="B", free_limits_remaining=3,
+    )
+    plain = _render_profile_text(user, 2, 4)
+    user.is_admin = True
+    tagged = _render_profile_text(user, 2, 4)
+    assert _retag_profile(plain, True) == tagged
+    assert _retag_profile(tagged, False) == plain
+    assert _retag_profile("Пакет обновлён.", True) is None
+
+
+@pytest.mark.asyncio
+async def test_promote_single_statement_and_retag():
+    """Назначение админом — один UPDATE ... RETURNING, карточка правится без повторного чтения профиля."""
+    user = SimpleNamespace(
+        created_at=None, is_banned=False, is_admin=False, tg_id=5,
+        username="u", first_name="A", last_name="B", free_limits_remaining=3,
+    )
+    shown = _render_profile_text(user, 0, 0)
+    session = AsyncMock()
+    result = MagicMock()
+    result.one_or_none.return_value = SimpleNamespace(tg_id=5, is_banned=False)
+    session.execute = AsyncMock(return_value=result)
+    callback = AsyncMock()
+    callback.from_user = SimpleNamespace(id=1)
+    with (
+        patch("bot.routers.admin.Message", AsyncMock),
+        patch("bot.routers.admin.is_superadmin", return_value=True),
+        patch("bot.routers.admin.invalidate_admin_cache", AsyncMock()) as invalidate,
+    ):
+        callback.message = AsyncMock()
+        callback.message.html_text = shown
+        await admin_user_promote(callback, session, 42)
+
+    assert session.execute.await_count == 1
+    invalidate.assert_awaited_once_with(5)
+    user.is_admin = True
+    assert callback.message.edit_text.await_args.args[0] == _render_profile_text(user, 0, 0)
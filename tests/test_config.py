@@ -10,7 +10,21 @@ def test_admin_ids_parsed(settings):
     assert isinstance(settings.ADMIN_TG_IDS, list)
 
 
+def test_admin_ids_separators():
+    from config import Settings
+
+    assert Settings.parse_admin_ids("1, 2;3\n4\t 5") == [1, 2, 3, 4, 5]
+    assert Settings.parse_admin_ids(" ;, ") == []
+
+
 def test_payment_pack_settings(settings):
     assert settings.PAYMENT_PACK_SIZE >= 1
     assert settings.PAYMENT_PACK_PRICE
     assert "." in settings.PAYMENT_PACK_PRICE or settings.PAYMENT_PACK_PRICE.isdigit()
+
+
+def test_pack_price_normalized():
+    from config import Settings
+
+    assert Settings.normalize_pack_price(" 100 ") == "100.00"
+    assert Settings.normalize_pack_price("99.9") == "99.90"
@@ -1,69 +1,215 @@
 """
-Тесты тарифных пакетов: DTO, форматирование, кэш.
+Тесты тарифных пакетов: DTO, форматирование, кэш, создание платежа.
 """
 from __future__ import annotations
 
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
 import pytest
 
+from app.services import settings as settings_service
 from app.services.settings import (
     PaymentPackageData,
+    get_cached_package_by_code,
     invalidate_packages_cache,
 )
 
 
-def test_payment_package_data_has_required_fields():
-    """PaymentPackageData содержит поля для оплаты и отображения."""
-    pkg = PaymentPackageData(
-        id=1,
-        code="demo",
-        name="Демо",
-        pages=50,
-        price="225.00",
-        currency="RUB",
-        is_active=True,
-        sort_order=1,
+@pytest.fixture(scope="module")
+def demo_pkg() -> PaymentPackageData:
+    return PaymentPackageData(
+        id=1, code="demo", name="Демо", pages=50,
+        price="225.00", currency="RUB", is_active=True, sort_order=1,
     )
-    assert pkg.code == "demo"
-    assert pkg.name == "Демо"
-    assert pkg.pages == 50
-    assert pkg.price == "225.00"
-    assert pkg.is_active is True
 
 
-def test_format_package_button_label():
-    """Формат кнопки выбора пакета."""
-    from bot.keyboards.payments import format_package_button_label
-    pkg = PaymentPackageData(
-        id=1, code="basic", name="Базовый", pages=300,
+@pytest.fixture(scope="module")
+def basic_pkg() -> PaymentPackageData:
+    return PaymentPackageData(
+        id=2, code="basic", name="Базовый", pages=300,
         price="900.00", currency="RUB", is_active=True, sort_order=2,
     )
-    assert "Базовый" in format_package_button_label(pkg)
-    assert "300" in format_package_button_label(pkg)
-    assert "900" in format_package_button_label(pkg)
 
 
-def test_format_tariff_line():
+def test_payment_package_data_has_required_fields(demo_pkg):
+    """PaymentPackageData содержит поля для оплаты и отображения."""
+    assert demo_pkg.code == "demo"
+    assert demo_pkg.name == "Демо"
+    assert demo_pkg.pages == 50
+    assert demo_pkg.price == "225.00"
+    assert demo_pkg.is_active is True
+    assert demo_pkg.price_decimal == Decimal("225.00")
+    assert demo_pkg.price_decimal is demo_pkg.price_decimal
+
+
+def test_format_package_button_label(basic_pkg):
+    """Формат кнопки выбора пакета."""
+    from bot.keyboards.payments import format_package_button_label
+    assert "Базовый" in format_package_button_label(basic_pkg)
+    assert "300" in format_package_button_label(basic_pkg)
+    assert "900" in format_package_button_label(basic_pkg)
+    assert format_package_button_label(basic_pkg) is format_package_button_label(basic_pkg)
+
+
+def test_format_tariff_line(demo_pkg):
     """Строка тарифа с ценой за страницу."""
     from bot.routers.payments import _format_tariff_line
-    pkg = PaymentPackageData(
-        id=1, code="demo", name="Демо", pages=50,
-        price="225.00", currency="RUB", is_active=True, sort_order=1,
-    )
-    line = _format_tariff_line(pkg)
+    line = _format_tariff_line(demo_pkg)
     assert "Демо" in line
     assert "50" in line
     assert "225" in line
     assert "₽" in line
+    assert _format_tariff_line(demo_pkg) is line
 
 
-def test_invalidate_packages_cache_no_error():
-    """Инвалидация кэша пакетов не падает."""
-    invalidate_packages_cache()
+def test_format_tariff_line_currency_symbol():
+    """Символ валюты берётся по коду пакета; неизвестная валюта — кодом."""
+    from bot.routers.payments import _format_tariff_line
+    usd = PaymentPackageData(
+        id=3, code="usd", name="USD", pages=10,
+        price="5.00", currency="USD", is_active=True, sort_order=3,
+    )
+    xyz = PaymentPackageData(
+        id=4, code="xyz", name="XYZ", pages=10,
+        price="5.00", currency="XYZ", is_active=True, sort_order=4,
+    )
+    assert "5.00 $ (0,5 $/стр)" in _format_tariff_line(usd)
+    assert "5.00 XYZ" in _format_tariff_line(xyz)
+
+
+@pytest.mark.parametrize("times", [1, 2, 5])
+def test_invalidate_packages_cache_idempotent(times, demo_pkg):
+    """Повторная полная инвалидация не падает и каждый раз оставляет кэш пустым."""
+    settings_service._set_cached_packages([demo_pkg])
+    for _ in range(times):
+        invalidate_packages_cache()
+        assert not settings_service._PACKAGES_CACHE
+
+
+@pytest.mark.parametrize("code", [None, "demo", "pro"])
+def test_invalidate_packages_cache_scoped(code, demo_pkg, basic_pkg):
+    """Инвалидация на пустом кэше — no-op; точечная сбрасывает только свой код и список."""
+    invalidate_packages_cache(code)
+    assert settings_service._get_cached_packages() is None
+    settings_service._set_cached_packages([demo_pkg, basic_pkg])
+    try:
+        invalidate_packages_cache(code)
+        assert settings_service._get_cached_packages() is None
+        if code is None:
+            assert get_cached_package_by_code("basic") is None
+        else:
+            assert get_cached_package_by_code("basic") is basic_pkg
+            assert (get_cached_package_by_code("demo") is None) == (code == "demo")
+    finally:
+        invalidate_packages_cache()
+
+
+def test_cached_package_by_code(basic_pkg):
+    """Пакет по коду берётся из кэша списка; после инвалидации кэша — None (идём в БД)."""
+    settings_service._set_cached_packages([basic_pkg])
+    assert get_cached_package_by_code("basic") is basic_pkg
+    assert get_cached_package_by_code("pro") is None
     invalidate_packages_cache()
+    assert get_cached_package_by_code("basic") is None
 
 
 def test_pay_package_prefix_length():
     """callback_data укладывается в лимит Telegram 64 байт."""
-    from bot.keyboards.payments import PAY_PACKAGE_PREFIX
+    from bot.keyboards.payments import MAX_PACKAGE_CODE_LEN, PAY_PACKAGE_PREFIX
     # pay:pkg: + code (e.g. "pro") = 11 bytes
     assert len((PAY_PACKAGE_PREFIX + "pro").encode("utf-8")) <= 64
+    assert MAX_PACKAGE_CODE_LEN == 56
+    assert len((PAY_PACKAGE_PREFIX + "x" * MAX_PACKAGE_CODE_LEN).encode("utf-8")) == 64
+
+
+def test_pay_callback_data_cached():
+    """callback_data пакета собирается один раз на код."""
+    from bot.keyboards.payments import PAY_PACKAGE_PREFIX, _pay_cb
+    assert _pay_cb("pro") == PAY_PACKAGE_PREFIX + "pro"
+    assert _pay_cb("pro") is _pay_cb("pro")
+
+
+@pytest.mark.asyncio
+async def test_buy_reserves_txn_before_payment(basic_pkg):
+    """Покупка: строка транзакции вставляется до платежа в ЮKassa, txn_id уходит в metadata, затем payment_id."""
+    from bot.routers.payments import _do_buy_with_package
+
+    settings_service._set_cached_packages([basic_pkg])
+    buyer = MagicMock()
+    buyer.one_or_none.return_value = (7, 0)
+    session = AsyncMock()
+    session.execute = AsyncMock(return_value=buyer)
+    session.scalar = AsyncMock(return_value=11)
+    callback = AsyncMock()
+    callback.from_user = SimpleNamespace(id=100)
+    payment = SimpleNamespace(id="pay-1", confirmation_url="https://pay.example/1")
+
+    async def _create_payment(**kwargs):
+        # к моменту создания платежа строка уже закоммичена
+        assert session.commit.await_count == 1
+        return payment
+
+    try:
+        with patch("bot.routers.payments.create_payment", AsyncMock(side_effect=_create_payment)) as create:
+            assert await _do_buy_with_package(callback, session, "basic") is True
+    finally:
+        invalidate_packages_cache()
+
+    assert create.await_args.kwargs["metadata"]["txn_id"] == "11"
+    assert session.scalar.await_count == 1
+    assert str(session.scalar.await_args.args[0]).startswith("INSERT INTO transactions")
+    stmt = session.execute.await_args.args[0]
+    assert str(stmt).startswith("UPDATE transactions")
+    assert "pay-1" in stmt.compile().params.values()
+    assert session.commit.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_buy_pending_limit_creates_no_payment(basic_pkg):
+    """Лимит pending сработал во вставке (параллельное нажатие) — платёж в ЮKassa не создаётся."""
+    from bot.routers.payments import _do_buy_with_package
+
+    settings_service._set_cached_packages([basic_pkg])
+    buyer = MagicMock()
+    buyer.one_or_none.return_value = (7, 0)
+    session = AsyncMock()
+    session.execute = AsyncMock(return_value=buyer)
+    session.scalar = AsyncMock(return_value=None)
+    callback = AsyncMock()
+    callback.from_user = SimpleNamespace(id=100)
+    try:
+        with patch("bot.routers.payments.create_payment", AsyncMock()) as create:
+            assert await _do_buy_with_package(callback, session, "basic") is False
+    finally:
+        invalidate_packages_cache()
+
+    create.assert_not_awaited()
+    session.commit.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_buy_payment_failure_deletes_reserved_txn(basic_pkg):
+    """Ошибка ЮKassa — зарезервированная строка транзакции удаляется."""
+    from bot.routers.payments import _do_buy_with_package
+
+    settings_service._set_cached_packages([basic_pkg])
+    buyer = MagicMock()
+    buyer.one_or_none.return_value = (7, 0)
+    session = AsyncMock()
+    session.execute = AsyncMock(return_value=buyer)
+    session.scalar = AsyncMock(return_value=11)
+    callback = AsyncMock()
+    callback.from_user = SimpleNamespace(id=100)
+    try:
+        with (
+            patch("bot.routers.payments.create_payment", AsyncMock(side_effect=RuntimeError("down"))),
+            patch("bot.routers.payments.get_settings", return_value=SimpleNamespace(DEMO_PAYMENT_URL="")),
+        ):
+            assert await _do_buy_with_package(callback, session, "basic") is False
+    finally:
+        invalidate_packages_cache()
+
+    assert str(session.execute.await_args.args[0]).startswith("DELETE FROM transactions")
+    assert session.commit.await_count == 2
@@ -0,0 +1,61 @@
+"""
+Тесты пакетного чтения настроек (get_settings_bulk).
+"""
+from __future__ import annotations
+
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from app.services import settings as settings_service
+
+
+@pytest.fixture(autouse=True)
+def _clear_cache():
+    settings_service._SETTINGS_CACHE.clear()
+    yield
+    settings_service._SETTINGS_CACHE.clear()
+
+
+def _session_returning(rows):
+    session = AsyncMock()
+    result = MagicMock()
+    result.all.return_value = rows
+    session.execute = AsyncMock(return_value=result)
+    return session
+
+
+@pytest.mark.asyncio
+async def test_bulk_single_query_and_cache():
+    """Недостающие ключи читаются одним запросом и попадают в кэш."""
+    session = _session_returning([("A", "1"), ("B", "2")])
+    out = await settings_service.get_settings_bulk(session, ["A", "B", "C"])
+    assert out == {"A": "1", "B": "2"}
+    assert session.execute.await_count == 1
+
+    out = await settings_service.get_settings_bulk(session, ["A", "B"])
+    assert out == {"A": "1", "B": "2"}
+    assert session.execute.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_all_cached_no_query():
+    """Если всё в кэше — в БД не ходим."""
+    settings_service._set_cached("A", "x")
+    session = _session_returning([])
+    assert await settings_service.get_settings_bulk(session, ["A"]) == {"A": "x"}
+    session.execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_absent_key_is_cached():
+    """Отсутствующая в БД настройка тоже кэшируется — повторный get_setting без запроса."""
+    session = AsyncMock()
+    session.scalar = AsyncMock(return_value=None)
+    assert await settings_service.get_setting(session, "PAYMENT_TARIFFS_HEADER") is None
+    assert await settings_service.get_setting(session, "PAYMENT_TARIFFS_HEADER") is None
+    assert session.scalar.await_count == 1
+
+    bulk_session = _session_returning([])
+    assert await settings_service.get_settings_bulk(bulk_session, ["PAYMENT_TARIFFS_HEADER"]) == {}
+    bulk_session.execute.assert_not_awaited()
@@ -0,0 +1,30 @@
+"""
+Тесты SQL списания лимитов воркером (доплата за страницы PDF): защита от ухода купленных в минус.
+"""
+from __future__ import annotations
+
+from sqlalchemy.dialects import postgresql
+
+from app.services.limits import spend_limits_stmt
+
+
+def _sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def test_spend_limits_paid_update_rechecks_balance():
+    """UPDATE купленных сам перепроверяет остаток, а бесплатные списываются только вместе с ним."""
+    sql = _sql(spend_limits_stmt(5, 3))
+    paid = sql[sql.index("paid AS"):sql.index("RETURNING user_balances.user_id")]
+    assert "user_balances.purchased_credits >= 3 - locked.ded_free" in paid
+    assert "locked.ded_free < 3" in paid
+    main = sql[sql.index("UPDATE users"):]
+    assert "locked.ded_free >= 3 OR (EXISTS (SELECT paid.user_id" in main
+
+
+def test_spend_limits_locks_users_row_only():
+    """Блокируется строка users (строки баланса может не быть — outer join)."""
+    sql = _sql(spend_limits_stmt(5, 3))
+    assert "LEFT OUTER JOIN user_balances" in sql
+    assert "coalesce(user_balances.purchased_credits, 0) >= 3" in sql
+    assert "FOR UPDATE OF users" in sql
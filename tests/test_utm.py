@@ -1,66 +1,108 @@
 """
-Тесты парсинга UTM из /start payload.
+Тесты парсинга UTM из /start payload и записи UTM при создании пользователя.
 """
-from bot.routers.start import _parse_start_payload, _parse_utm_from_payload
-
-
-def test_parse_start_payload_empty():
-    assert _parse_start_payload("") is None
-    assert _parse_start_payload("/start") is None
-    assert _parse_start_payload("  /start  ") is None
-
-
-def test_parse_start_payload_with_text():
-    assert _parse_start_payload("/start ref123") == "ref123"
-    assert _parse_start_payload("/start utm_source=telegram") == "utm_source=telegram"
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import pytest
+from sqlalchemy.dialects import postgresql
 
-def test_parse_utm_from_payload():
-    assert _parse_utm_from_payload(None) == {}
-    assert _parse_utm_from_payload("") == {}
-    out = _parse_utm_from_payload("utm_source=ads&utm_medium=cpc")
-    assert "utm_source" in out
-    assert out["utm_source"] == ["ads"]  # parse_qs returns lists
-    out2 = _parse_utm_from_payload("single_ref")
-    assert "raw" in out2
+from bot.routers.start import _parse_start_payload, _parse_utm_from_payload
+from bot.services.user import get_or_create_user
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("", None),
+        ("/start", None),
+        ("  /start  ", None),
+        ("/start ref123", "ref123"),
+        ("/start utm_source=telegram", "utm_source=telegram"),
+    ],
+)
+def test_parse_start_payload(text, expected):
+    assert _parse_start_payload(text) == expected
+
+
+@pytest.mark.parametrize(
+    "payload,expected",
+    [
+        (None, {}),
+        ("", {}),
+        ("utm_source=ads&utm_medium=cpc", {"utm_source": "ads", "utm_medium": "cpc"}),
+        ("ref=partner&utm_source=ads", {"utm_source": "ads"}),
+        ("single_ref", {"raw": "single_ref"}),
+    ],
+)
+def test_parse_utm_from_payload(payload, expected):
+    assert _parse_utm_from_payload(payload) == expected
+
+
+def test_parse_utm_from_payload_repeated_key_keeps_first():
+    """Повтор ключа в классическом формате — берётся первое значение."""
+    assert _parse_utm_from_payload("utm_source=a&utm_source=b") == {"utm_source": "a"}
+
+
+@pytest.fixture(scope="module")
+def parsed_full():
+    """Полный набор UTM в классическом формате — разбирается один раз на модуль."""
+    return _parse_utm_from_payload(
+        "utm_source=s&utm_medium=m&utm_campaign=c&utm_term=keyword&utm_content=block"
+    )
 
 
-def test_parse_utm_from_payload_term_content():
+def test_parse_utm_from_payload_term_content(parsed_full):
     """Парсинг utm_term и utm_content."""
-    out = _parse_utm_from_payload(
-        "utm_source=s&utm_medium=m&utm_campaign=c&utm_term=keyword&utm_content=block"
-    )
-    assert out.get("utm_source") == ["s"]
-    assert out.get("utm_medium") == ["m"]
-    assert out.get("utm_campaign") == ["c"]
-    assert out.get("utm_term") == ["keyword"]
-    assert out.get("utm_content") == ["block"]
+    assert parsed_full == {
+        "utm_source": "s",
+        "utm_medium": "m",
+        "utm_campaign": "c",
+        "utm_term": "keyword",
+        "utm_content": "block",
+    }
 
 
 def test_parse_utm_telegram_format_double_underscore():
     """Telegram-формат: source-xxx__medium-yyy__campaign-zzz (разделитель __)."""
     out = _parse_utm_from_payload("source-gramads__medium-AI__campaign-bun")
-    assert out.get("utm_source") == ["gramads"]
-    assert out.get("utm_medium") == ["AI"]
-    assert out.get("utm_campaign") == ["bun"]
+    assert out.get("utm_source") == "gramads"
+    assert out.get("utm_medium") == "AI"
+    assert out.get("utm_campaign") == "bun"
 
 
 def test_parse_utm_telegram_format_single_param():
     """Один параметр в Telegram-формате."""
     out = _parse_utm_from_payload("source-telegram")
-    assert out.get("utm_source") == ["telegram"]
+    assert out.get("utm_source") == "telegram"
 
 
 def test_parse_utm_telegram_format_value_with_hyphen():
     """Значение с дефисом (split по первому '-')."""
     out = _parse_utm_from_payload("source-gram-ads__medium-cpc")
-    assert out.get("utm_source") == ["gram-ads"]
-    assert out.get("utm_medium") == ["cpc"]
+    assert out.get("utm_source") == "gram-ads"
+    assert out.get("utm_medium") == "cpc"
 
 
 def test_parse_utm_short_prefixes_s_m_c():
     """Короткие префиксы s, m, c (как в инструкции для заказчика)."""
     out = _parse_utm_from_payload("s-gramads_m-AI_c-bun")
-    assert out.get("utm_source") == ["gramads"]
-    assert out.get("utm_medium") == ["AI"]
-    assert out.get("utm_campaign") == ["bun"]
+    assert out.get("utm_source") == "gramads"
+    assert out.get("utm_medium") == "AI"
+    assert out.get("utm_campaign") == "bun"
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_user_writes_utm_in_same_statement():
+    """Пользователь, баланс нового пользователя и UTM-запись — один запрос."""
+    session = AsyncMock()
+    result = MagicMock()
+    session.execute = AsyncMock(return_value=result)
+    with patch("bot.services.user._default_free_limit", AsyncMock(return_value=5)):
+        user = await get_or_create_user(session, tg_id=1, utm={"raw_start_payload": "s-ads", "utm_source": "ads"})
+
+    assert user is result.scalar_one_or_none.return_value
+    assert session.execute.await_count == 1
+    sql = str(session.execute.await_args.args[0].compile(dialect=postgresql.dialect()))
+    assert "INSERT INTO users" in sql
+    assert "INSERT INTO user_balances" in sql
+    assert "INSERT INTO user_utm (user_id, raw_start_payload, utm_source)" in sql